@@ -0,0 +1,247 @@
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+
+def content_key(content: bytes, ext: str) -> str:
+    """Ключ кэша: sha256 содержимого + расширение (одни и те же байты парсятся по-разному)"""
+    return hashlib.sha256(content).hexdigest() + "." + ext
+
+
+class ParsedDocumentCache:
+    """
+    Кэш результатов extract_text по хэшу содержимого файла:
+    текст, метаданные и найденная обфускация.
+    - в памяти: LRU по числу записей и суммарному объёму текста;
+    - на диске (опционально, disk_dir): JSON-файлы, переживают рестарт;
+    - для файлов на диске (attack_files/) ключ запоминается по (путь, mtime, size),
+      поэтому при тёплом кэше файл даже не читается; таких путей — не больше
+      max_paths (LRU), на путь — только последняя версия файла.
+    """
+
+    def __init__(self, max_entries: int = 128, max_chars: int = 64_000_000, disk_dir: Optional[str] = None,
+                 max_paths: int = 4096):
+        self.max_entries = max_entries
+        self.max_paths = max_paths
+        self.max_chars = max_chars
+        self.disk_dir = disk_dir
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._chars = 0
+        self._paths: "OrderedDict[str, Tuple[int, int, str]]" = OrderedDict()   # путь -> (mtime_ns, size, ключ)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def _size(entry: Dict[str, Any]) -> int:
+        return len(entry.get("text", "")) + len(entry.get("meta", ""))
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key + ".json")
+
+    def _remember(self, key: str, entry: Dict[str, Any]):
+        size = self._size(entry)
+        if size > self.max_chars:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = entry
+            self._chars += size
+            while len(self._entries) > self.max_entries or self._chars > self.max_chars:
+                _, old = self._entries.popitem(last=False)
+                self._chars -= self._size(old)
+                self._stats["evictions"] += 1
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return entry
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key), encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                entry = None
+            if entry is not None:
+                with self._lock:
+                    self._stats["disk_hits"] += 1
+                self._remember(key, entry)
+                return entry
+        return None
+
+    def put(self, key: str, entry: Dict[str, Any]):
+        self._remember(key, entry)
+        if self.disk_dir:
+            tmp = self._disk_path(key) + ".tmp"
+            try:
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(entry, f, ensure_ascii=False)
+                os.replace(tmp, self._disk_path(key))
+            except OSError:
+                pass
+
+    def get_or_parse(self, content: bytes, ext: str, parse: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        """Вернуть результат из кэша или распарсить и запомнить"""
+        return self._get_or_parse(content_key(content, ext), parse)
+
+    def _get_or_parse(self, key: str, parse: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        entry = self.get(key)
+        if entry is None:
+            with self._lock:
+                self._stats["misses"] += 1
+            entry = parse()
+            self.put(key, entry)
+        return entry
+
+    def get_or_parse_path(self, path: str, parse: Callable[[bytes], Dict[str, Any]]) -> Dict[str, Any]:
+        """То же для файла на диске: при тёплом кэше файл не читается"""
+        st = os.stat(path)
+        ext = path.rsplit('.', 1)[-1].lower()
+        abspath = os.path.abspath(path)
+        with self._lock:
+            known = self._paths.get(abspath)
+            if known is not None:
+                self._paths.move_to_end(abspath)
+        if known is not None and known[:2] == (st.st_mtime_ns, st.st_size):
+            entry = self.get(known[2])
+            if entry is not None:
+                return entry
+        with open(path, "rb") as f:
+            content = f.read()
+        key = content_key(content, ext)
+        with self._lock:
+            self._paths[abspath] = (st.st_mtime_ns, st.st_size, key)
+            self._paths.move_to_end(abspath)
+            while len(self._paths) > self.max_paths:
+                self._paths.popitem(last=False)
+        return self._get_or_parse(key, lambda: parse(content))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries), "chars": self._chars, "paths": len(self._paths)}
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Prompt для ключа кэша ответов: NFKC, нижний регистр, схлопнутые пробелы"""
+    return " ".join(unicodedata.normalize("NFKC", prompt).lower().split())
+
+
+def context_key(docs: Sequence[Any]) -> str:
+    """sha256 текстов выбранных чанков (после защит) в порядке подачи в chain"""
+    h = hashlib.sha256()
+    for d in docs:
+        h.update(d.page_content.encode("utf-8", "surrogatepass"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+def _cosine(a: Sequence[float], b: Sequence[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class ResponseCache:
+    """
+    Кэш ответов LLM перед chain.invoke.
+    Ключ — (нормализованный prompt, хэш выбранного контекста, профиль): набор
+    защит уже отражён в контексте (изоляция/фильтр/санитизация меняют чанки),
+    а защиты ответа применяются к закэшированному сырому ответу заново.
+    profile — параметры генерации класса запроса (generation.profile_key):
+    ответ с max_tokens=128 и temperature=0 не годится классу с другими.
+    - LRU по числу записей и TTL в секундах;
+    - clear() при загрузке/удалении документов;
+    - similarity (опционально): при промахе ищется запись с тем же контекстом
+      и косинусной близостью эмбеддингов prompt не ниже порога.
+    """
+
+    def __init__(self, max_entries: int = 256, ttl: float = 3600.0, similarity: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        # (prompt, контекст, профиль) -> (ответ, срок годности, эмбеддинг prompt или None)
+        self._entries: "OrderedDict[Tuple[str, str, str], Tuple[str, float, Optional[List[float]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "near_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _near(self, ctx: Tuple[str, str], vector: List[float]) -> Optional[Tuple[str, str, str]]:
+        """Ближайший prompt среди записей с тем же (контекстом, профилем)"""
+        best, best_key = self.similarity, None
+        for key, (_, _, vec) in self._entries.items():
+            if key[1:] == ctx and vec is not None:
+                score = _cosine(vector, vec)
+                if score >= best:
+                    best, best_key = score, key
+        return best_key
+
+    def get(self, prompt: str, docs: Sequence[Any],
+            embed: Optional[Callable[[str], List[float]]] = None, profile: str = "") -> Optional[str]:
+        """Ответ из кэша или None; embed(prompt) нужен только для режима similarity"""
+        if not self.enabled:
+            return None
+        key = (normalize_prompt(prompt), context_key(docs), profile)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < now:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return entry[0]
+            has_context = self.similarity is not None and embed is not None and any(
+                k[1:] == key[1:] for k in self._entries
+            )
+        if has_context:
+            vector = embed(key[0])
+            with self._lock:
+                near = self._near(key[1:], vector)
+                entry = self._entries.get(near) if near else None
+                if entry is not None and entry[1] >= now:
+                    self._entries.move_to_end(near)
+                    self._stats["near_hits"] += 1
+                    return entry[0]
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def put(self, prompt: str, docs: Sequence[Any], answer: str,
+            embed: Optional[Callable[[str], List[float]]] = None, profile: str = ""):
+        if not self.enabled:
+            return
+        key = (normalize_prompt(prompt), context_key(docs), profile)
+        vector = embed(key[0]) if self.similarity is not None and embed is not None else None
+        with self._lock:
+            self._entries[key] = (answer, time.monotonic() + self.ttl, vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def clear(self):
+        """Сбросить все ответы (корпус документов изменился)"""
+        with self._lock:
+            self._entries.clear()
+            self._stats["invalidations"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries), "max_entries": self.max_entries,
+                    "ttl": self.ttl, "similarity": self.similarity}
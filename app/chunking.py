@@ -0,0 +1,51 @@
+import os
+from typing import Iterable, Iterator, List, Tuple
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+# ==== НАСТРОЙКИ ЧАНКИНГА ====
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1000"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "100"))
+STREAM_WINDOW = 16 * CHUNK_SIZE   # сколько текста копить перед нарезкой в потоковом режиме
+
+_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=CHUNK_SIZE,
+    chunk_overlap=CHUNK_OVERLAP,
+    add_start_index=True,
+)
+
+def split_text(text: str) -> List[Tuple[int, str]]:
+    """
+    Нарезка документа на чанки при загрузке.
+    Возвращает [(смещение чанка в исходном тексте, текст чанка), ...]
+    """
+    return [
+        (d.metadata.get("start_index", 0), d.page_content)
+        for d in _splitter.create_documents([text])
+    ]
+
+def split_stream(segments: Iterable[str]) -> Iterator[Tuple[int, str]]:
+    """
+    Потоковая нарезка: фрагменты текста (страницы, абзацы) копятся в окне
+    STREAM_WINDOW, готовые чанки отдаются сразу. Хвост окна, который может
+    продолжиться следующим фрагментом, придерживается — в памяти не больше окна.
+    Текст короче окна режется ровно как split_text; на стыках окон границы
+    чанков могут отличаться (нарезка продолжается с начала придержанного чанка),
+    но чанки так же не длиннее CHUNK_SIZE, покрывают весь текст и смещения точные.
+    """
+    buf, base = "", 0   # base — смещение buf в документе
+    for segment in segments:
+        buf += segment
+        if len(buf) < STREAM_WINDOW:
+            continue
+        keep_from = len(buf) - CHUNK_SIZE
+        rest = 0
+        for offset, chunk in split_text(buf):
+            if offset + len(chunk) > keep_from:
+                rest = offset
+                break
+            yield base + offset, chunk
+        buf, base = buf[rest:], base + rest
+    if buf:
+        for offset, chunk in split_text(buf):
+            yield base + offset, chunk
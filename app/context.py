@@ -0,0 +1,99 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Tuple
+
+from langchain_core.documents import Document
+
+from app.metrics import llm_tokenizer
+
+# ==== НАСТРОЙКИ СБОРКИ КОНТЕКСТА ====
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1536"))    # токенов контекста в prompt LLM
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", "20"))          # чанков-кандидатов из retrieval
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.8"))   # Жаккар по шинглам слов
+CHARS_PER_TOKEN = 4       # оценка, если у LLM нет своего токенизатора
+_SHINGLE = 3
+_WORDS = re.compile(r"\w+")
+
+
+class TokenCounter:
+    """Число токенов текста токенизатором модели (с кэшем: чанки повторяются между запросами)"""
+
+    def __init__(self, count: Callable[[str], int], cache_size: int = 4096):
+        self._count = count
+        self._cache: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.cache_size = cache_size
+
+    def __call__(self, text: str) -> int:
+        with self._lock:
+            n = self._cache.get(text)
+            if n is not None:
+                self._cache.move_to_end(text)
+                return n
+        n = self._count(text)
+        with self._lock:
+            self._cache[text] = n
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return n
+
+
+_COUNTERS: Dict[int, TokenCounter] = {}
+
+
+def token_counter(llm) -> TokenCounter:
+    """Счётчик токенов для LLM: llama.cpp tokenize или оценка по CHARS_PER_TOKEN"""
+    counter = _COUNTERS.get(id(llm))
+    if counter is None:
+        count = llm_tokenizer(llm) or (lambda text: -(-len(text) // CHARS_PER_TOKEN))
+        counter = _COUNTERS[id(llm)] = TokenCounter(count)
+    return counter
+
+
+def _shingles(text: str) -> frozenset:
+    words = _WORDS.findall(text.lower())
+    if len(words) < _SHINGLE:
+        return frozenset([tuple(words)])
+    return frozenset(tuple(words[i:i + _SHINGLE]) for i in range(len(words) - _SHINGLE + 1))
+
+
+def _similar(a: frozenset, b: frozenset, threshold: float) -> bool:
+    if not a or not b:
+        return a == b
+    return len(a & b) / len(a | b) >= threshold
+
+
+def pack_context(docs: List[Document], count: Callable[[str], int], budget: int = CONTEXT_TOKEN_BUDGET,
+                 dedup_threshold: float = CONTEXT_DEDUP_THRESHOLD) -> Tuple[List[Document], Dict[str, Any]]:
+    """
+    Сборка контекста под бюджет токенов: чанки по убыванию релевантности
+    (metadata["rank"] от retrieval, меньше — ближе), почти-дубликаты уже
+    взятых пропускаются, чанк, не влезающий в остаток бюджета, — тоже
+    (следующие, более короткие, ещё могут влезть).
+    Возвращает (выбранные чанки в порядке релевантности, отчёт).
+    """
+    ranked = sorted(docs, key=lambda d: d.metadata.get("rank", 0))
+    selected, taken = [], []
+    used = duplicates = over_budget = 0
+    for d in ranked:
+        shingles = _shingles(d.page_content)
+        if any(_similar(shingles, s, dedup_threshold) for s in taken):
+            duplicates += 1
+            continue
+        tokens = count(d.page_content)
+        if used + tokens > budget:
+            over_budget += 1
+            continue
+        used += tokens
+        taken.append(shingles)
+        selected.append(d)
+    return selected, {
+        "budget": budget,
+        "tokens": used,
+        "candidates": len(docs),
+        "selected": len(selected),
+        "dropped_duplicates": duplicates,
+        "dropped_over_budget": over_budget,
+    }
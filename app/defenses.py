@@ -0,0 +1,157 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Type
+
+from fastapi import HTTPException
+
+from app.metrics import observe_stage
+from app.security import filter_prompt, isolate_context, sanitize_answer
+
+DEFENSE_WORKERS = int(os.getenv("DEFENSE_WORKERS", "4"))              # потоков для защит контекста
+DEFENSE_PARALLEL_MIN = int(os.getenv("DEFENSE_PARALLEL_MIN", "16"))   # чанков, с которых батч делится по потокам
+
+_POOL = ThreadPoolExecutor(max_workers=max(1, DEFENSE_WORKERS), thread_name_prefix="defense")
+
+# name -> класс этапа; порядок применения — по DefenseStage.order
+DEFENSES: Dict[str, Type["DefenseStage"]] = {}
+
+
+class StageResult(NamedTuple):
+    texts: List[Optional[str]]     # чанки после этапа; None — чанк выброшен
+    details: Any = None            # что этап нашёл (например, оценки semantic)
+
+
+class DefenseStage:
+    """
+    Этап защиты контекста с пакетным интерфейсом: run() получает все чанки сразу.
+    independent = True — этап только решает, выбросить ли чанк, по исходному
+    тексту, и идёт параллельно с остальными (им не нужен его результат).
+    context — общее состояние запроса (state приложения), если этапу нужны модели.
+    """
+
+    name = ""
+    order = 0
+    independent = False
+
+    def __init__(self, context: Dict[str, Any]):
+        self.context = context
+
+    def run(self, texts: List[str]) -> StageResult:
+        return StageResult([self.apply(t) or None for t in texts])
+
+    def apply(self, text: str) -> str:
+        raise NotImplementedError
+
+
+def register_defense(cls: Type[DefenseStage]) -> Type[DefenseStage]:
+    DEFENSES[cls.name] = cls
+    return cls
+
+
+def defense_names() -> List[str]:
+    return sorted(DEFENSES, key=lambda name: DEFENSES[name].order)
+
+
+def check_defenses(defenses: List[str]):
+    unknown = set(defenses) - set(DEFENSES)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Неизвестные защиты: {sorted(unknown)}")
+
+
+@register_defense
+class SemanticStage(DefenseStage):
+    """Чанки, близкие по эмбеддингу к фразам атак (SemanticDetector), выбрасываются"""
+    name, order, independent = "semantic", 0, True
+
+    def run(self, texts: List[str]) -> StageResult:
+        detector = self.context['models'].get('semantic_detector')
+        scores = detector.score(texts)
+        return StageResult([None if s["flagged"] else t for t, s in zip(texts, scores)],
+                           {"threshold": detector.threshold, "scores": scores})
+
+
+@register_defense
+class IsolationStage(DefenseStage):
+    """Строки с чувствительными ключевыми словами вырезаются"""
+    name, order = "isolation", 10
+
+    def apply(self, text: str) -> str:
+        return isolate_context(text)
+
+
+@register_defense
+class FilterStage(DefenseStage):
+    """Точные совпадения паттернов атак редактируются"""
+    name, order = "filter", 20
+
+    def apply(self, text: str) -> str:
+        return filter_prompt(text)[0]
+
+
+@register_defense
+class SanitizeStage(DefenseStage):
+    """Секреты, e-mail, URL, IP редактируются правилами санитизации"""
+    name, order = "sanitize", 30
+
+    def apply(self, text: str) -> str:
+        return sanitize_answer(text)
+
+
+def _run_stage(stage: DefenseStage, texts: List[Optional[str]]) -> Tuple[StageResult, float]:
+    """Этап по живым чанкам (выброшенные пропускаются); крупный батч делится по потокам"""
+    start = time.perf_counter()
+    alive = [i for i, t in enumerate(texts) if t is not None]
+    batch = [texts[i] for i in alive]
+    if len(batch) >= DEFENSE_PARALLEL_MIN and DEFENSE_WORKERS > 1 and not stage.independent:
+        step = -(-len(batch) // DEFENSE_WORKERS)
+        parts = list(_POOL.map(stage.run, [batch[i:i + step] for i in range(0, len(batch), step)]))
+        details = [p.details for p in parts if p.details is not None]
+        result = StageResult([t for part in parts for t in part.texts], details or None)
+    else:
+        result = stage.run(batch) if batch else StageResult([])
+    out: List[Optional[str]] = [None] * len(texts)
+    for i, text in zip(alive, result.texts):
+        out[i] = text
+    return StageResult(out, result.details), time.perf_counter() - start
+
+
+def run_defenses(texts: List[str], defenses: List[str], context: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Защиты контекста по всем чанкам:
+    независимые этапы (semantic) идут в пуле параллельно цепочке остальных,
+    цепочка (isolation -> filter -> sanitize) применяется по порядку к батчу чанков.
+    Возвращает {"texts": чанки (None — выброшен), "stages": отчёт по этапам,
+    "details": {этап: что нашёл}}.
+    """
+    check_defenses(defenses)
+    stages = [DEFENSES[name](context) for name in defense_names() if name in defenses]
+    side = {s.name: _POOL.submit(_run_stage, s, list(texts)) for s in stages if s.independent}
+    current: List[Optional[str]] = list(texts)
+    results: Dict[str, Tuple[StageResult, float, List[Optional[str]]]] = {}
+    for stage in stages:
+        if not stage.independent:
+            result, seconds = _run_stage(stage, current)
+            results[stage.name] = (result, seconds, current)
+            current = result.texts
+    for name, future in side.items():
+        result, seconds = future.result()
+        results[name] = (result, seconds, list(texts))
+        current = [c if r is not None else None for c, r in zip(current, result.texts)]
+
+    report = []
+    for stage in stages:
+        result, seconds, before = results[stage.name]
+        observe_stage(f"context.{stage.name}", seconds)
+        live = [(b, a) for b, a in zip(before, result.texts) if b is not None]
+        report.append({
+            "stage": stage.name,
+            "ms": round(seconds * 1000, 3),
+            "removed": sum(a is None for _, a in live),
+            "changed": sum(a is not None and a != b for b, a in live),
+        })
+    return {
+        "texts": current,
+        "stages": report,
+        "details": {name: r[0].details for name, r in results.items() if r[0].details is not None},
+    }
@@ -1,67 +1,170 @@
 import os
-import tempfile
+import re
+import codecs
 from io import BytesIO
+from typing import BinaryIO, Iterator
 from fastapi import HTTPException, UploadFile
 from PyPDF2 import PdfReader
 import docx
 
 from app.utils import find_obfuscated_fragments
+from app.cache import ParsedDocumentCache
+
+SUPPORTED_EXTENSIONS = ('pdf', 'docx', 'doc', 'txt', 'text')
+
+# ==== ЛИМИТЫ ЗАГРУЗКИ ====
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "200")) * 2**20       # больше — 413
+MAX_BULK_UPLOAD_BYTES = int(os.getenv("MAX_BULK_UPLOAD_MB", "1024")) * 2**20  # на весь /upload/bulk
+STREAM_THRESHOLD_BYTES = int(os.getenv("STREAM_UPLOAD_MB", "8")) * 2**20  # больше — потоковый разбор
+TEXT_BLOCK_SIZE = 1 << 20   # по сколько байт читать TXT в потоковом режиме
+META_HEADER = "\n\n[Вредоносные метаданные:]\n"
+WORD_CARRY_MAX = 4096        # незаконченное слово на стыке фрагментов — не длиннее
+_TRAILING_WORD = re.compile(r'\w+\Z')
+
+# Кэш распарсенных документов (по sha256 содержимого); PARSE_CACHE_DIR — дисковый уровень
+PARSE_CACHE = ParsedDocumentCache(
+    max_entries=int(os.getenv("PARSE_CACHE_SIZE", "128")),
+    disk_dir=os.getenv("PARSE_CACHE_DIR") or None,
+)
 
 def extract_text(file: UploadFile) -> str:
     """
     Извлекает текст из файла (PDF, DOCX, TXT).
     Также анализирует на наличие обфускации и вредоносных метаданных.
+    Результат кэшируется по хэшу содержимого: повторный файл не парсится.
     """
     content = file.file.read()
     if not content:
         raise HTTPException(status_code=400, detail="File is empty")
     name = file.filename or ''
     ext = name.rsplit('.', 1)[-1].lower()
+    if ext not in SUPPORTED_EXTENSIONS:
+        raise HTTPException(status_code=415, detail="Unsupported file type")
+    parsed = PARSE_CACHE.get_or_parse(content, ext, lambda: parse_document(ext, content))
+    return render_text(parsed)
 
-    # Всё, что извлекли из файла
-    raw_text = ""
-    meta_text = ""
-
-    if ext == 'pdf':
-        reader = PdfReader(BytesIO(content))
-        # 1. Извлекаем основной текст
-        raw_text = '\n'.join(page.extract_text() or '' for page in reader.pages)
-        # 2. Проверяем вредоносные метаданные
-        meta_text = extract_pdf_metadata(reader)
-
-    elif ext in ('docx', 'doc'):
-        tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.' + ext)
-        try:
-            tmp.write(content)
-            tmp.close()
-            doc = docx.Document(tmp.name)
-            # 1. Основной текст
-            raw_text = '\n'.join(p.text for p in doc.paragraphs)
-            # 2. Метаданные — автор, заголовок, сноски
-            meta_text = extract_docx_metadata(doc)
-        finally:
-            os.unlink(tmp.name)
-
-    elif ext in ('txt', 'text'):
-        raw_text = content.decode('utf-8', errors='ignore')
-        meta_text = ""
-
-    else:
+def extract_text_from_path(path: str) -> str:
+    """extract_text для файла на диске (attack_files/): при тёплом кэше файл не читается"""
+    ext = path.rsplit('.', 1)[-1].lower()
+    if ext not in SUPPORTED_EXTENSIONS:
         raise HTTPException(status_code=415, detail="Unsupported file type")
+    parsed = PARSE_CACHE.get_or_parse_path(path, lambda content: parse_document(ext, content))
+    return render_text(parsed)
+
+def render_text(parsed: dict) -> str:
+    """Для RAG возвращаем просто текст (+мета внизу для анализа)"""
+    meta_text = parsed["meta"]
+    return parsed["text"] + (META_HEADER + meta_text if meta_text else "")
+
+def upload_size(file: UploadFile) -> int:
+    """Размер загруженного файла (UploadFile.file — spooled-файл, читать его не нужно)"""
+    f = file.file
+    pos = f.tell()
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(pos)
+    return size
+
+def check_upload_size(size: int):
+    if not size:
+        raise HTTPException(status_code=400, detail="File is empty")
+    if size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Файл больше {MAX_UPLOAD_BYTES // 2**20} МБ")
+
+class DocumentStream:
+    """
+    Потоковое извлечение текста: PDF — по страницам, DOCX — по абзацам,
+    TXT — блоками по TEXT_BLOCK_SIZE. Файл читается прямо из переданного
+    файлового объекта (в т.ч. spooled-файла загрузки), без временных копий;
+    целиком текст в памяти не собирается.
+    Итерация отдаёт фрагменты текста (склейка фрагментов = extract_text),
+    попутно собирая обфускацию; метаданные доступны после iter_body().
+    """
+
+    def __init__(self, ext: str, fileobj: BinaryIO):
+        if ext not in SUPPORTED_EXTENSIONS:
+            raise HTTPException(status_code=415, detail="Unsupported file type")
+        self.ext = ext
+        self.fileobj = fileobj
+        self.meta = ""
+        self.obfuscated = set()
+        self.chars = 0
+
+    def _pdf(self) -> Iterator[str]:
+        reader = PdfReader(self.fileobj)
+        self.meta = extract_pdf_metadata(reader)
+        for i, page in enumerate(reader.pages):
+            if i:
+                yield '\n'
+            yield page.extract_text() or ''
+
+    def _docx(self) -> Iterator[str]:
+        # python-docx читает zip прямо из файлового объекта — без NamedTemporaryFile
+        doc = docx.Document(self.fileobj)
+        self.meta = extract_docx_metadata(doc)
+        for i, p in enumerate(doc.paragraphs):
+            if i:
+                yield '\n'
+            yield p.text
+
+    def _txt(self) -> Iterator[str]:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        while True:
+            block = self.fileobj.read(TEXT_BLOCK_SIZE)
+            if not block:
+                break
+            yield decoder.decode(block)
+        yield decoder.decode(b'', final=True)
+
+    def iter_body(self) -> Iterator[str]:
+        """Основной текст по фрагментам"""
+        if self.ext == 'pdf':
+            parts = self._pdf()
+        elif self.ext in ('docx', 'doc'):
+            parts = self._docx()
+        else:
+            parts = self._txt()
+        carry = ''
+        for part in parts:
+            if not part:
+                continue
+            self.chars += len(part)
+            # слово на стыке фрагментов проверяется целиком: хвост переносится в следующий
+            text = carry + part
+            m = _TRAILING_WORD.search(text, max(0, len(text) - WORD_CARRY_MAX))
+            cut = m.start() if m else len(text)
+            self.obfuscated.update(find_obfuscated_fragments(text[:cut]))
+            carry = text[cut:]
+            yield part
+        if carry:
+            self.obfuscated.update(find_obfuscated_fragments(carry))
+
+    def __iter__(self) -> Iterator[str]:
+        """Текст + секция вредоносных метаданных, как в extract_text"""
+        yield from self.iter_body()
+        if self.meta:
+            tail = META_HEADER + self.meta
+            self.chars += len(tail)
+            yield tail
+
+def parse_document(ext: str, content: bytes) -> dict:
+    """
+    Разбор содержимого файла по расширению.
+    Возвращает {"text", "meta", "obfuscated", "meta_obfuscated"}.
+    """
+    stream = DocumentStream(ext, BytesIO(content))
+    # 1. Основной текст (страницы PDF / абзацы DOCX / TXT)
+    # 2. Вредоносные метаданные — автор, заголовок, producer и т.п.
+    raw_text = ''.join(stream.iter_body())
+    meta_text = stream.meta
 
-    # Анализируем обфускацию (основной текст и метаданные)
-    obfuscated = find_obfuscated_fragments(raw_text)
-    meta_obfuscated = find_obfuscated_fragments(meta_text) if meta_text else []
-
-    # Можно возвращать структуру для фронта:
-    # return {
-    #     "text": raw_text,
-    #     "meta": meta_text,
-    #     "obfuscated": obfuscated,
-    #     "meta_obfuscated": meta_obfuscated
-    # }
-    # Но для RAG возвращаем просто текст (+мета внизу для анализа)
-    return raw_text + ("\n\n[Вредоносные метаданные:]\n" + meta_text if meta_text else "")
+    # Анализируем обфускацию (основной текст — уже по фрагментам, и метаданные)
+    return {
+        "text": raw_text,
+        "meta": meta_text,
+        "obfuscated": sorted(stream.obfuscated),
+        "meta_obfuscated": find_obfuscated_fragments(meta_text) if meta_text else [],
+    }
 
 def extract_pdf_metadata(reader) -> str:
     """
@@ -0,0 +1,132 @@
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from langchain_core.embeddings import Embeddings
+
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "64"))          # текстов в одном forward pass
+EMBED_MAX_WAIT_MS = float(os.getenv("EMBED_MAX_WAIT_MS", "2"))     # окно ожидания попутных запросов
+EMBED_QUERY_CACHE = int(os.getenv("EMBED_QUERY_CACHE", "1024"))    # эмбеддингов запросов в LRU
+
+
+class _Request(NamedTuple):
+    texts: List[str]
+    future: Future
+
+
+class EmbeddingService(Embeddings):
+    """
+    Единый сервис эмбеддингов поверх модели (HuggingFaceEmbeddings) для загрузки,
+    retrieval и защит. Один фоновый поток забирает запросы из очереди и склеивает
+    одновременные в микробатч (до max_batch текстов или max_wait секунд ожидания),
+    так что модель делает один forward pass вместо нескольких по одному тексту.
+    Эмбеддинги повторяющихся запросов (embed_query) берутся из LRU-кэша,
+    одинаковые запросы в полёте считаются один раз.
+    embed_query считается как документ: для симметричных моделей
+    (all-MiniLM-L6-v2) это тот же вектор.
+    """
+
+    def __init__(self, model: Embeddings, max_batch: int = EMBED_MAX_BATCH,
+                 max_wait: float = EMBED_MAX_WAIT_MS / 1000, cache_size: int = EMBED_QUERY_CACHE):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.cache_size = cache_size
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self._cache: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._worker = None
+        self._stats = {"requests": 0, "texts": 0, "batches": 0, "max_batch_texts": 0,
+                       "query_cache_hits": 0, "query_cache_misses": 0, "embed_seconds_total": 0.0}
+
+    def _submit(self, texts: List[str], future: Optional[Future] = None) -> Future:
+        if future is None:
+            future = Future()
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="embedder", daemon=True)
+                self._worker.start()
+            self._stats["requests"] += 1
+        self._queue.put(_Request(texts, future))
+        return future
+
+    def _collect(self) -> List[_Request]:
+        """Первый запрос из очереди и все, что успели прийти за max_wait (до max_batch текстов)"""
+        batch = [self._queue.get()]
+        size = len(batch[0].texts)
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                request = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.texts)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [text for request in batch for text in request.texts]
+            start = time.perf_counter()
+            try:
+                vectors = self.model.embed_documents(texts)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            with self._lock:
+                self._stats["batches"] += 1
+                self._stats["texts"] += len(texts)
+                self._stats["max_batch_texts"] = max(self._stats["max_batch_texts"], len(texts))
+                self._stats["embed_seconds_total"] += time.perf_counter() - start
+            pos = 0
+            for request in batch:
+                request.future.set_result(vectors[pos:pos + len(request.texts)])
+                pos += len(request.texts)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return self._submit(list(texts)).result()
+
+    def embed_query(self, text: str) -> List[float]:
+        with self._lock:
+            vector = self._cache.get(text)
+            if vector is not None:
+                self._cache.move_to_end(text)
+                self._stats["query_cache_hits"] += 1
+                return list(vector)
+            self._stats["query_cache_misses"] += 1
+            future = self._inflight.get(text)
+            owner = future is None
+            if owner:
+                future = self._inflight[text] = Future()
+        if owner:
+            future.add_done_callback(lambda f: self._remember(text, f))
+            self._submit([text], future)
+        return list(future.result()[0])
+
+    def _remember(self, text: str, future: Future):
+        with self._lock:
+            if self._inflight.get(text) is future:
+                del self._inflight[text]
+            if future.exception() is None and self.cache_size > 0:
+                self._cache[text] = future.result()[0]
+                self._cache.move_to_end(text)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cached_queries"] = len(self._cache)
+        stats["queue_depth"] = self._queue.qsize()
+        stats["avg_batch_texts"] = round(stats["texts"] / stats["batches"], 2) if stats["batches"] else 0.0
+        return stats
@@ -0,0 +1,226 @@
+"""
+Пакетный прогон атак × наборов защит.
+
+API: POST /evaluate. CLI:
+    python -m app.evaluation [--attack-file F ...] [--defenses "filter,sanitize" ...]
+                             [--workers N] [--json out.json] [--csv out.csv]
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+
+from app.defenses import defense_names
+from app.generation import chain_name
+from app.pipeline import load_prompt, retrieval_filter, retrieve, defend_context, assemble_context, chain_input, finalize_answer
+from app.utils import to_text
+
+DEFENSE_OPTIONS = defense_names()   # все зарегистрированные этапы защит
+
+TABLE_COLUMNS = [
+    "attack_file", "defenses", "leak", "contains_email", "contains_url", "contains_ip",
+    "exact", "fuzzy", "retrieve_ms", "defense_ms", "generate_ms", "post_ms", "cached", "error",
+]
+
+
+def defense_matrix() -> List[List[str]]:
+    """
+    Все комбинации защит, включая пустую: 2^len(DEFENSE_OPTIONS) — сейчас
+    2^4 = 16 (isolation, filter, sanitize, semantic). Каждая новая защита
+    удваивает число прогонов на файл атаки.
+    """
+    return [
+        list(combo)
+        for n in range(len(DEFENSE_OPTIONS) + 1)
+        for combo in itertools.combinations(DEFENSE_OPTIONS, n)
+    ]
+
+
+def _ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1000, 2)
+
+
+def run_evaluation(
+    state: Dict[str, Any],
+    docs: Dict[str, Any],
+    attack_dir: str,
+    attack_files: List[str],
+    defense_sets: Optional[List[List[str]]] = None,
+    generate: Optional[Callable[[Dict[str, Any]], Any]] = None,
+    workers: int = 1,
+    filters: Optional[Dict[str, Any]] = None,
+    catalog=None,
+) -> Dict[str, Any]:
+    """
+    Прогон матрицы attack_file × defenses:
+    1) prompt и retrieval — один раз на файл атаки;
+    2) защиты контекста — на каждую пару;
+    3) генерация — один раз на уникальную пару (prompt, защищённый контекст),
+       параллельно в workers потоков;
+    4) фильтры/санитизация ответа и sanity_check — на каждую пару.
+    generate(inputs) по умолчанию вызывает chain.invoke напрямую.
+    filters — фильтры retrieval по метаданным (как в /query).
+    catalog — ScenarioCatalog с уже разобранными файлами атак.
+    """
+    defense_sets = defense_sets if defense_sets is not None else defense_matrix()
+    if generate is None:
+        generate = lambda inputs: state['models'].get(chain_name("evaluate")).invoke(inputs)
+    where = retrieval_filter(filters, docs)
+    started = time.perf_counter()
+
+    # 1) Общий retrieval по файлу атаки
+    retrieved = {}
+    for attack_file in attack_files:
+        t0 = time.perf_counter()
+        try:
+            prompt = load_prompt({"attack_file": attack_file}, attack_dir, catalog)
+            load_ms = _ms(t0)
+            t1 = time.perf_counter()
+            raw = retrieve(state, prompt, where)
+            retrieved[attack_file] = {"prompt": prompt, "raw": raw, "load_ms": load_ms, "retrieve_ms": _ms(t1)}
+        except HTTPException as e:
+            retrieved[attack_file] = {"error": str(e.detail)}
+
+    # 2) Защиты контекста по каждой паре
+    rows, jobs = [], {}
+    for attack_file, defenses in itertools.product(attack_files, defense_sets):
+        row = {"attack_file": attack_file, "defenses": list(defenses)}
+        rows.append(row)
+        base = retrieved[attack_file]
+        if "error" in base:
+            row["error"] = base["error"]
+            continue
+        t0 = time.perf_counter()
+        prepared = assemble_context(state, defend_context(base["raw"], defenses, state))
+        prepared.update({"prompt_used": base["prompt"], "defenses": list(defenses)})
+        row.update({"load_ms": base["load_ms"], "retrieve_ms": base["retrieve_ms"], "defense_ms": _ms(t0)})
+        key = (base["prompt"], tuple(d.page_content for d in prepared["selected_docs"]))
+        row["_key"] = key
+        row["cached"] = key in jobs
+        jobs.setdefault(key, prepared)
+
+    # 3) Генерация по уникальным (prompt, контекст)
+    def _run(item):
+        key, prepared = item
+        t0 = time.perf_counter()
+        try:
+            return key, {"answer_raw": to_text(generate(chain_input(prepared))), "generate_ms": _ms(t0)}
+        except Exception as e:
+            return key, {"error": repr(e), "generate_ms": _ms(t0)}
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        answers = dict(pool.map(_run, jobs.items()))
+
+    # 4) Обработка ответа и флаги утечки
+    for row in rows:
+        key = row.pop("_key", None)
+        if key is None:
+            continue
+        gen = answers[key]
+        row["generate_ms"] = 0.0 if row["cached"] else gen["generate_ms"]
+        if "error" in gen:
+            row["error"] = gen["error"]
+            continue
+        t0 = time.perf_counter()
+        answer = finalize_answer(gen["answer_raw"], row["defenses"])
+        row.update({
+            "post_ms": _ms(t0),
+            "flags": answer["flags"],
+            "leak": any(answer["flags"].values()),
+            "found_exact": answer["found_exact"],
+            "found_fuzzy": answer["found_fuzzy"],
+            "answer": answer["answer_filtered"] or answer["answer_sanitized"] or answer["answer_raw"],
+        })
+
+    return {
+        "rows": rows,
+        "summary": {
+            "attack_files": len(attack_files),
+            "defense_sets": len(defense_sets),
+            "runs": len(rows),
+            "generations": len(jobs),
+            "total_seconds": round(time.perf_counter() - started, 3),
+        },
+    }
+
+
+def table_rows(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Плоские строки таблицы результатов (для CSV и вывода в консоль)"""
+    flat = []
+    for row in rows:
+        flags = row.get("flags", {})
+        flat.append({
+            "attack_file": row["attack_file"],
+            "defenses": "+".join(row["defenses"]) or "none",
+            "leak": row.get("leak", ""),
+            "contains_email": flags.get("contains_email", ""),
+            "contains_url": flags.get("contains_url", ""),
+            "contains_ip": flags.get("contains_ip", ""),
+            "exact": len(row.get("found_exact", [])),
+            "fuzzy": len(row.get("found_fuzzy", [])),
+            "retrieve_ms": row.get("retrieve_ms", ""),
+            "defense_ms": row.get("defense_ms", ""),
+            "generate_ms": row.get("generate_ms", ""),
+            "post_ms": row.get("post_ms", ""),
+            "cached": row.get("cached", ""),
+            "error": row.get("error", ""),
+        })
+    return flat
+
+
+def format_table(rows: List[Dict[str, Any]]) -> str:
+    flat = table_rows(rows)
+    widths = {c: max([len(c)] + [len(str(r[c])) for r in flat]) for c in TABLE_COLUMNS}
+    lines = ["  ".join(c.ljust(widths[c]) for c in TABLE_COLUMNS)]
+    lines.append("  ".join("-" * widths[c] for c in TABLE_COLUMNS))
+    for r in flat:
+        lines.append("  ".join(str(r[c]).ljust(widths[c]) for c in TABLE_COLUMNS))
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Пакетный прогон атак × защит")
+    parser.add_argument("--attack-file", action="append", dest="attack_files",
+                        help="файл атаки (по умолчанию — все из attack_scenarios.json)")
+    parser.add_argument("--defenses", action="append", dest="defense_sets",
+                        help='набор защит через запятую, "" — без защит (по умолчанию — все 16 комбинаций)')
+    parser.add_argument("--workers", type=int, default=int(os.getenv("LLM_WORKERS", "1")))
+    parser.add_argument("--json", dest="json_path", help="сохранить полный результат в JSON")
+    parser.add_argument("--csv", dest="csv_path", help="сохранить таблицу в CSV")
+    args = parser.parse_args(argv)
+
+    # Полное состояние приложения: встроенные документы, индекс, модели
+    from app import main as app_main
+    app_main.startup_event()
+
+    attack_files = args.attack_files or app_main.default_attack_files()
+    defense_sets = (
+        [[d for d in s.split(",") if d] for s in args.defense_sets]
+        if args.defense_sets is not None else None
+    )
+    result = run_evaluation(
+        app_main.app.state.rag, app_main.DOCS, app_main.ATTACK_FILES_DIR,
+        attack_files, defense_sets, workers=args.workers,
+    )
+
+    print(format_table(result["rows"]))
+    print(json.dumps(result["summary"], ensure_ascii=False))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.csv_path:
+        with open(args.csv_path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=TABLE_COLUMNS)
+            writer.writeheader()
+            writer.writerows(table_rows(result["rows"]))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,265 @@
+"""
+Параметры генерации по классам запросов и бэкенды llama.cpp с переиспользованием KV-кэша.
+
+Классы запросов: query (/query), stream (/query/stream), evaluate (/evaluate).
+У каждого свой профиль — n_ctx, n_threads, n_batch (параметры загрузки модели)
+и max_tokens, temperature, top_p (параметры выборки). Профили переопределяются
+LLM_PROFILES — JSON-строкой или путём к JSON-файлу, например:
+    {"evaluate": {"max_tokens": 128, "temperature": 0.0}, "stream": {"n_threads": 8}}
+Классы с одинаковыми параметрами загрузки делят один экземпляр модели.
+
+KV-кэш: prompt собран так, что неизменная часть (системный prompt + контекст)
+идёт первой, а вопрос — последним. llama.cpp переиспользует KV-кэш общего
+префикса с предыдущим вызовом, поэтому:
+- LLM_SLOTS > 1 — несколько экземпляров модели (веса общие через mmap, KV-кэш
+  у каждого свой); запрос уходит в слот, где уже лежит тот же контекст;
+- LLM_PROMPT_CACHE_MB > 0 — у каждого слота ещё и LlamaRAMCache с состояниями
+  нескольких последних prompt (поиск по самому длинному общему префиксу);
+- LLM_BACKEND=server — llama.cpp server (llama-server --parallel N) по HTTP:
+  параллельные запросы декодируются одним батчем в слотах сервера,
+  cache_prompt оставляет префикс в KV-кэше слота.
+"""
+import json
+import os
+import threading
+import zlib
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import requests
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+from pydantic import PrivateAttr
+
+LLM_SLOTS = int(os.getenv("LLM_SLOTS", "1"))                               # экземпляров модели (llamacpp)
+LLM_PROMPT_CACHE_MB = int(os.getenv("LLM_PROMPT_CACHE_MB", "0"))           # LlamaRAMCache на слот, 0 — выкл.
+LLAMA_SERVER_URL = os.getenv("LLAMA_SERVER_URL", "http://127.0.0.1:8080")  # LLM_BACKEND=server
+LLAMA_SERVER_TIMEOUT = float(os.getenv("LLAMA_SERVER_TIMEOUT", "600"))
+
+REQUEST_CLASSES = ("query", "stream", "evaluate")
+MODEL_KEYS = ("n_ctx", "n_threads", "n_batch")
+SAMPLING_KEYS = ("max_tokens", "temperature", "top_p")
+DEFAULT_PROFILE = {
+    "n_ctx": int(os.getenv("LLM_N_CTX", "8192")),
+    "n_threads": int(os.getenv("LLM_THREADS", "4")),
+    "n_batch": int(os.getenv("LLM_N_BATCH", "512")),
+    "max_tokens": int(os.getenv("LLM_MAX_TOKENS", "256")),
+    "temperature": 0.7,
+    "top_p": 0.9,
+}
+
+
+def load_profiles(raw: Optional[str]) -> Dict[str, Dict[str, Any]]:
+    """Профили всех классов: DEFAULT_PROFILE, поверх — переопределения из JSON (строка или путь к файлу)"""
+    overrides: Dict[str, Any] = {}
+    if raw:
+        if os.path.isfile(raw):
+            with open(raw, encoding="utf-8") as f:
+                overrides = json.load(f)
+        else:
+            overrides = json.loads(raw)
+    unknown = set(overrides) - set(REQUEST_CLASSES)
+    if unknown:
+        raise ValueError(f"LLM_PROFILES: неизвестные классы запросов {sorted(unknown)}")
+    profiles = {}
+    for name in REQUEST_CLASSES:
+        fields = overrides.get(name, {})
+        bad = set(fields) - set(MODEL_KEYS) - set(SAMPLING_KEYS)
+        if bad:
+            raise ValueError(f"LLM_PROFILES[{name}]: неизвестные параметры {sorted(bad)}")
+        profiles[name] = {**DEFAULT_PROFILE, **fields}
+    return profiles
+
+
+PROFILES = load_profiles(os.getenv("LLM_PROFILES"))
+
+
+def model_params(request_class: str) -> Dict[str, Any]:
+    return {k: PROFILES[request_class][k] for k in MODEL_KEYS}
+
+
+def sampling_params(request_class: str) -> Dict[str, Any]:
+    return {k: PROFILES[request_class][k] for k in SAMPLING_KEYS}
+
+
+def llm_name(request_class: str) -> str:
+    """Имя модели класса в реестре: классы с параметрами загрузки как у query делят "llm" """
+    if request_class == "query" or model_params(request_class) == model_params("query"):
+        return "llm"
+    return f"llm_{request_class}"
+
+
+def chain_name(request_class: str) -> str:
+    """Имя RAG-chain класса в реестре ("chain" — для query)"""
+    return "chain" if request_class == "query" else f"chain_{request_class}"
+
+
+def profile_key(request_class: str) -> str:
+    """Профиль класса для ключа кэша ответов: классы с одинаковым профилем делят ответы"""
+    return json.dumps(PROFILES[request_class], sort_keys=True)
+
+
+class SlotPool(LLM):
+    """
+    Несколько экземпляров LlamaCpp как слоты параллельной генерации.
+    Запрос получает свободный слот, в котором последним был тот же префикс
+    prompt (prefix_of) — тогда llama.cpp считает заново только вопрос;
+    иначе — слот по хэшу префикса или любой свободный. Занятых слотов
+    не больше len(slots), остальные ждут.
+    """
+
+    slots: List[Any]
+    prefix_of: Callable[[str], str]
+
+    _cond: threading.Condition = PrivateAttr(default_factory=threading.Condition)
+    _free: List[int] = PrivateAttr(default_factory=list)
+    _last: Dict[int, int] = PrivateAttr(default_factory=dict)   # слот -> crc32 последнего префикса
+    _stats: Dict[str, int] = PrivateAttr(default_factory=lambda: {"calls": 0, "prefix_hits": 0, "waits": 0})
+
+    def model_post_init(self, __context: Any):
+        self._free = list(range(len(self.slots)))
+
+    @property
+    def _llm_type(self) -> str:
+        return "llamacpp_slots"
+
+    @property
+    def client(self):
+        # токенизатор у слотов общий (одна модель) — для metrics.llm_tokenizer
+        return self.slots[0].client
+
+    def _acquire(self, prompt: str) -> int:
+        key = zlib.crc32(self.prefix_of(prompt).encode("utf-8", "surrogatepass"))
+        with self._cond:
+            self._stats["calls"] += 1
+            if not self._free:
+                self._stats["waits"] += 1
+                self._cond.wait_for(lambda: self._free)
+            warm = [i for i in self._free if self._last.get(i) == key]
+            if warm:
+                slot = warm[0]
+                self._stats["prefix_hits"] += 1
+            else:
+                home = key % len(self.slots)
+                slot = home if home in self._free else self._free[0]
+            self._free.remove(slot)
+            self._last[slot] = key
+            return slot
+
+    def _release(self, slot: int):
+        with self._cond:
+            self._free.append(slot)
+            self._cond.notify()
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        slot = self._acquire(prompt)
+        try:
+            return self.slots[slot]._call(prompt, stop, run_manager, **kwargs)
+        finally:
+            self._release(slot)
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[GenerationChunk]:
+        slot = self._acquire(prompt)
+        try:
+            yield from self.slots[slot]._stream(prompt, stop, run_manager, **kwargs)
+        finally:
+            self._release(slot)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {**self._stats, "slots": len(self.slots), "free": len(self._free)}
+
+
+class _ServerTokenizer:
+    """tokenize() в духе llama_cpp.Llama поверх /tokenize сервера — для подсчёта токенов"""
+
+    def __init__(self, llm: "LlamaServerLLM"):
+        self._llm = llm
+
+    def tokenize(self, text: bytes, add_bos: bool = True) -> List[int]:
+        resp = self._llm._post("/tokenize", {"content": text.decode("utf-8", "replace"), "add_special": add_bos})
+        return resp.json()["tokens"]
+
+
+class LlamaServerLLM(LLM):
+    """
+    Клиент llama.cpp server (/completion). Параллельные запросы сервер
+    раскладывает по слотам (--parallel) и декодирует одним батчем;
+    cache_prompt=True — общий префикс prompt берётся из KV-кэша слота.
+    n_ctx и потоки задаются при запуске сервера (контекст делится между слотами).
+    """
+
+    base_url: str = LLAMA_SERVER_URL
+    timeout: float = LLAMA_SERVER_TIMEOUT
+    max_tokens: int = DEFAULT_PROFILE["max_tokens"]
+    temperature: float = DEFAULT_PROFILE["temperature"]
+    top_p: float = DEFAULT_PROFILE["top_p"]
+
+    _session: requests.Session = PrivateAttr(default_factory=requests.Session)
+
+    @property
+    def _llm_type(self) -> str:
+        return "llamacpp_server"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"base_url": self.base_url, "max_tokens": self.max_tokens,
+                "temperature": self.temperature, "top_p": self.top_p}
+
+    @property
+    def client(self) -> _ServerTokenizer:
+        return _ServerTokenizer(self)
+
+    def _post(self, path: str, payload: Dict[str, Any], stream: bool = False) -> requests.Response:
+        resp = self._session.post(self.base_url.rstrip("/") + path, json=payload, stream=stream, timeout=self.timeout)
+        resp.raise_for_status()
+        return resp
+
+    def _payload(self, prompt: str, stop: Optional[List[str]], stream: bool, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "prompt": prompt,
+            "n_predict": kwargs.get("max_tokens", self.max_tokens),
+            "temperature": kwargs.get("temperature", self.temperature),
+            "top_p": kwargs.get("top_p", self.top_p),
+            "stop": stop or [],
+            "cache_prompt": True,
+            "stream": stream,
+        }
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        return self._post("/completion", self._payload(prompt, stop, False, kwargs)).json()["content"]
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[GenerationChunk]:
+        with self._post("/completion", self._payload(prompt, stop, True, kwargs), stream=True) as resp:
+            for line in resp.iter_lines():
+                if not line.startswith(b"data: "):
+                    continue
+                data = json.loads(line[len(b"data: "):])
+                text = data.get("content", "")
+                if text:
+                    chunk = GenerationChunk(text=text)
+                    if run_manager:
+                        run_manager.on_llm_new_token(text, chunk=chunk)
+                    yield chunk
+                if data.get("stop"):
+                    break
+
+
+def build_llamacpp(model_path: str, request_class: str, prefix_of: Callable[[str], str]):
+    """LlamaCpp с параметрами загрузки класса; LLM_SLOTS > 1 — пул слотов SlotPool"""
+    from langchain_community.llms import LlamaCpp
+
+    def _one():
+        llm = LlamaCpp(model_path=model_path, **model_params(request_class), **sampling_params(request_class))
+        if LLM_PROMPT_CACHE_MB > 0:
+            from llama_cpp import LlamaRAMCache
+            llm.client.set_cache(LlamaRAMCache(capacity_bytes=LLM_PROMPT_CACHE_MB * 2**20))
+        return llm
+
+    if LLM_SLOTS <= 1:
+        return _one()
+    return SlotPool(slots=[_one() for _ in range(LLM_SLOTS)], prefix_of=prefix_of)
@@ -0,0 +1,263 @@
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from langchain_core.documents import Document
+from langchain_community.vectorstores import Chroma
+
+from app.chunking import split_text
+from app.metrics import span
+
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+BULK_EMBED_BATCH_SIZE = int(os.getenv("BULK_EMBED_BATCH_SIZE", "512"))   # батч при пакетной загрузке
+# Уровни доверия документов (metadata "trust" каждого чанка) — по ним можно
+# отсечь документы в retrieval, не заводя отдельный индекс
+TRUST_LEVELS = ("public", "user", "internal", "secret")
+DEFAULT_TRUST = os.getenv("DEFAULT_TRUST", "user")
+
+
+def _base_metadata(doc_id: str, metadata: Optional[Dict]) -> Dict:
+    """Метаданные всех чанков документа: filename, trust, uploaded_at, doc_id"""
+    return {"filename": "", "trust": DEFAULT_TRUST, "uploaded_at": time.time(), **(metadata or {}), "doc_id": doc_id}
+
+
+class DocumentIndex:
+    """
+    Инкрементальный менеджер векторного индекса.
+    Документ нарезается на чанки при загрузке; каждый чанк хранится в Chroma
+    со своим эмбеддингом и метаданными (doc_id, offset, chunk, filename,
+    trust, uploaded_at) — по ним фильтрует retrieval.
+    При загрузке/удалении пересчитывается только затронутый документ,
+    а не весь корпус.
+    lexical: BM25Index — лексический индекс, который ведётся вместе с векторным.
+    """
+
+    def __init__(self, embedder, k: int = 5, collection_name: str = "rag_docs",
+                 persist_directory: Optional[str] = None, lexical=None):
+        self.embedder = embedder
+        self.lexical = lexical
+        # persist_directory: коллекция хранится на диске и открывается при рестарте без пересчёта
+        self.vect = Chroma(
+            collection_name=collection_name,
+            embedding_function=embedder,
+            persist_directory=persist_directory,
+        )
+        self.retriever = self.vect.as_retriever(search_kwargs={"k": k})
+        self._lock = threading.Lock()
+
+    def add(self, doc_id: str, text: str, metadata: Optional[Dict] = None) -> int:
+        """Нарезать документ, посчитать эмбеддинги чанков батчами и записать в индекс.
+        Возвращает число чанков."""
+        with span("index.chunk"):
+            chunks = split_text(text)
+        return self.add_chunks(doc_id, chunks, metadata)
+
+    def add_chunks(self, doc_id: str, chunks: Iterable[Tuple[int, str]], metadata: Optional[Dict] = None) -> int:
+        """
+        Записать готовые чанки [(offset, текст), ...] — в т.ч. из генератора
+        (потоковая загрузка): из него берётся не больше EMBED_BATCH_SIZE чанков
+        за раз, так что память ограничена батчем. Разбор файла (генератор),
+        эмбеддинги и лемматизация для BM25 идут без блокировки индекса — она
+        берётся только на запись батча, и остальные загрузки/удаления не ждут
+        парсинга. Возвращает число чанков.
+        """
+        base = _base_metadata(doc_id, metadata)
+        count = 0
+        with self._lock:
+            self._delete(doc_id)
+        try:
+            batch = []
+            for chunk in chunks:
+                batch.append(chunk)
+                if len(batch) >= EMBED_BATCH_SIZE:
+                    self._upsert(doc_id, base, count, batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                self._upsert(doc_id, base, count, batch)
+                count += len(batch)
+        except Exception:
+            # не оставляем в индексе половину документа
+            with self._lock:
+                self._delete(doc_id)
+            raise
+        return count
+
+    def add_many(self, docs: List[Tuple[str, str, Optional[Dict]]]) -> List[int]:
+        """
+        Пакетная загрузка [(doc_id, текст, метаданные), ...]: чанки всех документов
+        эмбеддятся и лемматизируются общими батчами по BULK_EMBED_BATCH_SIZE (без блокировки индекса)
+        и пишутся в индекс под блокировкой по батчу. Возвращает число чанков каждого документа.
+        """
+        rows, counts = [], []
+        for doc_id, text, metadata in docs:
+            base = _base_metadata(doc_id, metadata)
+            with span("index.chunk"):
+                chunks = split_text(text)
+            counts.append(len(chunks))
+            rows.extend(self._rows(doc_id, base, 0, chunks))
+        doc_ids = [doc_id for doc_id, _, _ in docs]
+        with self._lock:
+            self._delete(*doc_ids)
+        try:
+            for i in range(0, len(rows), BULK_EMBED_BATCH_SIZE):
+                batch = rows[i:i + BULK_EMBED_BATCH_SIZE]
+                embeddings, analyzed = self._embed(batch), self._analyze(batch)
+                with self._lock:
+                    self._store(batch, embeddings, analyzed)
+        except Exception:
+            with self._lock:
+                self._delete(*doc_ids)
+            raise
+        return counts
+
+    @staticmethod
+    def _rows(doc_id: str, base: Dict, start: int, batch: List[Tuple[int, str]]) -> List[Tuple[str, str, Dict]]:
+        """(id, текст, метаданные) для чанков документа, нумерация с start"""
+        return [
+            (f"{doc_id}:{start + i}", chunk, {**base, "offset": offset, "chunk": start + i})
+            for i, (offset, chunk) in enumerate(batch)
+        ]
+
+    def _embed(self, rows: List[Tuple[str, str, Dict]]) -> List[List[float]]:
+        with span("index.embed"):
+            return self.embedder.embed_documents([text for _, text, _ in rows])
+
+    def _analyze(self, rows: List[Tuple[str, str, Dict]]) -> list:
+        """Частоты термов BM25 — как и эмбеддинги, считаются без блокировки индекса"""
+        if self.lexical is None:
+            return []
+        with span("index.lexical"):
+            return self.lexical.analyze(rows)
+
+    def _store(self, rows: List[Tuple[str, str, Dict]], embeddings: List[List[float]], analyzed: list):
+        """
+        Записать чанки с готовыми эмбеддингами в Chroma и их частоты термов
+        (_analyze) в BM25 (под self._lock: только запись, без пересчётов)
+        """
+        with span("index.write"):
+            self.vect._collection.upsert(
+                ids=[row_id for row_id, _, _ in rows],
+                embeddings=embeddings,
+                metadatas=[meta for _, _, meta in rows],
+                documents=[text for _, text, _ in rows],
+            )
+            if self.lexical is not None and analyzed:
+                self.lexical.add_analyzed(analyzed)
+
+    def _delete(self, *doc_ids: str):
+        """Удалить чанки документов из векторного и лексического индексов (под self._lock)"""
+        if not doc_ids:
+            return
+        self.vect.delete(where={"doc_id": doc_ids[0]} if len(doc_ids) == 1 else {"doc_id": {"$in": list(doc_ids)}})
+        if self.lexical is not None:
+            for doc_id in doc_ids:
+                self.lexical.remove(doc_id)
+
+    def _write(self, rows: List[Tuple[str, str, Dict]]):
+        # тексты чанков не меняются — частоты термов BM25 остаются прежними
+        self._store(rows, self._embed(rows), [])
+
+    def _upsert(self, doc_id: str, base: Dict, start: int, batch: List[Tuple[int, str]]):
+        """Эмбеддинги и частоты термов батча — без блокировки, запись — под ней"""
+        rows = self._rows(doc_id, base, start, batch)
+        embeddings, analyzed = self._embed(rows), self._analyze(rows)
+        with self._lock:
+            self._store(rows, embeddings, analyzed)
+
+    def remove(self, doc_id: str):
+        """Удалить все чанки документа из индекса"""
+        with self._lock:
+            self._delete(doc_id)
+
+    def update_metadata(self, doc_id: str, fields: Dict) -> int:
+        """Дописать поля в метаданные всех чанков документа (без пересчёта эмбеддингов)"""
+        with self._lock:
+            res = self.vect._collection.get(where={"doc_id": doc_id}, include=["metadatas"])
+            if res["ids"]:
+                self.vect._collection.update(
+                    ids=res["ids"], metadatas=[{**meta, **fields} for meta in res["metadatas"]],
+                )
+            if self.lexical is not None:
+                self.lexical.update_metadata(doc_id, fields)
+        return len(res["ids"])
+
+    def clear(self):
+        """Удалить все чанки (например, осиротевшие после удаления реестра документов)"""
+        with self._lock:
+            ids = self.vect._collection.get(include=[])["ids"]
+            for i in range(0, len(ids), BULK_EMBED_BATCH_SIZE):
+                self.vect._collection.delete(ids=ids[i:i + BULK_EMBED_BATCH_SIZE])
+            if self.lexical is not None:
+                self.lexical.clear()
+
+    def rebuild_lexical(self) -> int:
+        """
+        Заполнить лексический индекс чанками из Chroma (при старте: BM25 живёт в памяти);
+        частоты термов берутся из его store, так что лемматизируются только новые чанки.
+        Блокировка берётся на чтение страницы и на вставку готовых частот, но не
+        на лемматизацию: загрузки и удаления идут параллельно со сборкой.
+        Страницы читаются по offset, и удаление посреди сборки сдвигает его — в конце
+        недостающие чанки добираются по id, и уже под блокировкой ставится ready.
+        Возвращает число чанков.
+        """
+        if self.lexical is None:
+            return 0
+        with self._lock:
+            saved = self.lexical.begin_restore()
+        offset = 0
+        while True:
+            with self._lock:
+                res = self.vect._collection.get(
+                    include=["documents", "metadatas"], limit=BULK_EMBED_BATCH_SIZE, offset=offset,
+                )
+            if not res["ids"]:
+                break
+            offset += len(res["ids"])
+            self._restore_rows(res, saved)
+        while True:
+            with self._lock:
+                ids = self.vect._collection.get(include=[])["ids"]
+                missing = set(ids).difference(self.lexical.ids())
+                if not missing:
+                    self.lexical.finish_restore(ids, saved)
+                    return len(self.lexical)
+                res = self.vect._collection.get(ids=list(missing), include=["documents", "metadatas"])
+            self._restore_rows(res, saved)
+
+    def _restore_rows(self, res: Dict, saved: Dict):
+        """Частоты термов чанков страницы — без блокировки, вставка в BM25 — под ней"""
+        rows = list(zip(res["ids"], res["documents"], res["metadatas"]))
+        with span("index.lexical"):
+            analyzed = self.lexical.analyze(rows, saved)
+        with self._lock:
+            # пока шла лемматизация, часть чанков могли удалить — их не воскрешаем
+            alive = set(self.vect._collection.get(ids=[row_id for row_id, _, _ in rows], include=[])["ids"])
+            self.lexical.restore_page([row for row in analyzed if row[0] in alive], saved)
+
+    def reembed(self) -> int:
+        """Пересчитать эмбеддинги всех чанков (после смены модели эмбеддингов)"""
+        count = 0
+        with self._lock:
+            while True:
+                res = self.vect._collection.get(
+                    include=["documents", "metadatas"], limit=BULK_EMBED_BATCH_SIZE, offset=count,
+                )
+                if not res["ids"]:
+                    break
+                self._write(list(zip(res["ids"], res["documents"], res["metadatas"])))
+                count += len(res["ids"])
+        return count
+
+    def get_chunks(self, doc_id: str) -> List[Document]:
+        """Все чанки документа в порядке следования в тексте"""
+        res = self.vect.get(where={"doc_id": doc_id}, include=["documents", "metadatas"])
+        docs = [
+            Document(page_content=text, metadata=meta)
+            for text, meta in zip(res["documents"], res["metadatas"])
+        ]
+        return sorted(docs, key=lambda d: d.metadata.get("chunk", 0))
+
+    def __len__(self) -> int:
+        return self.vect._collection.count()
@@ -0,0 +1,122 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+
+class QueueFullError(Exception):
+    """Очередь генераций заполнена — запрос нужно отклонить сразу"""
+
+
+class InferenceExecutor:
+    """
+    Выделенный пул для генераций LLM, чтобы llama.cpp не блокировал event loop.
+    max_workers — сколько генераций идёт одновременно,
+    max_queue — сколько запросов может ждать своей очереди;
+    сверх этого run() сразу бросает QueueFullError.
+    max_batch — сколько пакетных задач (execute, /evaluate) одновременно
+    в пуле; остальные ждут в своих потоках, не занимая очередь интерактивных
+    запросов и не вытесняя их из пула.
+    """
+
+    def __init__(self, max_workers: int = 1, max_queue: int = 8, max_batch: int = 1):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.max_batch = max(1, max_batch)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm")
+        self._batch_slots = threading.BoundedSemaphore(self.max_batch)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._batch = 0      # пакетных задач в пуле (в очереди или в работе)
+        self._stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "completed": 0,
+            "failed": 0,
+            "cancelled": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "run_seconds_total": 0.0,
+        }
+
+    def _execute(self, enqueued_at: float, fn: Callable, *args, **kwargs) -> Any:
+        started = time.perf_counter()
+        wait = started - enqueued_at
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._stats["wait_seconds_total"] += wait
+            self._stats["wait_seconds_max"] = max(self._stats["wait_seconds_max"], wait)
+        ok = False
+        try:
+            result = fn(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._stats["completed" if ok else "failed"] += 1
+                self._stats["run_seconds_total"] += time.perf_counter() - started
+
+    def _reserve(self):
+        with self._lock:
+            # пакетные задачи в лимит интерактивных не входят: у них своя доля max_batch
+            if self._queued + self._running - self._batch >= self.max_workers + self.max_queue:
+                self._stats["rejected"] += 1
+                raise QueueFullError("Очередь генераций заполнена")
+            self._queued += 1
+            self._stats["submitted"] += 1
+
+    def _cancelled(self, future: Future):
+        # задача отменена, пока ждала в очереди (клиент ушёл, таймаут): _execute
+        # не запустится — место в очереди освобождается здесь
+        if future.cancelled():
+            with self._lock:
+                self._queued -= 1
+                self._stats["cancelled"] += 1
+
+    def submit(self, fn: Callable, *args, **kwargs) -> "asyncio.Future":
+        """Поставить fn в очередь (QueueFullError — сразу, до ожидания); вернуть future"""
+        self._reserve()
+        future = self._pool.submit(self._execute, time.perf_counter(), fn, *args, **kwargs)
+        future.add_done_callback(self._cancelled)
+        return asyncio.wrap_future(future)
+
+    def execute(self, fn: Callable, *args, **kwargs) -> Any:
+        """
+        Синхронно выполнить fn в пуле генераций (для пакетных задач из рабочих потоков):
+        ждёт свободный слот без отказа; в пуле одновременно не больше max_batch
+        пакетных задач, так что интерактивные запросы не получают 503 из-за прогона.
+        """
+        with self._batch_slots:
+            with self._lock:
+                self._queued += 1
+                self._batch += 1
+                self._stats["submitted"] += 1
+            try:
+                return self._pool.submit(self._execute, time.perf_counter(), fn, *args, **kwargs).result()
+            finally:
+                with self._lock:
+                    self._batch -= 1
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """Выполнить fn в пуле генераций, не блокируя event loop"""
+        return await self.submit(fn, *args, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        """Глубина очереди, число активных генераций и время ожидания"""
+        with self._lock:
+            st = dict(self._stats)
+            started = st["completed"] + st["failed"] + self._running
+            st.update({
+                "queue_depth": self._queued,
+                "running": self._running,
+                "batch": self._batch,
+                "max_batch": self.max_batch,
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "wait_seconds_avg": st["wait_seconds_total"] / started if started else 0.0,
+            })
+        return st
@@ -0,0 +1,282 @@
+"""
+Загрузка документов в индекс: одиночная (/upload), пакетная (/upload/bulk) и из CLI:
+    python -m app.ingest PATH [PATH ...] [--workers N] [--batch N] [--json out.json] [--trust LEVEL]
+PATH — файл или каталог (рекурсивно, PDF/DOCX/TXT).
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, UploadFile
+
+from app.cache import content_key
+from app.chunking import split_stream
+from app.index import DEFAULT_TRUST, TRUST_LEVELS
+from app.metrics import span
+from app.document_loader import (
+    MAX_UPLOAD_BYTES, PARSE_CACHE, STREAM_THRESHOLD_BYTES, SUPPORTED_EXTENSIONS,
+    DocumentStream, check_upload_size, extract_text, parse_document, render_text, upload_size,
+)
+
+BULK_WORKERS = int(os.getenv("BULK_WORKERS", str(os.cpu_count() or 1)))   # процессов разбора
+CRASHED_ERROR = "Процесс разбора аварийно завершился (повреждённый файл или нехватка памяти)"
+
+# Пулы процессов разбора переиспользуются между запросами (старт spawn-процесса дорогой)
+_POOLS: Dict[int, ProcessPoolExecutor] = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def ingest_upload(index, doc_id: str, file: UploadFile, metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Загрузка файла в индекс.
+    Небольшие файлы разбираются целиком (с кэшем по содержимому), крупнее
+    STREAM_THRESHOLD_BYTES — потоково: страницы/абзацы сразу идут в нарезку
+    и эмбеддинг батчами, полный текст в памяти не собирается.
+    metadata — дополнительные метаданные чанков (например, trust).
+    Возвращает {"size": символов текста, "chunks": число чанков, "streamed": bool}.
+    """
+    size = upload_size(file)
+    check_upload_size(size)
+    meta = {**(metadata or {}), "filename": file.filename or ""}
+    if size <= STREAM_THRESHOLD_BYTES:
+        with span("upload.parse"):
+            raw_text = extract_text(file)
+        chunks = index.add(doc_id, raw_text, meta)
+        return {"size": len(raw_text), "chunks": chunks, "streamed": False}
+
+    ext = (file.filename or '').rsplit('.', 1)[-1].lower()
+    file.file.seek(0)
+    stream = DocumentStream(ext, file.file)
+    chunks = index.add_chunks(doc_id, split_stream(stream), meta)
+    return {"size": stream.chars, "chunks": chunks, "streamed": True}
+
+
+def _parse_pool(workers: int) -> ProcessPoolExecutor:
+    with _POOLS_LOCK:
+        pool = _POOLS.get(workers)
+        if pool is None:
+            # spawn: без fork процесса с потоками Chroma/llama.cpp (и так же, как на Windows)
+            pool = _POOLS[workers] = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+            )
+        return pool
+
+
+def _drop_pool(workers: int, pool: ProcessPoolExecutor):
+    """Убрать сломанный пул (упал процесс): следующий _parse_pool создаст новый"""
+    with _POOLS_LOCK:
+        if _POOLS.get(workers) is pool:
+            del _POOLS[workers]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _submit(workers: int, ext: str, content: bytes):
+    """Отправить разбор в пул; пул, сломавшийся между запросами, пересоздаётся"""
+    pool = _parse_pool(workers)
+    try:
+        return pool, pool.submit(_parse_job, ext, content)
+    except BrokenProcessPool:
+        _drop_pool(workers, pool)
+        pool = _parse_pool(workers)
+        return pool, pool.submit(_parse_job, ext, content)
+
+
+def _parse_parallel(jobs: List[Tuple[str, bytes]], workers: int) -> List[Tuple[Optional[Dict[str, Any]], Optional[str]]]:
+    """
+    Разбор в пуле процессов. Если процесс пула умер (парсер упал на файле,
+    OOM killer), пул пересоздаётся, а затронутые файлы разбираются заново
+    по одному — ошибку получает только тот файл, на котором процесс падает снова.
+    """
+    results: List[Any] = [None] * len(jobs)
+    crashed = []
+    submitted = [_submit(workers, ext, content) for ext, content in jobs]
+    for i, (pool, future) in enumerate(submitted):
+        try:
+            results[i] = future.result()
+        except (BrokenProcessPool, CancelledError):
+            _drop_pool(workers, pool)
+            crashed.append(i)
+    for i in crashed:
+        pool, future = _submit(workers, *jobs[i])
+        try:
+            results[i] = future.result()
+        except (BrokenProcessPool, CancelledError):
+            _drop_pool(workers, pool)
+            results[i] = (None, CRASHED_ERROR)
+    return results
+
+
+def _parse_job(ext: str, content: bytes) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """Разбор в процессе пула: ошибка возвращается строкой (HTTPException плохо пиклится)"""
+    try:
+        return parse_document(ext, content), None
+    except HTTPException as e:
+        return None, str(e.detail)
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def _check_item(filename: str, content: bytes) -> Optional[str]:
+    ext = filename.rsplit('.', 1)[-1].lower()
+    if ext not in SUPPORTED_EXTENSIONS:
+        return "Unsupported file type"
+    if not content:
+        return "File is empty"
+    if len(content) > MAX_UPLOAD_BYTES:
+        return f"Файл больше {MAX_UPLOAD_BYTES // 2**20} МБ"
+    return None
+
+
+def parse_many(items: List[Tuple[str, bytes]], workers: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Разбор пачки файлов [(имя, содержимое), ...] теми же обработчиками, что extract_text.
+    Уже разобранные (PARSE_CACHE) не парсятся, одинаковое содержимое — один раз;
+    остальное — параллельно в пуле процессов.
+    Возвращает по каждому файлу {"parsed", "error", "cached"}.
+    """
+    workers = workers or BULK_WORKERS
+    out: List[Dict[str, Any]] = []
+    pending: Dict[str, Tuple[str, bytes]] = {}
+    for filename, content in items:
+        error = _check_item(filename, content)
+        if error:
+            out.append({"parsed": None, "error": error, "cached": False})
+            continue
+        ext = filename.rsplit('.', 1)[-1].lower()
+        key = content_key(content, ext)
+        parsed = PARSE_CACHE.get(key)
+        out.append({"parsed": parsed, "error": None, "cached": parsed is not None, "_key": key})
+        if parsed is None:
+            pending[key] = (ext, content)
+
+    if pending:
+        keys = list(pending)
+        exts = [pending[k][0] for k in keys]
+        contents = [pending[k][1] for k in keys]
+        if workers > 1 and len(keys) > 1:
+            results = _parse_parallel(list(zip(exts, contents)), workers)
+        else:
+            results = [_parse_job(ext, content) for ext, content in zip(exts, contents)]
+        done = dict(zip(keys, results))
+        for key, (parsed, error) in done.items():
+            if parsed is not None:
+                PARSE_CACHE.put(key, parsed)
+        for item in out:
+            key = item.pop("_key", None)
+            if key in done:
+                item["parsed"], item["error"] = done[key]
+    for item in out:
+        item.pop("_key", None)
+    return out
+
+
+def ingest_many(index, items: List[Tuple[str, bytes]], workers: Optional[int] = None,
+                metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Пакетная загрузка: разбор в пуле процессов, эмбеддинг всех чанков общими
+    батчами и одна запись в индекс. metadata — общие для всех файлов
+    метаданные чанков (например, trust). Возвращает поля BulkUploadOut.
+    """
+    started = time.perf_counter()
+    with span("bulk.parse"):
+        parsed = parse_many(items, workers)
+    results, docs = [], []
+    for (filename, _), item in zip(items, parsed):
+        row = {"filename": filename, "doc_id": None, "size": 0, "chunks": 0,
+               "cached": item["cached"], "error": item["error"]}
+        results.append(row)
+        if item["parsed"] is None:
+            continue
+        text = render_text(item["parsed"])
+        row.update({"doc_id": str(uuid.uuid4()), "size": len(text)})
+        docs.append((row, text))
+
+    counts = index.add_many([
+        (row["doc_id"], text, {**(metadata or {}), "filename": row["filename"]}) for row, text in docs
+    ])
+    for (row, _), count in zip(docs, counts):
+        row["chunks"] = count
+
+    seconds = time.perf_counter() - started
+    return {
+        "results": results,
+        "documents": len(docs),
+        "failed": len(results) - len(docs),
+        "chunks": sum(counts),
+        "seconds": round(seconds, 3),
+        "docs_per_sec": round(len(docs) / seconds, 2) if seconds > 0 else 0.0,
+    }
+
+
+def collect_paths(paths: List[str]) -> List[str]:
+    """Файлы поддерживаемых форматов из списка файлов/каталогов"""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                found.extend(
+                    os.path.join(root, name) for name in sorted(names)
+                    if name.rsplit('.', 1)[-1].lower() in SUPPORTED_EXTENSIONS
+                )
+        else:
+            found.append(path)
+    return found
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Пакетная загрузка документов в индекс RAG")
+    parser.add_argument("paths", nargs="+", help="файлы или каталоги (PDF/DOCX/TXT)")
+    parser.add_argument("--workers", type=int, default=BULK_WORKERS, help="процессов разбора")
+    parser.add_argument("--batch", type=int, default=256, help="файлов в одной записи в индекс")
+    parser.add_argument("--json", dest="json_path", help="сохранить результаты по файлам в JSON")
+    parser.add_argument("--trust", choices=TRUST_LEVELS, default=DEFAULT_TRUST, help="уровень доверия документов")
+    args = parser.parse_args(argv)
+
+    from app import main as app_main
+    app_main.startup_event()
+    index = app_main.app.state.rag['index']
+
+    paths = collect_paths(args.paths)
+    started = time.perf_counter()
+    results = []
+    for i in range(0, len(paths), max(1, args.batch)):
+        items = []
+        for path in paths[i:i + max(1, args.batch)]:
+            with open(path, "rb") as f:
+                items.append((os.path.basename(path), f.read()))
+        uploaded_at = time.time()
+        out = ingest_many(index, items, args.workers, {"trust": args.trust, "uploaded_at": uploaded_at})
+        for path, row in zip(paths[i:], out["results"]):
+            row["path"] = path
+            if row["doc_id"]:
+                app_main.register_doc(row["doc_id"], row["filename"], row["size"], {"trust": args.trust}, uploaded_at)
+            else:
+                print(f"{path}: {row['error']}", file=sys.stderr)
+        results.extend(out["results"])
+
+    seconds = time.perf_counter() - started
+    ok = sum(1 for row in results if row["doc_id"])
+    summary = {
+        "documents": ok,
+        "failed": len(results) - ok,
+        "chunks": sum(row["chunks"] for row in results),
+        "seconds": round(seconds, 3),
+        "docs_per_sec": round(ok / seconds, 2) if seconds > 0 else 0.0,
+    }
+    print(json.dumps(summary, ensure_ascii=False))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"results": results, "summary": summary}, f, ensure_ascii=False, indent=2)
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
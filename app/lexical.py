@@ -0,0 +1,292 @@
+import heapq
+import math
+import os
+import re
+import threading
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = int(os.getenv("RRF_K", "60"))   # сглаживание reciprocal rank fusion
+_WORD = re.compile(r"\w+")
+_CYRILLIC = re.compile(r"[а-яё]")
+_LEMMA_CACHE_SIZE = 200_000
+
+
+class Lemmatizer:
+    """
+    Лемматизация словоформ моделями spaCy (ru_core_news_sm / en_core_web_sm):
+    язык слова — по наличию кириллицы. Леммы запоминаются по словоформе,
+    так что spaCy работает только на новых словах, а повторные запросы
+    не трогают модель вовсе. Если spaCy или модели нет — слова остаются как есть.
+    """
+
+    def __init__(self, loaders: Dict[str, Callable[[], Any]]):
+        self._loaders = loaders
+        self._models: Dict[str, Any] = {}
+        self._cache: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def _model(self, lang: str):
+        if lang not in self._models:
+            try:
+                self._models[lang] = self._loaders[lang]()
+            except (ImportError, OSError, KeyError):
+                # spaCy не установлен или модель не скачана — без лемматизации
+                self._models[lang] = None
+        return self._models[lang]
+
+    def lemmas(self, words: Iterable[str]) -> Dict[str, str]:
+        """Словоформа (в нижнем регистре) -> лемма"""
+        words = set(words)
+        out = {w: self._cache[w] for w in words if w in self._cache}
+        missing = [w for w in words if w not in out]
+        if not missing:
+            return out
+        with self._lock:
+            by_lang: Dict[str, List[str]] = {}
+            for w in missing:
+                by_lang.setdefault("ru" if _CYRILLIC.search(w) else "en", []).append(w)
+            for lang, forms in by_lang.items():
+                nlp = self._model(lang)
+                if nlp is None:
+                    found = {w: w for w in forms}
+                else:
+                    found = {
+                        w: (doc[0].lemma_.lower() or w) if len(doc) == 1 else w
+                        for w, doc in zip(forms, nlp.pipe(forms, disable=["parser", "ner"]))
+                    }
+                out.update(found)
+                if len(self._cache) < _LEMMA_CACHE_SIZE:
+                    self._cache.update(found)
+        return out
+
+    def terms(self, text: str) -> List[str]:
+        """Термы текста: леммы слов, идентификаторы (secret_key) — ещё и по частям"""
+        words = _WORD.findall(text.lower())
+        lemmas = self.lemmas(words)
+        terms = []
+        for w in words:
+            terms.append(lemmas[w])
+            if "_" in w:
+                terms.extend(part for part in w.split("_") if len(part) > 1)
+        return terms
+
+
+def matches(meta: Dict[str, Any], where: Optional[Dict[str, Any]]) -> bool:
+    """Проверка метаданных чанка тем же where, что уходит в Chroma ($and, $in, $gte, $lte, равенство)"""
+    if not where:
+        return True
+    if "$and" in where:
+        return all(matches(meta, clause) for clause in where["$and"])
+    for key, cond in where.items():
+        value = meta.get(key)
+        if not isinstance(cond, dict):
+            cond = {"$eq": cond}
+        for op, arg in cond.items():
+            if op == "$eq" and value != arg:
+                return False
+            if op == "$in" and value not in arg:
+                return False
+            if op == "$gte" and (value is None or value < arg):
+                return False
+            if op == "$lte" and (value is None or value > arg):
+                return False
+    return True
+
+
+class BM25Index:
+    """
+    Лексический индекс BM25 по леммам чанков — рядом с Chroma, с теми же
+    id чанков ("doc_id:номер") и метаданными. Обновляется инкрементально
+    вместе с векторным индексом (DocumentIndex) и живёт в памяти.
+    store: DocumentStore — частоты термов чанков сохраняются в нём, и при
+    старте индекс собирается из текстов Chroma и сохранённых частот без
+    лемматизации (spaCy работает только на чанках, которых в store нет).
+    ready — индекс собран (DocumentIndex.rebuild_lexical); до этого retrieval
+    обходится векторами.
+    Поиск по ключевым словам не вызывает эмбеддер.
+    """
+
+    def __init__(self, lemmatizer: Lemmatizer, store=None):
+        self.lemmatizer = lemmatizer
+        self.store = store
+        self._postings: Dict[str, Dict[str, int]] = {}        # терм -> {id чанка: tf}
+        # id -> (текст, метаданные, длина, термы)
+        self._chunks: Dict[str, Tuple[str, Dict[str, Any], int, Tuple[str, ...]]] = {}
+        self._by_doc: Dict[str, set] = {}
+        self._total_len = 0
+        self._lock = threading.Lock()
+        self.ready = threading.Event()
+
+    def analyze(self, rows: List[Tuple[str, str, Dict[str, Any]]],
+                saved: Optional[Dict[str, Counter]] = None) -> List[Tuple[str, str, Dict[str, Any], Counter]]:
+        """
+        Частоты термов чанков [(id, текст, метаданные, Counter), ...] — без блокировок
+        и записи в store. Лемматизация — самая долгая часть добавления, поэтому
+        DocumentIndex считает её до того, как взять свою блокировку.
+        saved — уже сохранённые частоты (begin_restore): для этих чанков spaCy не нужен.
+        """
+        saved = saved or {}
+        analyzed = []
+        for chunk_id, text, meta in rows:
+            tf = saved.get(chunk_id)
+            analyzed.append((chunk_id, text, meta, Counter(self.lemmatizer.terms(text)) if tf is None else tf))
+        return analyzed
+
+    def add(self, rows: List[Tuple[str, str, Dict[str, Any]]]):
+        """Добавить/заменить чанки [(id, текст, метаданные), ...]"""
+        self.add_analyzed(self.analyze(rows))
+
+    def add_analyzed(self, analyzed: List[Tuple[str, str, Dict[str, Any], Counter]]):
+        """Добавить/заменить чанки с готовыми частотами (analyze) и сохранить частоты в store"""
+        self._save(analyzed)
+        self._insert(analyzed)
+
+    def _save(self, analyzed: List[Tuple[str, str, Dict[str, Any], Counter]]):
+        if self.store is not None and analyzed:
+            self.store.save_terms([(chunk_id, meta.get("doc_id"), tf) for chunk_id, _, meta, tf in analyzed])
+
+    def begin_restore(self) -> Dict[str, Counter]:
+        """
+        Начать сборку индекса заново из чанков Chroma (DocumentIndex.rebuild_lexical):
+        ready сбрасывается, индекс очищается. Возвращает сохранённые частоты термов
+        (id чанка -> Counter) — их получает analyze(rows, saved).
+        """
+        self.ready.clear()
+        saved = self.store.load_terms() if self.store is not None else {}
+        self._reset()
+        return saved
+
+    def restore_page(self, analyzed: List[Tuple[str, str, Dict[str, Any], Counter]], saved: Dict[str, Counter]):
+        """
+        Вставить восстановленные чанки. Чанки, которые уже в индексе, пропускаются:
+        их записала загрузка, шедшая параллельно со сборкой, и её версия новее.
+        Частоты чанков, лемматизированных заново, сохраняются в store.
+        """
+        with self._lock:
+            fresh = [row for row in analyzed if row[0] not in self._chunks]
+        self._save([row for row in fresh if row[0] not in saved])
+        self._insert(fresh)
+
+    def finish_restore(self, chunk_ids: Iterable[str], saved: Dict[str, Counter]):
+        """Сборка закончена: chunk_ids — все чанки Chroma, сохранённые частоты остальных удаляются"""
+        stale = set(saved).difference(chunk_ids)
+        if stale and self.store is not None:
+            self.store.remove_terms(chunk_ids=list(stale))
+        self.ready.set()
+
+    def ids(self) -> set:
+        with self._lock:
+            return set(self._chunks)
+
+    def _insert(self, analyzed: List[Tuple[str, str, Dict[str, Any], Counter]]):
+        with self._lock:
+            for chunk_id, text, meta, tf in analyzed:
+                self._drop(chunk_id)
+                length = sum(tf.values())
+                self._chunks[chunk_id] = (text, meta, length, tuple(tf))
+                self._by_doc.setdefault(meta.get("doc_id"), set()).add(chunk_id)
+                self._total_len += length
+                for term, n in tf.items():
+                    self._postings.setdefault(term, {})[chunk_id] = n
+
+    def _drop(self, chunk_id: str):
+        old = self._chunks.pop(chunk_id, None)
+        if old is None:
+            return
+        _, meta, length, terms = old
+        self._total_len -= length
+        self._by_doc.get(meta.get("doc_id"), set()).discard(chunk_id)
+        for term in terms:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(chunk_id, None)
+                if not postings:
+                    del self._postings[term]
+
+    def remove(self, doc_id: str):
+        with self._lock:
+            for chunk_id in list(self._by_doc.pop(doc_id, ())):
+                self._drop(chunk_id)
+        if self.store is not None:
+            self.store.remove_terms(doc_ids=[doc_id])
+
+    def update_metadata(self, doc_id: str, fields: Dict[str, Any]):
+        with self._lock:
+            for chunk_id in self._by_doc.get(doc_id, ()):
+                text, meta, length, terms = self._chunks[chunk_id]
+                self._chunks[chunk_id] = (text, {**meta, **fields}, length, terms)
+
+    def clear(self):
+        self._reset()
+        if self.store is not None:
+            self.store.remove_terms()
+
+    def _reset(self):
+        with self._lock:
+            self._postings.clear()
+            self._chunks.clear()
+            self._by_doc.clear()
+            self._total_len = 0
+
+    def search(self, query: str, k: int, where: Optional[Dict[str, Any]] = None) -> List[Tuple[Document, float]]:
+        """Топ-k чанков по BM25 среди подходящих под where: [(Document, score), ...]"""
+        terms = set(self.lemmatizer.terms(query))
+        scores: Dict[str, float] = {}
+        with self._lock:
+            n = len(self._chunks)
+            if not n:
+                return []
+            avg_len = self._total_len / n or 1.0
+            allowed: Dict[str, bool] = {}
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for chunk_id, tf in postings.items():
+                    ok = allowed.get(chunk_id)
+                    if ok is None:
+                        ok = allowed[chunk_id] = matches(self._chunks[chunk_id][1], where)
+                    if not ok:
+                        continue
+                    length = self._chunks[chunk_id][2]
+                    norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_len)
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+            top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+            return [
+                (Document(page_content=self._chunks[cid][0], metadata=dict(self._chunks[cid][1])), score)
+                for cid, score in top
+            ]
+
+    def __len__(self) -> int:
+        return len(self._chunks)
+
+
+def chunk_key(doc: Document) -> str:
+    return f"{doc.metadata.get('doc_id')}:{doc.metadata.get('chunk')}"
+
+
+def reciprocal_rank_fusion(rankings: List[List[Document]], k: int = RRF_K) -> List[Document]:
+    """
+    Слияние ранжированных списков (векторный, BM25): score = Σ 1 / (k + ранг).
+    Метаданные одного чанка из разных списков объединяются (distance, bm25).
+    """
+    scores: Dict[str, float] = {}
+    docs: Dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            key = chunk_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+            if key in docs:
+                docs[key].metadata.update(doc.metadata)
+            else:
+                docs[key] = doc
+    fused = sorted(scores, key=scores.get, reverse=True)
+    for key in fused:
+        docs[key].metadata["rrf"] = round(scores[key], 6)
+    return [docs[key] for key in fused]
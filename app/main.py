@@ -1,104 +1,268 @@
 # app/main.py
 
 import os
-import glob
+import re
 import json
 import uuid
+import time
+import asyncio
+import threading
+from typing import List
 
-from fastapi import FastAPI, HTTPException, Request, UploadFile, File
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Form, HTTPException, Request, UploadFile, File
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from langchain_core.documents import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from starlette.concurrency import run_in_threadpool
 
-from app.models import QueryOut, UploadOut
-from app.document_loader import extract_text
-from app.security import filter_prompt, sanitize_answer, sanity_check, isolate_context
+from app.models import QueryOut, UploadOut, BulkUploadOut
+from app.cache import ResponseCache
+from app.document_loader import PARSE_CACHE, MAX_UPLOAD_BYTES, MAX_BULK_UPLOAD_BYTES, TEXT_BLOCK_SIZE
+from app.index import DEFAULT_TRUST, TRUST_LEVELS
+from app.ingest import ingest_upload, ingest_many
+from app.security import SANITIZER, StreamSanitizer
+from app.redaction import Rule, check_untrusted
+from app.pipeline import prepare_query, chain_input, finalize_answer, query_out_fields
 from app.rag import init_app_state
+from app.scenarios import ScenarioCatalog
+from app.store import DocumentStore
+from app.inference import InferenceExecutor, QueueFullError
+from app.defenses import check_defenses
+from app.evaluation import run_evaluation
+from app.generation import LLM_SLOTS, REQUEST_CLASSES, chain_name, llm_name, profile_key
+from app.profiling import RequestProfiler
+from app.metrics import REGISTRY, REQUEST_SECONDS, Gauge, LLMUsage, record_generation, trace, trace_ms
 from app.utils import to_text
 
 # ==== НАСТРОЙКИ ====
 ATTACK_FILES_DIR = "attack_files"
 ATTACK_SCENARIOS_FILE = "attack_scenarios.json"
 TEMPLATES_DIR = "templates"
+LLM_WORKERS = int(os.getenv("LLM_WORKERS", str(LLM_SLOTS)))  # одновременных генераций (по числу слотов LLM)
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", "8"))   # ожидающих в очереди, сверх — 503
+# пакетных генераций (/evaluate) в пуле одновременно — доля, не мешающая /query
+LLM_BATCH_WORKERS = int(os.getenv("LLM_BATCH_WORKERS", str(max(1, LLM_WORKERS // 2))))
+QUERY_DEBUG = os.getenv("QUERY_DEBUG", "0") == "1"       # debug (этапы, токены) в каждом QueryOut
+STREAM_DISCONNECT_POLL = float(os.getenv("STREAM_DISCONNECT_POLL", "1"))   # сек между проверками обрыва /query/stream
+# Кэш ответов LLM: записей (0 — выключен), TTL в секундах и порог косинусной
+# близости prompt для почти-дубликатов (пусто — только точное совпадение)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY") or 0) or None
+# POST /sanitize/rules: правила по HTTP меняют санитизацию всех запросов — по умолчанию выкл.,
+# постоянные правила — через SANITIZE_RULES_FILE
+SANITIZE_RULES_RUNTIME = os.getenv("SANITIZE_RULES_RUNTIME", "0") == "1"
+# Каталог данных: реестр документов (SQLite) и индекс Chroma; "" — всё в памяти
+RAG_DATA_DIR = os.getenv("RAG_DATA_DIR", "data")
 
-app = FastAPI(title="RAG Prompt Injection Demo")
+# Swagger UI — на /api/docs: /docs — список документов для UI (ETag/304)
+app = FastAPI(title="RAG Prompt Injection Demo", docs_url="/api/docs")
 templates = Jinja2Templates(directory=TEMPLATES_DIR)
+# Генерации LLM идут в отдельном пуле, а не в event loop
+INFERENCE = InferenceExecutor(max_workers=LLM_WORKERS, max_queue=LLM_QUEUE_SIZE, max_batch=LLM_BATCH_WORKERS)
+RESPONSE_CACHE = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIMILARITY)
+# имена правил с запуска (встроенные + SANITIZE_RULES_FILE) — по HTTP не заменяются
+BASE_RULE_NAMES = [r.name for r in SANITIZER.rules]
+# Профили медленных / запрошенных запросов (collapsed stacks) — в каталоге данных
+PROFILER = RequestProfiler(os.path.join(RAG_DATA_DIR, "profiles") if RAG_DATA_DIR else "")
 
-# In-memory docs: doc_id -> {"text": ..., "meta": ...}
-DOCS = {}         # doc_id: {"text": str, "meta": dict, "filename": str}
+# Docs: doc_id -> {"size": ..., "meta": ...}; копия реестра STORE в памяти,
+# сам текст живёт чанками в индексе
+DOCS = {}         # doc_id: {"size": int, "meta": dict, "filename": str, "uploaded_at": float}
 DOCS_LIST = []    # list of doc_id for ordering (to preserve upload order)
+# Лимит Content-Length по путям загрузки (проверяется до чтения тела)
+UPLOAD_LIMITS = {"/upload": MAX_UPLOAD_BYTES, "/upload/bulk": MAX_BULK_UPLOAD_BYTES}
+STORE = None      # DocumentStore, открывается в startup_event
+DOCS_VERSION = 0  # растёт при каждой загрузке/удалении — для ETag списка документов
+DOCS_BOOT = uuid.uuid4().hex[:8]
+# Сценарии атак: файлы, описания, разобранный текст и найденные паттерны — в памяти
+CATALOG = ScenarioCatalog(ATTACK_FILES_DIR, ATTACK_SCENARIOS_FILE)
+
+REGISTRY.register(Gauge("rag_inference_queue_depth", "Генерации в очереди", lambda: INFERENCE.stats()["queue_depth"]))
+REGISTRY.register(Gauge("rag_inference_running", "Генерации в работе", lambda: INFERENCE.stats()["running"]))
+REGISTRY.register(Gauge("rag_response_cache_hits", "Ответы из кэша (точные и почти-дубликаты)",
+                        lambda: sum(RESPONSE_CACHE.stats()[k] for k in ("hits", "near_hits"))))
+REGISTRY.register(Gauge("rag_documents", "Загруженные документы", lambda: len(DOCS)))
 
 @app.on_event("startup")
 def startup_event():
-    # Загружаем тестовые встроенные документы (опционально)
-    global DOCS, DOCS_LIST
+    # Открываем сохранённые документы и индекс; встроенные примеры — только в пустую базу
+    global DOCS, DOCS_LIST, STORE
     DOCS.clear()
     DOCS_LIST.clear()
+    STORE = DocumentStore(os.path.join(RAG_DATA_DIR, "documents.sqlite3") if RAG_DATA_DIR else None)
+    for doc_id, info in STORE.all():
+        DOCS[doc_id] = info
+        DOCS_LIST.append(doc_id)
     example_docs = [
         {"text": "secretpersonalmail@local.mail.ru", "meta": {}, "filename": "mail.txt"},
         {"text": "secret_token: tokentokentoken123", "meta": {}, "filename": "token.txt"},
         {"text": "Admin password: 12344321", "meta": {}, "filename": "passwords.txt"},
     ]
-    for doc in example_docs:
-        doc_id = str(uuid.uuid4())
-        DOCS[doc_id] = doc
-        DOCS_LIST.append(doc_id)
-    app.state.rag = init_app_state([doc["text"] for doc in DOCS.values()])
-
-def load_attack_scenarios():
-    """Загрузить описания сценариев атак из attack_scenarios.json"""
-    path = os.path.join(ATTACK_SCENARIOS_FILE)
-    if not os.path.exists(path):
-        return {}
-    with open(path, encoding="utf-8") as f:
-        return json.load(f)
-
-def list_attack_files_with_scenarios():
-    """Вернуть список файлов атак + описание сценария"""
-    scenarios = load_attack_scenarios()
-    files = []
-    for file_path in glob.glob(os.path.join(ATTACK_FILES_DIR, "*")):
-        basename = os.path.basename(file_path)
-        scenario = scenarios.get(basename, {})
-        files.append({
-            "file": basename,
-            "name": scenario.get("name", basename),
-            "scenario": scenario.get("scenario", ""),
-        })
-    return files
+    initial = {}
+    if not DOCS_LIST:
+        uploaded_at = time.time()
+        for doc in example_docs:
+            initial[str(uuid.uuid4())] = {**doc, "uploaded_at": uploaded_at}
+    app.state.rag = init_app_state(
+        initial, STORE, os.path.join(RAG_DATA_DIR, "chroma") if RAG_DATA_DIR else None,
+    )
+    for doc_id, doc in initial.items():
+        register_doc(doc_id, doc["filename"], len(doc["text"]), uploaded_at=doc["uploaded_at"])
+    CATALOG.refresh(force=True)
+
+def default_attack_files():
+    """Файлы атак из attack_scenarios.json, которые есть на диске"""
+    return CATALOG.default_files()
+
+def _etag_response(request: Request, etag: str, payload) -> Response:
+    """JSON с ETag; при совпадении If-None-Match — пустой 304"""
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse(content=payload(), headers={"ETag": etag, "Cache-Control": "no-cache"})
 
 @app.get("/", response_class=HTMLResponse)
 def ui(request: Request):
     return templates.TemplateResponse("ui.html", {"request": request})
 
 @app.get("/attack_files")
-def attack_files():
-    """API для фронта: список доступных атакующих файлов с описанием"""
-    return list_attack_files_with_scenarios()
+def attack_files(request: Request):
+    """API для фронта: файлы атак с описанием, размером и найденными паттернами (ETag/304)"""
+    listing = CATALOG.listing()
+    return _etag_response(request, CATALOG.etag, lambda: listing)
 
 @app.get("/docs")
-def list_docs():
-    """Список загруженных документов"""
+def list_docs(request: Request):
+    """Список загруженных документов (ETag/304)"""
+    return _etag_response(request, f'"docs-{DOCS_BOOT}-{DOCS_VERSION}"', _docs_listing)
+
+def _docs_listing():
     return [
-        {"doc_id": doc_id, "filename": DOCS[doc_id].get("filename", ""), "size": len(DOCS[doc_id]["text"])}
+        {"doc_id": doc_id, "filename": DOCS[doc_id].get("filename", ""), "size": DOCS[doc_id]["size"],
+         "trust": DOCS[doc_id]["meta"].get("trust", DEFAULT_TRUST), "uploaded_at": DOCS[doc_id]["uploaded_at"]}
         for doc_id in DOCS_LIST
     ]
 
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    """Время каждого запроса — в гистограмму rag_request_seconds (по шаблону маршрута)"""
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    REQUEST_SECONDS.observe(
+        time.perf_counter() - start,
+        request.method, getattr(route, "path", "unmatched"), str(response.status_code),
+    )
+    return response
+
+@app.middleware("http")
+async def profile_requests(request: Request, call_next):
+    """
+    Профилирование запроса: X-Profile: 1 или ?profile=1, либо автоматически
+    дольше PROFILE_SLOW_MS. Профиль закрывается после отправки тела ответа
+    (для /query/stream — после последнего события). X-Request-ID — ключ профиля в /profiles.
+    """
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex
+    if not PROFILER.applies(request.url.path):
+        response = await call_next(request)
+        response.headers["X-Request-ID"] = request_id
+        return response
+    requested = request.headers.get("x-profile") == "1" or request.query_params.get("profile") == "1"
+    session = PROFILER.start(request_id, request.method, request.url.path, requested)
+    try:
+        response = await call_next(request)
+    except Exception:
+        await run_in_threadpool(PROFILER.finish, session, 500)
+        raise
+    body = response.body_iterator
+
+    async def _body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            await run_in_threadpool(PROFILER.finish, session, response.status_code)
+
+    response.body_iterator = _body()
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """Отклонить заведомо слишком большую загрузку до чтения тела запроса"""
+    limit = UPLOAD_LIMITS.get(request.url.path)
+    if limit:
+        length = request.headers.get("content-length")
+        if length and length.isdigit() and int(length) > limit:
+            return JSONResponse(status_code=413, content={"detail": f"Загрузка больше {limit // 2**20} МБ"})
+    return await call_next(request)
+
+def register_doc(doc_id: str, filename: str, size: int, meta: dict = None, uploaded_at: float = None):
+    """
+    Запомнить загруженный документ (его чанки уже в индексе); meta — например, {"trust": ...}.
+    uploaded_at — то же время, что записано в метаданные чанков, иначе фильтр
+    uploaded_after по значению из /docs не найдёт сам документ.
+    """
+    DOCS[doc_id] = STORE.add(doc_id, filename, size, meta or {}, uploaded_at)
+    DOCS_LIST.append(doc_id)
+    _docs_changed()
+
+def _docs_changed():
+    global DOCS_VERSION
+    DOCS_VERSION += 1
+    RESPONSE_CACHE.clear()
+
 @app.post("/upload", response_model=UploadOut)
-async def upload_file(file: UploadFile = File(...)):
-    """Загрузка пользовательского файла (PDF/DOCX/TXT) в базу RAG"""
-    raw_text = extract_text(file)
+async def upload_file(file: UploadFile = File(...), trust: str = Form(DEFAULT_TRUST)):
+    """Загрузка пользовательского файла (PDF/DOCX/TXT) в базу RAG; trust — уровень доверия документа"""
+    meta = {"trust": _check_trust(trust)}
     doc_id = str(uuid.uuid4())
-    DOCS[doc_id] = {
-        "text": raw_text,
-        "meta": {},  # meta может быть заполнено extract_text при необходимости
-        "filename": file.filename
-    }
-    DOCS_LIST.append(doc_id)
-    # Обновить RAG базу с новыми документами
-    app.state.rag = init_app_state([DOCS[did]["text"] for did in DOCS_LIST])
-    return UploadOut(doc_id=doc_id, size=len(raw_text))
+    uploaded_at = time.time()
+    # Добавить в индекс только чанки нового документа (крупные файлы — потоково)
+    info = await run_in_threadpool(ingest_upload, app.state.rag['index'], doc_id, file,
+                                   {**meta, "uploaded_at": uploaded_at})
+    register_doc(doc_id, file.filename, info["size"], meta, uploaded_at)
+    return UploadOut(doc_id=doc_id, size=info["size"])
+
+@app.post("/upload/bulk", response_model=BulkUploadOut)
+async def upload_bulk(files: List[UploadFile] = File(...), trust: str = Form(DEFAULT_TRUST)):
+    """
+    Пакетная загрузка многих файлов: разбор в пуле процессов,
+    эмбеддинг общими батчами, одна запись в индекс. Результат — по каждому файлу.
+    """
+    meta = {"trust": _check_trust(trust)}
+    items = await _read_bulk(files)
+    uploaded_at = time.time()
+    out = await run_in_threadpool(ingest_many, app.state.rag['index'], items, None, {**meta, "uploaded_at": uploaded_at})
+    for row in out["results"]:
+        if row["doc_id"]:
+            register_doc(row["doc_id"], row["filename"], row["size"], meta, uploaded_at)
+    return out
+
+async def _read_bulk(files: List[UploadFile]) -> list:
+    """
+    Прочитать файлы пакета [(имя, байты), ...] блоками, считая общий размер:
+    413, как только он превысит MAX_BULK_UPLOAD_BYTES. Middleware проверяет
+    только Content-Length, а при chunked-загрузке его нет.
+    """
+    items, total = [], 0
+    for f in files:
+        blocks = []
+        while True:
+            block = await f.read(TEXT_BLOCK_SIZE)
+            if not block:
+                break
+            total += len(block)
+            if total > MAX_BULK_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail=f"Загрузка больше {MAX_BULK_UPLOAD_BYTES // 2**20} МБ")
+            blocks.append(block)
+        items.append((f.filename or "", b"".join(blocks)))
+    return items
+
+def _check_trust(trust: str) -> str:
+    if trust not in TRUST_LEVELS:
+        raise HTTPException(status_code=400, detail=f"trust должен быть одним из {list(TRUST_LEVELS)}")
+    return trust
 
 @app.delete("/docs/{doc_id}")
 def delete_doc(doc_id: str):
@@ -107,8 +271,10 @@ def delete_doc(doc_id: str):
         raise HTTPException(status_code=404, detail="doc_id не найден")
     del DOCS[doc_id]
     DOCS_LIST.remove(doc_id)
-    # Обновить RAG базу
-    app.state.rag = init_app_state([DOCS[did]["text"] for did in DOCS_LIST])
+    STORE.remove(doc_id)
+    # Убрать из индекса только чанки этого документа
+    app.state.rag['index'].remove(doc_id)
+    _docs_changed()
     return {"status": "deleted"}
 
 @app.post("/query", response_model=QueryOut)
@@ -117,121 +283,297 @@ async def query(q: dict):
     Ожидает:
     {
       "attack_file": "jailbreak.txt" (опционально),
-      "defenses": ["isolation", "filter"],  # список
+      "defenses": ["isolation", "filter"],  # список: isolation, filter, sanitize, semantic
       "prompt": "..."                       # если нет attack_file
       "doc_id": "..." (опционально, строка!)
+      "filters": {                          # опционально, фильтры retrieval по метаданным чанков
+        "doc_ids": [...], "filenames": [...], "trust": ["public", "user"],
+        "uploaded_after": 1700000000.0, "uploaded_before": ...
+      },
+      "retrieval": "hybrid"                 # опционально: hybrid | vector | lexical
     }
     """
     state = app.state.rag
 
-    # 1) Получаем исходный prompt/контекст (атакующий файл или пользовательский ввод)
-    prompt = ""
-    attack_file = q.get("attack_file")
-    if attack_file:
-        path = os.path.join(ATTACK_FILES_DIR, attack_file)
-        if not os.path.exists(path):
-            raise HTTPException(status_code=400, detail="Файл атаки не найден")
-        ext = attack_file.rsplit('.', 1)[-1].lower()
-        if ext in ('txt', 'text'):
-            with open(path, encoding="utf-8") as f:
-                prompt = f.read()
-        elif ext in ('docx', 'pdf'):
-            # Мокаем UploadFile для extract_text
-            from fastapi import UploadFile
-            class DummyUploadFile:
-                def __init__(self, filename, content):
-                    self.filename = filename
-                    from io import BytesIO
-                    self.file = BytesIO(content)
-            with open(path, "rb") as f:
-                content = f.read()
-                upload = DummyUploadFile(attack_file, content)
-                prompt = extract_text(upload)
-        else:
-            raise HTTPException(status_code=415, detail="Unsupported attack file type")
-    else:
-        prompt = q.get("prompt", "").strip()
-        if not prompt:
-            raise HTTPException(status_code=400, detail="Пустой prompt")
-
-    # 2) Определяем документ/корпус для поиска
-    doc_id = q.get("doc_id")
-    if doc_id:
-        if doc_id not in DOCS:
-            raise HTTPException(status_code=404, detail="doc_id не найден")
-        doc = DOCS[doc_id]
-        raw = [Document(page_content=doc["text"], metadata={"id": doc_id, "filename": doc.get("filename", "")})]
-    else:
-        # Поиск по всей базе (RAG retrieval)
-        raw = state['retriever'].invoke(prompt)
-        # ВНИМАНИЕ: здесь контекст может содержать вредоносные вставки из документов
-
-    # 3) Обработка контекста после retrieval: применяем защиты ПОСЛЕ векторизации
-    defenses = q.get("defenses", [])
-    raw_context = "\n\n".join(d.page_content for d in raw)
-
-    # Для отчёта: что было удалено/заменено в процессе защиты
-    isolated_context = None
-    context_chunks = []
-    for d in raw:
-        ctx = d.page_content
-        orig_ctx = ctx
-        if "isolation" in defenses:
-            ctx = isolate_context(ctx)
-        if "filter" in defenses:
-            ctx, exact, fuzzy = filter_prompt(ctx)
-        else:
-            exact, fuzzy = [], []
-        if "sanitize" in defenses:
-            ctx = sanitize_answer(ctx)
-        context_chunks.append(ctx)
-    final_context = "\n\n".join(context_chunks)
-    if "isolation" in defenses:
-        isolated_context = final_context
-
-    # 4) Чанкинг для LLM (как и раньше)
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=2000,
-        chunk_overlap=200
-    )
-    chunks = splitter.split_text(final_context)
-    selected = chunks[-3:]
-    selected_docs = [Document(page_content=c, metadata={}) for c in selected]
-
-    # 5) Составляем финальный prompt для LLM
-    prompt_used = prompt
-
-    # 6) Генерируем ответ
-    resp = state['chain'].invoke({'input': prompt_used, 'context': selected_docs})
-    answer_raw = to_text(resp)
-
-    # 7) Последовательно применяем фильтры/санитизацию к ответу (как safety net)
-    answer_sanitized = None
-    answer_filtered = None
-    exact, fuzzy = [], []
-
-    filtered = answer_raw
-    if "filter" in defenses:
-        filtered, exact, fuzzy = filter_prompt(filtered)
-    if "sanitize" in defenses:
-        filtered = sanitize_answer(filtered)
-        answer_sanitized = filtered
-    answer_filtered = filtered if "filter" in defenses else None
-
-    flags = sanity_check(answer_filtered or answer_sanitized or answer_raw)
-
-    return QueryOut(
-        raw_context=raw_context,
-        isolated_context=isolated_context,
-        prompt_used=prompt_used,
-        answer_raw=answer_raw,
-        answer_filtered=answer_filtered,
-        answer_sanitized=answer_sanitized,
-        flags=flags,
-        found_exact=exact,
-        found_fuzzy=fuzzy,
+    with trace() as stages:
+        # 1-3) prompt, retrieval и защиты контекста (в пуле потоков, не в event loop)
+        prepared = await run_in_threadpool(prepare_query, state, q, DOCS, ATTACK_FILES_DIR, CATALOG)
+
+        # 4) Генерируем ответ (в пуле генераций; при переполненной очереди — сразу 503),
+        #    если такой же prompt с тем же контекстом ещё не отвечен
+        answer_raw = await run_in_threadpool(_cached_answer, state, prepared, "query")
+        cached = answer_raw is not None
+        tokens = {}
+        if not cached:
+            usage = LLMUsage()
+            def _generate():
+                start = time.perf_counter()
+                resp = state['models'].get(chain_name("query")).invoke(chain_input(prepared), config={"callbacks": [usage]})
+                seconds = time.perf_counter() - start
+                return resp, seconds, record_generation(state['models'].get(llm_name("query")), usage, seconds)
+            try:
+                resp, gen_seconds, tokens = await INFERENCE.run(_generate)
+            except QueueFullError:
+                raise _queue_full()
+            stages["generate"] = gen_seconds
+            answer_raw = to_text(resp)
+            await run_in_threadpool(_remember_answer, state, prepared, answer_raw, "query")
+
+        # 5) Фильтры/санитизация ответа и sanity-check
+        answer = finalize_answer(answer_raw, prepared["defenses"])
+    debug = {"stages_ms": trace_ms(stages), **tokens, "context": prepared["context_budget"]} if q.get("debug") or QUERY_DEBUG else None
+    return QueryOut(**query_out_fields(prepared, answer), debug=debug, cached=cached)
+
+def _embed_prompt(state):
+    return state['index'].embedder.embed_query
+
+def _cached_answer(state, prepared, request_class: str):
+    """Сырой ответ LLM из кэша ответов (защиты ответа применяются к нему заново)"""
+    return RESPONSE_CACHE.get(prepared["prompt_used"], prepared["selected_docs"], _embed_prompt(state),
+                              profile_key(request_class))
+
+def _remember_answer(state, prepared, answer_raw: str, request_class: str):
+    RESPONSE_CACHE.put(prepared["prompt_used"], prepared["selected_docs"], answer_raw, _embed_prompt(state),
+                       profile_key(request_class))
+
+def _queue_full() -> HTTPException:
+    return HTTPException(status_code=503, detail="Сервер занят: очередь генераций заполнена",
+                         headers={"Retry-After": "1"})
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+class _ReleasingStream(StreamingResponse):
+    """
+    StreamingResponse, который вызывает release() при любом завершении отправки:
+    штатном, обрыве соединения или отмене. finally генератора событий тут не
+    годится — если клиент ушёл до первого события, генератор не запускается.
+    """
+
+    def __init__(self, content, release, **kwargs):
+        super().__init__(content, **kwargs)
+        self._release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self._release()
+
+@app.post("/query/stream")
+async def query_stream(q: dict, request: Request):
+    """
+    Потоковый вариант /query (Server-Sent Events), тело запроса то же.
+    event: token — очередной фрагмент ответа (filter/sanitize применяются на лету);
+    event: done  — итоговый QueryOut (flags, found_exact, found_fuzzy и т.д.);
+    event: error — ошибка генерации.
+    """
+    state = app.state.rag
+    with trace() as stages:
+        prepared = await run_in_threadpool(prepare_query, state, q, DOCS, ATTACK_FILES_DIR, CATALOG)
+        answer_cached = await run_in_threadpool(_cached_answer, state, prepared, "stream")
+    if answer_cached is not None:
+        return StreamingResponse(_cached_events(q, prepared, stages, answer_cached), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    loop = asyncio.get_running_loop()
+    tokens: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+    usage = LLMUsage()
+
+    def _stream():
+        start = time.perf_counter()
+        try:
+            for chunk in state['models'].get(chain_name("stream")).stream(chain_input(prepared), config={"callbacks": [usage]}):
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(tokens.put_nowait, to_text(chunk))
+        finally:
+            loop.call_soon_threadsafe(tokens.put_nowait, None)
+        seconds = time.perf_counter() - start
+        return seconds, record_generation(state['models'].get(llm_name("stream")), usage, seconds)
+
+    try:
+        generation = INFERENCE.submit(_stream)
+    except QueueFullError:
+        raise _queue_full()
+
+    def _release():
+        # клиент отключился — освобождаем слот генерации: идущая генерация
+        # останавливается на следующем токене, ждущая в очереди — снимается
+        stop.set()
+        if not generation.done():
+            generation.cancel()
+
+    async def events():
+        sanitizer = StreamSanitizer(prepared["defenses"])
+        parts = []
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(tokens.get(), STREAM_DISCONNECT_POLL)
+                except asyncio.TimeoutError:
+                    # пока генерация ждёт в очереди, клиенту ничего не пишется,
+                    # и обрыв соединения иначе не заметить
+                    if await request.is_disconnected():
+                        return
+                    continue
+                if chunk is None:
+                    break
+                parts.append(chunk)
+                safe = sanitizer.feed(chunk)
+                if safe:
+                    yield _sse("token", {"text": safe})
+            tail = sanitizer.flush()
+            if tail:
+                yield _sse("token", {"text": tail})
+            try:
+                gen_seconds, gen_tokens = await generation
+            except Exception as e:
+                yield _sse("error", {"detail": str(e)})
+                return
+            answer_raw = "".join(parts)
+            await run_in_threadpool(_remember_answer, state, prepared, answer_raw, "stream")
+            with trace() as post:
+                answer = finalize_answer(answer_raw, prepared["defenses"])
+            debug = None
+            if q.get("debug") or QUERY_DEBUG:
+                debug = {"stages_ms": trace_ms({**stages, "generate": gen_seconds, **post}), **gen_tokens,
+                         "context": prepared["context_budget"]}
+            out = QueryOut(**query_out_fields(prepared, answer), debug=debug)
+            yield _sse("done", jsonable_encoder(out))
+        finally:
+            _release()
+
+    return _ReleasingStream(events(), _release, media_type="text/event-stream",
+                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def _cached_events(q: dict, prepared, stages, answer_raw: str):
+    """SSE для ответа из кэша: весь текст одним token-событием, затем done"""
+    sanitizer = StreamSanitizer(prepared["defenses"])
+    safe = sanitizer.feed(answer_raw) + sanitizer.flush()
+    if safe:
+        yield _sse("token", {"text": safe})
+    with trace() as post:
+        answer = finalize_answer(answer_raw, prepared["defenses"])
+    debug = {"stages_ms": trace_ms({**stages, **post}), "context": prepared["context_budget"]} if q.get("debug") or QUERY_DEBUG else None
+    out = QueryOut(**query_out_fields(prepared, answer), debug=debug, cached=True)
+    yield _sse("done", jsonable_encoder(out))
+
+@app.post("/evaluate")
+async def evaluate(body: dict):
+    """
+    Пакетный прогон атак × защит одним запросом.
+    По умолчанию — 16 наборов защит на каждый файл атаки (все комбинации
+    isolation, filter, sanitize, semantic): до 16 генераций LLM на файл,
+    если ответа нет в кэше. Для быстрого прогона передайте defense_sets.
+    Ожидает (все поля опциональны):
+    {
+      "attack_files": ["1_jailbreak.txt", ...],     # по умолчанию — все из attack_scenarios.json
+      "defense_sets": [[], ["filter"], ...],         # по умолчанию — все 16 комбинаций
+      "workers": 2,                                  # параллельных генераций (1..LLM_BATCH_WORKERS)
+      "filters": {"trust": ["user"]}                 # фильтры retrieval, как в /query
+    }
+    """
+    state = app.state.rag
+    attack_files = body.get("attack_files") or default_attack_files()
+    defense_sets = body.get("defense_sets")
+    for defenses in defense_sets or []:
+        check_defenses(defenses)
+    workers = _check_workers(body.get("workers"))
+
+    embed = _embed_prompt(state)
+    profile = profile_key("evaluate")
+
+    def _generate(inputs):
+        answer = RESPONSE_CACHE.get(inputs['input'], inputs['context'], embed, profile)
+        if answer is None:
+            # генерации идут через общий пул, чтобы не мешать /query сверх его лимитов
+            answer = to_text(INFERENCE.execute(lambda: state['models'].get(chain_name("evaluate")).invoke(inputs)))
+            RESPONSE_CACHE.put(inputs['input'], inputs['context'], answer, embed, profile)
+        return answer
+
+    return await run_in_threadpool(
+        run_evaluation, state, DOCS, ATTACK_FILES_DIR, attack_files, defense_sets,
+        generate=_generate, workers=workers, filters=body.get("filters"), catalog=CATALOG,
     )
 
+def _check_workers(workers) -> int:
+    """Число параллельных генераций прогона: 1..LLM_BATCH_WORKERS (по умолчанию — максимум)"""
+    if workers is None:
+        return LLM_BATCH_WORKERS
+    try:
+        workers = int(workers)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="workers должен быть целым числом")
+    return min(max(workers, 1), LLM_BATCH_WORKERS)
+
+@app.get("/models")
+def models():
+    """Статус тяжёлых моделей: загружены ли, время загрузки, прирост памяти"""
+    return app.state.rag['models'].stats()
+
+@app.get("/inference/stats")
+def inference_stats():
+    """Глубина очереди генераций и время ожидания; по загруженным моделям — занятость слотов"""
+    registry = app.state.rag['models']
+    slots = {
+        cls: registry.get(llm_name(cls)).stats()
+        for cls in REQUEST_CLASSES
+        if registry.is_loaded(llm_name(cls)) and hasattr(registry.get(llm_name(cls)), "stats")
+    }
+    return {**INFERENCE.stats(), "slots": slots}
+
+@app.get("/cache/stats")
+def cache_stats():
+    """Статистика кэшей (разобранные документы, ответы LLM, эмбеддинги запросов и микробатчи)"""
+    return {
+        "parsed_documents": PARSE_CACHE.stats(),
+        "responses": RESPONSE_CACHE.stats(),
+        "embeddings": app.state.rag['index'].embedder.stats(),
+    }
+
+@app.get("/sanitize/rules")
+def sanitize_rules():
+    """Правила санитизации и число срабатываний каждого с запуска"""
+    return SANITIZER.stats()
+
+@app.post("/sanitize/rules")
+def add_sanitize_rule(rule: dict):
+    """
+    Добавить пользовательское правило санитизации (только при SANITIZE_RULES_RUNTIME=1):
+    {"name": "...", "pattern": "...", "ignore_case": false, "flag": null, "redact": true, "hints": []}
+    Встроенные правила не заменяются; шаблоны с вложенными квантификаторами
+    и совпадающие с обычным текстом отклоняются.
+    """
+    if not SANITIZE_RULES_RUNTIME:
+        raise HTTPException(status_code=403, detail="Добавление правил по HTTP выключено (SANITIZE_RULES_RUNTIME=1)")
+    try:
+        new_rule = Rule(**{**rule, "hints": tuple(rule.get("hints") or ())})
+        check_untrusted(new_rule, BASE_RULE_NAMES)
+        SANITIZER.add_rule(new_rule)
+    except (TypeError, ValueError, re.error) as e:
+        raise HTTPException(status_code=400, detail=f"Некорректное правило: {e}")
+    return SANITIZER.stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Метрики в формате Prometheus: гистограммы этапов и запросов, токены LLM, очередь"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/profiles")
+def profiles():
+    """Последние профили медленных и запрошенных запросов с горячими точками"""
+    return {**PROFILER.stats(), "profiles": PROFILER.recent()}
+
+@app.get("/profiles/{request_id}", response_class=PlainTextResponse)
+def profile(request_id: str):
+    """Collapsed stacks профиля (flamegraph.pl, speedscope: Import)"""
+    folded = PROFILER.folded(request_id)
+    if folded is None:
+        raise HTTPException(status_code=404, detail="Профиль не найден")
+    return PlainTextResponse(folded)
+
 @app.get("/health")
 def health():
     return {"status": "ok"}
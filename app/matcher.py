@@ -0,0 +1,247 @@
+import re
+import unicodedata
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from rapidfuzz import fuzz
+
+try:
+    # C-реализация Aho–Corasick (pip install pyahocorasick) — опционально
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# Текст только из ASCII и базовой кириллицы: здесь NFKC ничего не меняет,
+# а lower() — посимвольный (1:1), так что смещения совпадают с исходным текстом
+_PLAIN_TEXT = re.compile(r"[\x00-\x7f\u0400-\u04ff]*")
+
+# С какой длины текст режется на сегменты для отсечения fuzzy-кандидатов
+_SEGMENT_MIN_LEN = 50_000
+_SEGMENT_SIZE = 4096
+
+# Классы символов для посегментной оценки: латиница / кириллица / прочее
+_LATIN, _CYRILLIC = "\x01", "\x02"
+_SCRIPT_TABLE = {
+    **{c: _LATIN for c in range(ord("a"), ord("z") + 1)},
+    **{c: _CYRILLIC for c in range(0x0430, 0x0460)},
+}
+
+REDACTED = "[REDACTED]"
+
+
+def _normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+class _KeywordIndex:
+    """
+    Поиск всех вхождений набора строк за один проход (Aho–Corasick).
+    Без pyahocorasick — по одному str.find на ключ (тоже C-скорость).
+    """
+
+    def __init__(self, keys: List[str]):
+        self.keys = sorted(set(keys))
+        self._automaton = None
+        if ahocorasick is not None and self.keys:
+            self._automaton = ahocorasick.Automaton()
+            for key in self.keys:
+                self._automaton.add_word(key, key)
+            self._automaton.make_automaton()
+
+    def present(self, text: str) -> set:
+        """Множество ключей, встречающихся в тексте"""
+        if self._automaton is None:
+            return {key for key in self.keys if key in text}
+        return {key for _, key in self._automaton.iter(text)}
+
+    def occurrences(self, text: str) -> List[Tuple[int, str]]:
+        """Все вхождения (в т.ч. перекрывающиеся): [(начало, ключ), ...]"""
+        if self._automaton is not None:
+            return [(end - len(key) + 1, key) for end, key in self._automaton.iter(text)]
+        found = []
+        for key in self.keys:
+            pos = text.find(key)
+            while pos != -1:
+                found.append((pos, key))
+                pos = text.find(key, pos + 1)
+        return found
+
+
+class PatternMatcher:
+    """
+    Предкомпилированный движок поиска паттернов атак для filter_prompt.
+    - точные совпадения: один проход Aho–Corasick по нормализованному тексту;
+    - нечёткие: дешёвая верхняя оценка partial_ratio по мультимножеству символов
+      (для длинных текстов — ещё и посегментно, с кэшем повторяющихся сегментов)
+      отсекает заведомо непрошедшие паттерны и участки текста, остальное
+      скорится rapidfuzz с score_cutoff;
+    - редактирование: для ASCII/кириллицы — по тем же вхождениям,
+      иначе — общим регулярным выражением (компилируется один раз).
+    Результаты совпадают с прежней попаттерновой реализацией.
+    """
+
+    def __init__(self, patterns: List[str]):
+        self.patterns = list(patterns)
+        self._norm = [_normalize(p) for p in self.patterns]
+        self._lower = [p.lower() for p in self.patterns]
+        # нормализованный ключ -> индексы паттернов (дубликаты тоже учитываются)
+        self._by_norm: Dict[str, List[int]] = {}
+        for i, key in enumerate(self._norm):
+            self._by_norm.setdefault(key, []).append(i)
+        # ключ в нижнем регистре -> первый паттерн (как выбирает альтернатива regex)
+        self._first_lower: Dict[str, int] = {}
+        for i, key in enumerate(self._lower):
+            self._first_lower.setdefault(key, i)
+        self._norm_index = _KeywordIndex(self._norm)
+        self._lower_index = _KeywordIndex(self._lower)
+        self._plain_patterns = all(_PLAIN_TEXT.fullmatch(p) for p in self.patterns)
+        self.regex = re.compile("|".join(map(re.escape, self.patterns)), flags=re.IGNORECASE)
+        self._char_counts = [Counter(p) for p in self._norm]
+        self._alphabet = sorted(set("".join(self._norm)))
+        self._script_counts_all = [self._script_counts(i) for i in range(len(self.patterns))]
+
+    # ---- точные совпадения и редактирование ----
+
+    def _redact_plain(self, text: str, lowered: str) -> Tuple[str, set]:
+        """Эмуляция regex.sub по вхождениям: в каждой позиции — первая по порядку
+        альтернатива, поиск продолжается с конца замены."""
+        starts: Dict[int, int] = {}
+        present = set()
+        for pos, key in self._lower_index.occurrences(lowered):
+            present.add(key)
+            idx = self._first_lower[key]
+            if idx < starts.get(pos, len(self.patterns)):
+                starts[pos] = idx
+        if not starts:
+            return text, present
+        out, last = [], 0
+        for pos in sorted(starts):
+            if pos < last:
+                continue
+            out.append(text[last:pos])
+            out.append(REDACTED)
+            last = pos + len(self._lower[starts[pos]])
+        out.append(text[last:])
+        return "".join(out), present
+
+    def exact_and_redact(self, text: str) -> Tuple[str, List[int], str]:
+        """(отредактированный текст, индексы точных совпадений, нормализованный текст)"""
+        if self._plain_patterns and _PLAIN_TEXT.fullmatch(text):
+            norm = text.lower()
+            redacted, present = self._redact_plain(text, norm)
+        else:
+            norm = _normalize(text)
+            present = self._norm_index.present(norm)
+            redacted = self.regex.sub(REDACTED, text)
+        exact = sorted(i for key in present for i in self._by_norm.get(key, ()))
+        return redacted, exact, norm
+
+    def redact(self, text: str) -> str:
+        """Только замена точных совпадений на [REDACTED] (без fuzzy-скоринга)"""
+        return self.exact_and_redact(text)[0]
+
+    @property
+    def max_pattern_len(self) -> int:
+        return max(map(len, self.patterns), default=0)
+
+    # ---- нечёткие совпадения ----
+
+    def _upper_bound(self, i: int, norm: str, text_counts: Dict[str, int]) -> float:
+        """
+        Верхняя оценка fuzz.partial_ratio(паттерн, текст).
+        partial_ratio = max 200*LCS/(m+l) по окнам длины l <= m более короткой строки m;
+        LCS <= min(l, I), где I — пересечение мультимножеств символов,
+        откуда максимум достигается при l = I: 200*I/(m+I).
+        """
+        pat_counts = self._char_counts[i]
+        if len(norm) >= len(self._norm[i]):
+            m = len(self._norm[i])
+            inter = sum(min(n, text_counts.get(ch, 0)) for ch, n in pat_counts.items())
+        else:
+            m = len(norm)
+            inter = sum(min(n, pat_counts.get(ch, 0)) for ch, n in Counter(norm).items())
+        return 200.0 * inter / (m + inter) if m + inter else 0.0
+
+    def _script_counts(self, i: int) -> Tuple[int, int, int]:
+        pat = self._norm[i]
+        classes = pat.translate(_SCRIPT_TABLE)
+        lat, cyr = classes.count(_LATIN), classes.count(_CYRILLIC)
+        return lat, cyr, len(pat) - lat - cyr
+
+    def _segments(self, norm: str) -> List[Tuple[int, int, int, int, int]]:
+        """
+        Нарезка длинного текста на сегменты с перекрытием m: любое окно длины <= m
+        целиком лежит в каком-то сегменте. Границы ставятся по переводам строк,
+        поэтому повторяющийся текст даёт одинаковые сегменты (их скоринг кэшируется).
+        Возвращает [(начало, конец, латиница, кириллица, прочее), ...]
+        """
+        classes = norm.translate(_SCRIPT_TABLE)
+        overlap = max(map(len, self._norm))
+        segments = []
+        start, n = 0, len(norm)
+        while start < n:
+            cut = norm.find("\n", start + _SEGMENT_SIZE)
+            if cut == -1 or cut - start > 2 * _SEGMENT_SIZE:
+                cut = start + _SEGMENT_SIZE
+            cut = min(cut + 1, n)
+            end = min(cut + overlap, n)
+            lat = classes.count(_LATIN, start, end)
+            cyr = classes.count(_CYRILLIC, start, end)
+            segments.append((start, end, lat, cyr, end - start - lat - cyr))
+            start = cut
+        return segments
+
+    def _fuzzy_long(self, i: int, norm: str, segments: List[Tuple[int, int, int, int, int]],
+                    threshold: float) -> bool:
+        """
+        partial_ratio >= threshold для длинного текста.
+        Сегмент отбрасывается, если оценка 200*I/(m+I), где I <= сумма по классам
+        (латиница/кириллица/прочее) min(символов класса в паттерне, в сегменте),
+        ниже порога; одинаковые по содержимому сегменты скорятся один раз.
+        """
+        pat, m = self._norm[i], len(self._norm[i])
+        p_lat, p_cyr, p_other = self._script_counts_all[i]
+        seen = set()
+        for start, end, lat, cyr, other in segments:
+            inter = min(p_lat, lat) + min(p_cyr, cyr) + min(p_other, other)
+            if 200.0 * inter / (m + inter) < threshold:
+                continue
+            part = norm[start:end]
+            if part in seen:
+                continue
+            seen.add(part)
+            res = fuzz.partial_ratio_alignment(pat, part, score_cutoff=threshold)
+            if res is None or res.score < threshold:
+                continue
+            # Окно полной длины (или у настоящей границы текста) есть и в исходном тексте
+            if (res.dest_end - res.dest_start == m
+                    or (start == 0 and res.dest_start == 0)
+                    or (end == len(norm) and res.dest_end == len(part))):
+                return True
+            # Короткое окно на искусственной границе сегмента — проверяем весь текст
+            return fuzz.partial_ratio(pat, norm, score_cutoff=threshold) >= threshold
+        return False
+
+    def fuzzy(self, norm: str, skip: List[int], threshold: float) -> List[int]:
+        """Индексы паттернов с partial_ratio >= threshold (кроме skip)"""
+        skip_set = set(skip)
+        text_counts = {ch: norm.count(ch) for ch in self._alphabet}
+        candidates = [
+            i for i in range(len(self.patterns))
+            if i not in skip_set and self._upper_bound(i, norm, text_counts) >= threshold
+        ]
+        if not candidates:
+            return []
+        if len(norm) >= _SEGMENT_MIN_LEN:
+            segments = self._segments(norm)
+            return [i for i in candidates if self._fuzzy_long(i, norm, segments, threshold)]
+        return [
+            i for i in candidates
+            if fuzz.partial_ratio(self._norm[i], norm, score_cutoff=threshold) >= threshold
+        ]
+
+    def scan(self, text: str, fuzzy_threshold: float = 75) -> Tuple[str, List[str], List[str]]:
+        """(отредактированный текст, точные совпадения, нечёткие совпадения)"""
+        redacted, exact, norm = self.exact_and_redact(text)
+        fuzzy = self.fuzzy(norm, exact, fuzzy_threshold)
+        return redacted, [self.patterns[i] for i in exact], [self.patterns[i] for i in fuzzy]
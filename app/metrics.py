@@ -0,0 +1,198 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+# Границы корзин гистограмм (секунды): от миллисекунды до минуты
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200)
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Histogram:
+    """Гистограмма в формате Prometheus (корзины le, _sum, _count) по наборам меток"""
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name, self.help = name, help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(k, list(v[0]), v[1], v[2]) for k, v in sorted(self._series.items())]
+        for labels, counts, total, count in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = 'le="%s"' % ("+Inf" if bound == float("inf") else repr(bound))
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class Counter:
+    """Монотонный счётчик Prometheus по наборам меток"""
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name, self.help = name, help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *labels: str):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        lines += [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in items]
+        return lines
+
+
+class Gauge:
+    """Значение, снимаемое функцией в момент запроса /metrics"""
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float]):
+        self.name, self.help, self.fn = name, help, fn
+
+    def render(self) -> List[str]:
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus (exposition format 0.0.4)"""
+        lines = []
+        for metric in self._metrics.values():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "rag_stage_seconds", "Время этапов обработки (retrieval, защиты, генерация, индексация)", ("stage",)))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "rag_request_seconds", "Время HTTP-запросов", ("method", "route", "status")))
+LLM_TOKENS = REGISTRY.register(Counter(
+    "rag_llm_tokens_total", "Токены LLM: prompt и completion", ("kind",)))
+LLM_TOKENS_PER_SECOND = REGISTRY.register(Histogram(
+    "rag_llm_tokens_per_second", "Скорость генерации (completion-токенов в секунду)", buckets=RATE_BUCKETS))
+
+# Разбивка текущего запроса по этапам (для поля debug в QueryOut);
+# run_in_threadpool копирует контекст, так что этапы из пула потоков попадают сюда же
+_TRACE: ContextVar[Optional[Dict[str, float]]] = ContextVar("rag_trace", default=None)
+
+
+def observe_stage(stage: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage)
+    trace = _TRACE.get()
+    if trace is not None:
+        trace[stage] = trace.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Замер этапа: в гистограмму rag_stage_seconds и в разбивку текущего запроса"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def trace() -> Iterator[Dict[str, float]]:
+    """Собрать этапы запроса: {stage: секунды} (повторяющиеся этапы суммируются)"""
+    stages: Dict[str, float] = {}
+    token = _TRACE.set(stages)
+    try:
+        yield stages
+    finally:
+        _TRACE.reset(token)
+
+
+def trace_ms(stages: Dict[str, float]) -> Dict[str, float]:
+    return {stage: round(seconds * 1000, 3) for stage, seconds in stages.items()}
+
+
+class LLMUsage(BaseCallbackHandler):
+    """
+    Callback для chain.invoke/stream: запоминает точный prompt, переданный в LLM,
+    и текст ответа — по ним считаются токены токенизатором самой модели.
+    """
+
+    def __init__(self):
+        self.prompts: List[str] = []
+        self.completions: List[str] = []
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.prompts.extend(prompts)
+
+    def on_llm_end(self, response, **kwargs):
+        for generations in response.generations:
+            self.completions.extend(g.text for g in generations)
+
+
+def llm_tokenizer(llm) -> Optional[Callable[[str], int]]:
+    """Токенизатор llama.cpp (LlamaCpp.client.tokenize); у других LLM — None"""
+    client = getattr(llm, "client", None)
+    if client is None or not hasattr(client, "tokenize"):
+        return None
+    return lambda text: len(client.tokenize(text.encode("utf-8"), add_bos=False))
+
+
+def record_generation(llm, usage: LLMUsage, seconds: float) -> Dict[str, Any]:
+    """Учесть генерацию: время, токены prompt/completion и токены в секунду"""
+    observe_stage("generate", seconds)
+    out: Dict[str, Any] = {}
+    count = llm_tokenizer(llm)
+    if count is None:
+        return out
+    prompt_tokens = sum(count(p) for p in usage.prompts)
+    completion_tokens = sum(count(c) for c in usage.completions)
+    LLM_TOKENS.inc(prompt_tokens, "prompt")
+    LLM_TOKENS.inc(completion_tokens, "completion")
+    out = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+    if seconds > 0 and completion_tokens:
+        rate = completion_tokens / seconds
+        LLM_TOKENS_PER_SECOND.observe(rate)
+        out["tokens_per_second"] = round(rate, 2)
+    return out
@@ -12,6 +12,7 @@ class DefenseType(str, Enum):
     filter = "filter"
     sanitize = "sanitize"
     isolation = "isolation"
+    semantic = "semantic"
 
 class Query(BaseModel):
     prompt: str
@@ -29,11 +30,32 @@ class QueryOut(BaseModel):
     flags: Dict[str, Any]               # sanity-check флаги
     found_exact: List[str]              # точные совпадения паттернов
     found_fuzzy: List[str]              # нечёткие совпадения паттернов
+    redactions: Optional[List[Dict[str, Any]]] = None   # сработавшие правила sanitize: rule, start, end
+    debug: Optional[Dict[str, Any]] = None              # время этапов и токены (если запрошено)
+    cached: bool = False                                # ответ LLM взят из кэша ответов
+    semantic: Optional[Dict[str, Any]] = None           # защита semantic: категория и близость prompt и чанков
+    defense_stages: List[Dict[str, Any]] = []           # этапы защит контекста: stage, ms, removed, changed
 
 class UploadOut(BaseModel):
     doc_id: str
     size: int
 
+class BulkUploadItem(BaseModel):
+    filename: str
+    doc_id: Optional[str] = None        # None — файл не загружен (см. error)
+    size: int = 0
+    chunks: int = 0
+    cached: bool = False                # разбор взят из кэша
+    error: Optional[str] = None
+
+class BulkUploadOut(BaseModel):
+    results: List[BulkUploadItem]
+    documents: int                      # успешно загружено
+    failed: int
+    chunks: int
+    seconds: float
+    docs_per_sec: float
+
 class DocInfo(BaseModel):
     doc_id: str
     filename: Optional[str] = None
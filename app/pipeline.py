@@ -0,0 +1,236 @@
+import os
+from typing import Any, Dict, List, Optional
+
+from fastapi import HTTPException
+from langchain_core.documents import Document
+
+from app.defenses import run_defenses
+from app.context import CONTEXT_CANDIDATES, pack_context, token_counter
+from app.document_loader import extract_text_from_path
+from app.index import TRUST_LEVELS
+from app.lexical import reciprocal_rank_fusion
+from app.metrics import span
+from app.security import filter_prompt, sanitize_scan, sanity_check
+
+# Режим retrieval: hybrid (вектор + BM25, слияние RRF), vector или lexical
+RETRIEVAL_MODES = ("hybrid", "vector", "lexical")
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+
+def load_prompt(q: Dict[str, Any], attack_dir: str, catalog=None) -> str:
+    """
+    Исходный prompt/контекст: атакующий файл или пользовательский ввод.
+    catalog: ScenarioCatalog — текст файла атаки берётся из него, без чтения с диска.
+    """
+    attack_file = q.get("attack_file")
+    if not attack_file:
+        prompt = (q.get("prompt") or "").strip()
+        if not prompt:
+            raise HTTPException(status_code=400, detail="Пустой prompt")
+        return prompt
+    text = catalog.text(attack_file) if catalog is not None else None
+    if text is not None:
+        return text
+
+    path = os.path.join(attack_dir, attack_file)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=400, detail="Файл атаки не найден")
+    ext = attack_file.rsplit('.', 1)[-1].lower()
+    if ext in ('txt', 'text'):
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    if ext in ('docx', 'pdf'):
+        # Разбор кэшируется по содержимому: при тёплом кэше файл не парсится
+        return extract_text_from_path(path)
+    raise HTTPException(status_code=415, detail="Unsupported attack file type")
+
+
+def _as_list(value: Any, name: str) -> List[Any]:
+    values = [value] if isinstance(value, (str, int, float)) else value
+    if not isinstance(values, list) or not values:
+        raise HTTPException(status_code=400, detail=f"filters.{name}: ожидается непустой список")
+    return list(values)
+
+
+def retrieval_filter(filters: Optional[Dict[str, Any]], docs: Dict[str, Any],
+                     doc_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Фильтры запроса -> where для Chroma (отбор идёт внутри векторного поиска):
+    doc_ids, filenames, trust — списки допустимых значений,
+    uploaded_after/uploaded_before — границы времени загрузки (unix time).
+    doc_id — прежний способ ограничить поиск одним документом.
+    """
+    if not isinstance(filters or {}, dict):
+        raise HTTPException(status_code=400, detail="filters: ожидается объект")
+    filters = dict(filters or {})
+    unknown = set(filters) - {"doc_ids", "filenames", "trust", "uploaded_after", "uploaded_before"}
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Неизвестные фильтры: {sorted(unknown)}")
+    clauses = []
+    doc_ids = _as_list(filters["doc_ids"], "doc_ids") if "doc_ids" in filters else []
+    if doc_id:
+        doc_ids.append(doc_id)
+    if doc_ids:
+        missing = [d for d in doc_ids if d not in docs]
+        if missing:
+            raise HTTPException(status_code=404, detail=f"doc_id не найден: {missing}")
+        clauses.append({"doc_id": {"$in": doc_ids}})
+    if "filenames" in filters:
+        clauses.append({"filename": {"$in": _as_list(filters["filenames"], "filenames")}})
+    if "trust" in filters:
+        trust = _as_list(filters["trust"], "trust")
+        unknown = set(trust) - set(TRUST_LEVELS)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Неизвестные уровни доверия: {sorted(unknown)}")
+        clauses.append({"trust": {"$in": trust}})
+    for key, op in (("uploaded_after", "$gte"), ("uploaded_before", "$lte")):
+        if filters.get(key) is not None:
+            try:
+                clauses.append({"uploaded_at": {op: float(filters[key])}})
+            except (TypeError, ValueError):
+                raise HTTPException(status_code=400, detail=f"filters.{key}: ожидается unix time")
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def retrieve(state: Dict[str, Any], prompt: str, where: Optional[Dict[str, Any]] = None,
+             mode: str = RETRIEVAL_MODE) -> List[Document]:
+    """
+    Кандидаты в контекст по убыванию релевантности (metadata["rank"]):
+    чанки всей базы или только подходящих под where (например, одного
+    документа — а не последние его чанки: конец файла — место для инъекций).
+    hybrid: векторный поиск (metadata["distance"]) и BM25 (metadata["bm25"])
+    сливаются reciprocal rank fusion; lexical не вызывает эмбеддер.
+    Пока BM25 собирается после старта (lexical.ready), hybrid и lexical
+    отвечают только векторным поиском.
+    Сколько из них попадёт в prompt LLM, решает pack_context.
+    """
+    if mode not in RETRIEVAL_MODES:
+        raise HTTPException(status_code=400, detail=f"retrieval должен быть одним из {list(RETRIEVAL_MODES)}")
+    # ВНИМАНИЕ: здесь контекст может содержать вредоносные вставки из документов
+    rankings = []
+    if not state['lexical'].ready.is_set():
+        mode = "vector"
+    if mode != "lexical":
+        with span("retrieve.vector"):
+            found = state['vector'].similarity_search_with_score(prompt, k=CONTEXT_CANDIDATES, filter=where)
+        rankings.append([Document(page_content=d.page_content, metadata={**d.metadata, "distance": s}) for d, s in found])
+    if mode != "vector":
+        with span("retrieve.lexical"):
+            found = state['lexical'].search(prompt, CONTEXT_CANDIDATES, where)
+        rankings.append([Document(page_content=d.page_content, metadata={**d.metadata, "bm25": s}) for d, s in found])
+    docs = rankings[0] if len(rankings) == 1 else reciprocal_rank_fusion(rankings)[:CONTEXT_CANDIDATES]
+    for rank, d in enumerate(docs):
+        d.metadata["rank"] = rank
+    return docs
+
+
+def defend_context(raw: List[Document], defenses: List[str], state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Защиты контекста ПОСЛЕ векторизации — конвейер зарегистрированных этапов
+    (app.defenses): semantic параллельно с isolation -> filter -> sanitize,
+    каждый этап — пакетом по всем чанкам. defense_stages — что каждый этап
+    выбросил/изменил и за сколько.
+    """
+    result = run_defenses([d.page_content for d in raw], defenses, state)
+    selected_docs = [
+        Document(page_content=text, metadata=d.metadata)
+        for d, text in zip(raw, result["texts"]) if text is not None
+    ]
+    semantic = None
+    if "semantic" in result["details"]:
+        details = result["details"]["semantic"]
+        semantic = {
+            "threshold": details["threshold"],
+            "chunks": [
+                {"doc_id": d.metadata.get("doc_id"), "chunk": d.metadata.get("chunk"), **s}
+                for d, s in zip(raw, details["scores"])
+            ],
+        }
+    return {
+        "raw_context": "\n\n".join(d.page_content for d in raw),
+        "isolated_context": (
+            "\n\n".join(d.page_content for d in selected_docs) if "isolation" in defenses else None
+        ),
+        "selected_docs": selected_docs,
+        "semantic": semantic,
+        "defense_stages": result["stages"],
+    }
+
+
+def assemble_context(state: Dict[str, Any], prepared: Dict[str, Any]) -> Dict[str, Any]:
+    """Защищённые чанки -> контекст под бюджет токенов модели (без почти-дубликатов)"""
+    with span("context.pack"):
+        count = token_counter(state['models'].get('llm'))
+        prepared["selected_docs"], prepared["context_budget"] = pack_context(prepared["selected_docs"], count)
+    return prepared
+
+
+def prepare_query(state: Dict[str, Any], q: Dict[str, Any], docs: Dict[str, Any], attack_dir: str,
+                  catalog=None) -> Dict[str, Any]:
+    """
+    Шаги /query до генерации:
+    1) prompt, 2) retrieval, 3) защиты контекста, 4) сборка контекста под бюджет токенов.
+    Возвращает всё, что нужно для вызова chain и сборки QueryOut.
+    """
+    with span("load_prompt"):
+        prompt = load_prompt(q, attack_dir, catalog)
+    defenses = q.get("defenses") or []
+    where = retrieval_filter(q.get("filters"), docs, q.get("doc_id"))
+    with span("retrieve"):
+        raw = retrieve(state, prompt, where, q.get("retrieval") or RETRIEVAL_MODE)
+    prepared = defend_context(raw, defenses, state)
+    if prepared["semantic"] is not None:
+        with span("prompt.semantic"):
+            prepared["semantic"]["prompt"] = state['models'].get('semantic_detector').score_query(prompt)
+    assemble_context(state, prepared)
+    prepared.update({"prompt_used": prompt, "defenses": defenses})
+    return prepared
+
+
+def chain_input(prepared: Dict[str, Any]) -> Dict[str, Any]:
+    return {'input': prepared["prompt_used"], 'context': prepared["selected_docs"]}
+
+
+def finalize_answer(answer_raw: str, defenses: List[str]) -> Dict[str, Any]:
+    """Последовательно применяем фильтры/санитизацию к ответу (как safety net)"""
+    answer_sanitized = None
+    exact, fuzzy = [], []
+    redactions, flags = None, None
+
+    filtered = answer_raw
+    if "filter" in defenses:
+        with span("answer.filter"):
+            filtered, exact, fuzzy = filter_prompt(filtered)
+    if "sanitize" in defenses:
+        # один проход: текст, сработавшие правила и флаги по уже очищенному тексту
+        with span("answer.sanitize"):
+            filtered, redactions, flags = sanitize_scan(filtered)
+        answer_sanitized = filtered
+    answer_filtered = filtered if "filter" in defenses else None
+    final = answer_filtered or answer_sanitized or answer_raw
+    if flags is None or final != answer_sanitized:
+        with span("answer.sanity_check"):
+            flags = sanity_check(final)
+
+    return {
+        "answer_raw": answer_raw,
+        "answer_filtered": answer_filtered,
+        "answer_sanitized": answer_sanitized,
+        "flags": flags,
+        "found_exact": exact,
+        "found_fuzzy": fuzzy,
+        "redactions": redactions,
+    }
+
+
+def query_out_fields(prepared: Dict[str, Any], answer: Dict[str, Any]) -> Dict[str, Any]:
+    """Поля QueryOut из подготовленного контекста и обработанного ответа"""
+    return {
+        "raw_context": prepared["raw_context"],
+        "isolated_context": prepared["isolated_context"],
+        "prompt_used": prepared["prompt_used"],
+        "semantic": prepared["semantic"],
+        "defense_stages": prepared["defense_stages"],
+        **answer,
+    }
@@ -0,0 +1,277 @@
+"""
+Сэмплирующий профайлер запросов: где ушло время медленного /query или /upload.
+
+Фоновый поток раз в PROFILE_INTERVAL_MS снимает стеки всех потоков
+(sys._current_frames) — event loop, пулы threadpool, генераций и защит —
+и держит их в кольцевом буфере за последние PROFILE_WINDOW_S секунд.
+Ожидающие потоки (Condition.wait, select, свободные потоки пулов
+concurrent.futures в ожидании задачи) не пишутся. По завершении
+запроса сэмплы его окна сворачиваются в collapsed stacks
+("поток;функция;...;функция N" — flamegraph.pl, speedscope) и сохраняются,
+если профиль запрошен (X-Profile: 1 или ?profile=1) или запрос дольше
+PROFILE_SLOW_MS. Сэмплер работает постоянно только при PROFILE_SLOW_MS > 0,
+иначе — лишь пока идут запросы с явным профилированием.
+Сэмплы не привязаны к потоку запроса: если запросы шли одновременно,
+в профиль попадает и чужая работа — это видно по полю overlapping.
+"""
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from typing import Any, Dict, List, Optional, Tuple
+
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))            # авто-профиль медленнее порога, 0 — выкл.
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))    # период сэмплирования
+PROFILE_WINDOW_S = float(os.getenv("PROFILE_WINDOW_S", "60"))         # сколько секунд сэмплов держать в памяти
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))                   # последних профилей в памяти и на диске
+PROFILE_PATHS = tuple(p for p in os.getenv(
+    "PROFILE_PATHS", "/query,/query/stream,/upload,/upload/bulk,/evaluate").split(",") if p)
+PROFILE_TOP = 10
+
+# Кадр на вершине стека, по которому поток считается простаивающим. Свободный поток
+# ThreadPoolExecutor (llm, defense, ...) стоит в work_queue.get() — это C-вызов,
+# так что вершина его стека — сам concurrent/futures/thread.py:_worker
+_IDLE = {("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"), ("selectors.py", "select"),
+         ("thread.py", "_worker")}
+_THREAD_NO = re.compile(r"[_-]?\d+$")
+_SAFE_ID = re.compile(r"^[A-Za-z0-9_.-]{1,128}$")
+
+
+def _short_path(filename: str) -> str:
+    cwd = os.getcwd() + os.sep
+    if filename.startswith(cwd):
+        return filename[len(cwd):]
+    marker = "site-packages" + os.sep
+    if marker in filename:
+        return filename.split(marker, 1)[1]
+    return os.path.basename(filename)
+
+
+class Sampler:
+    """Фоновый сэмплер стеков всех потоков в кольцевой буфер (метка времени, поток, стек)"""
+
+    def __init__(self, interval: float, window: float, always: bool):
+        self.interval = interval
+        self.window = window
+        self.always = always
+        self._samples: deque = deque()
+        self._labels: Dict[Any, str] = {}        # code -> "функция (файл:строка)"
+        self._demand = 0                          # запросов с явным профилированием
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def _stack(self, frame) -> Optional[Tuple[str, ...]]:
+        code = frame.f_code
+        if (os.path.basename(code.co_filename), code.co_name) in _IDLE:
+            return None
+        stack = []
+        while frame is not None:
+            stack.append(self._label(frame.f_code))
+            frame = frame.f_back
+        return tuple(reversed(stack))
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            if not (self.always or self._demand):
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            now = time.perf_counter()
+            names = {t.ident: _THREAD_NO.sub("", t.name) for t in threading.enumerate()}
+            rows = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = self._stack(frame)
+                if stack is not None:
+                    rows.append((now, names.get(ident, "thread"), stack))
+            with self._lock:
+                self._samples.extend(rows)
+                while self._samples and self._samples[0][0] < now - self.window:
+                    self._samples.popleft()
+            time.sleep(self.interval)
+
+    def start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                    self._thread.start()
+
+    def demand(self, delta: int):
+        """Учесть запрос с явным профилированием (+1 в начале, -1 в конце)"""
+        with self._lock:
+            self._demand += delta
+        if delta > 0:
+            self.start()
+            self._wake.set()
+
+    def collect(self, start: float, end: float) -> Counter:
+        """Collapsed stacks за окно [start, end]: "поток;кадр;...;кадр" -> число сэмплов"""
+        with self._lock:
+            rows = [r for r in self._samples if start <= r[0] <= end]
+        return Counter(";".join((thread,) + stack) for _, thread, stack in rows)
+
+
+def hotspots(folded: Counter, top: int = PROFILE_TOP) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Горячие точки профиля: self — функции на вершине стека (где шло время),
+    app — функции приложения (app/...) с учётом вызванного из них.
+    """
+    total = sum(folded.values()) or 1
+    own: Counter = Counter()
+    inclusive: Counter = Counter()
+    for stack, n in folded.items():
+        frames = stack.split(";")[1:]
+        if frames:
+            own[frames[-1]] += n
+        for frame in set(frames):
+            if "(app" + os.sep in frame:
+                inclusive[frame] += n
+
+    def _rows(counter: Counter):
+        return [{"function": f, "samples": n, "percent": round(100 * n / total, 1)} for f, n in counter.most_common(top)]
+
+    return {"self": _rows(own), "app": _rows(inclusive)}
+
+
+class RequestProfiler:
+    """
+    Профили запросов поверх Sampler: start() в начале запроса, finish() —
+    после отправки тела ответа. Последние PROFILE_KEEP профилей лежат
+    в памяти; с directory — ещё и файлами <request_id>.<суффикс>.folded.
+    request_id приходит от клиента (X-Request-ID) и может повторяться, поэтому
+    суффикс генерирует сервер; в каталоге остаются PROFILE_KEEP самых новых
+    файлов, в т.ч. с прошлых запусков.
+    """
+
+    def __init__(self, directory: str = "", slow_ms: float = PROFILE_SLOW_MS,
+                 interval_ms: float = PROFILE_INTERVAL_MS, window_s: float = PROFILE_WINDOW_S,
+                 keep: int = PROFILE_KEEP, paths: Tuple[str, ...] = PROFILE_PATHS):
+        self.directory = directory
+        self.slow_ms = slow_ms
+        self.paths = paths
+        self.sampler = Sampler(interval_ms / 1000, window_s, always=slow_ms > 0)
+        self._active: Dict[int, Dict[str, Any]] = {}
+        self._recent: "deque[Dict[str, Any]]" = deque(maxlen=max(1, keep))
+        self._lock = threading.Lock()
+        self._rotate()
+        if self.sampler.always:
+            self.sampler.start()
+
+    def applies(self, path: str) -> bool:
+        return path in self.paths
+
+    def start(self, request_id: str, method: str, path: str, requested: bool) -> Dict[str, Any]:
+        session = {"request_id": request_id, "method": method, "path": path, "requested": requested,
+                   "started_at": time.time(), "start": time.perf_counter(), "overlapping": 0}
+        with self._lock:
+            for other in self._active.values():
+                other["overlapping"] += 1
+            session["overlapping"] = len(self._active)
+            self._active[id(session)] = session
+        if requested:
+            self.sampler.demand(+1)
+        return session
+
+    def finish(self, session: Dict[str, Any], status: int) -> Optional[Dict[str, Any]]:
+        """Закрыть запрос; профиль сохраняется, если он запрошен или запрос медленный"""
+        end = time.perf_counter()
+        with self._lock:
+            self._active.pop(id(session), None)
+        if session["requested"]:
+            self.sampler.demand(-1)
+        ms = (end - session["start"]) * 1000
+        slow = self.slow_ms > 0 and ms >= self.slow_ms
+        if not (session["requested"] or slow):
+            return None
+        folded = self.sampler.collect(session["start"], end)
+        record = {
+            "request_id": session["request_id"],
+            "method": session["method"],
+            "path": session["path"],
+            "status": status,
+            "ms": round(ms, 3),
+            "reason": "requested" if session["requested"] else "slow",
+            "started_at": session["started_at"],
+            "samples": sum(folded.values()),
+            "overlapping": session["overlapping"],
+            "truncated": ms / 1000 > self.sampler.window,
+            "hotspots": hotspots(folded),
+        }
+        text = "".join(f"{stack} {n}\n" for stack, n in sorted(folded.items()))
+        if self.directory and _SAFE_ID.match(record["request_id"]):
+            os.makedirs(self.directory, exist_ok=True)
+            name = f"{record['request_id']}.{uuid.uuid4().hex[:12]}.folded"
+            with open(os.path.join(self.directory, name), "w", encoding="utf-8") as f:
+                f.write(text)
+            self._rotate()
+        with self._lock:
+            self._recent.append({**record, "_folded": text})
+        return record
+
+    def _files(self) -> List[Tuple[float, str, str]]:
+        """Файлы профилей каталога: [(mtime, request_id, путь), ...], старые первыми"""
+        try:
+            names = os.listdir(self.directory) if self.directory else []
+        except OSError:
+            return []
+        files = []
+        for name in names:
+            if not name.endswith(".folded"):
+                continue
+            stem = name[:-len(".folded")]
+            request_id = stem.rpartition(".")[0] or stem   # без суффикса — файл прежнего формата
+            path = os.path.join(self.directory, name)
+            try:
+                files.append((os.path.getmtime(path), request_id, path))
+            except OSError:
+                pass
+        return sorted(files)
+
+    def _rotate(self):
+        """Оставить в каталоге только keep самых новых профилей"""
+        files = self._files()
+        for _, _, path in files[:max(0, len(files) - self._recent.maxlen)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def recent(self) -> List[Dict[str, Any]]:
+        """Последние профили, новые первыми (без самих стеков)"""
+        with self._lock:
+            return [{k: v for k, v in r.items() if k != "_folded"} for r in reversed(self._recent)]
+
+    def folded(self, request_id: str) -> Optional[str]:
+        """
+        Collapsed stacks профиля: из памяти, иначе из каталога (профили прошлых запусков);
+        при повторном request_id — самый новый
+        """
+        with self._lock:
+            for r in reversed(self._recent):
+                if r["request_id"] == request_id:
+                    return r["_folded"]
+        for _, found, path in reversed(self._files()):
+            if found == request_id:
+                try:
+                    with open(path, encoding="utf-8") as f:
+                        return f.read()
+                except OSError:
+                    return None
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"slow_ms": self.slow_ms, "interval_ms": self.sampler.interval * 1000,
+                "window_s": self.sampler.window, "paths": list(self.paths), "directory": self.directory or None}
@@ -0,0 +1,270 @@
+import json
+import re
+import threading
+from collections import Counter
+from typing import Any, Dict, List, NamedTuple, Optional
+
+try:
+    import re._parser as sre_parse    # Python 3.11+
+except ImportError:
+    import sre_parse
+
+REDACTED = "[REDACTED]"
+# Повторные проходы по результату замен идут, пока текст меняется; предел —
+# защита от правил, срабатывающих на собственной замене (например, «REDACTED»)
+_MAX_PASSES = 16
+_RULE_NAME = re.compile(r"[A-Za-z_][A-Za-z0-9_]*\Z")
+# Ограничения для правил, пришедших по HTTP (check_untrusted)
+UNTRUSTED_MAX_PATTERN = 512
+UNTRUSTED_MAX_COVERAGE = 0.5   # доля обычного текста, которую правило может закрыть
+_PROBE_TEXT = (
+    "Обычный ответ модели без секретов: проект завершён в срок, отчёт отправлен заказчику. "
+    "A plain answer without secrets: the report was sent to the client on time."
+)
+_REPEATS = tuple(getattr(sre_parse, op) for op in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT") if hasattr(sre_parse, op))
+
+
+class Rule(NamedTuple):
+    name: str                    # имя правила (идентификатор: имя группы в общем regex)
+    pattern: str
+    ignore_case: bool = False
+    flag: Optional[str] = None   # ключ в flags (sanity-check), если правило его выставляет
+    redact: bool = True          # False — только детекция, текст не меняется
+    hints: tuple = ()            # подстроки, без одной из которых правило не сработает (отсев до regex)
+
+
+class ScanResult(NamedTuple):
+    text: str                          # текст после редактирования
+    hits: List[Dict[str, Any]]         # [{"rule", "start", "end"}, ...] — смещения во входном тексте
+    flags: Dict[str, bool]             # flag-правила, сработавшие без замены (в любом из проходов)
+
+
+class RedactionEngine:
+    """
+    Все правила санитизации в одном предкомпилированном регулярном выражении
+    (альтернативы с именованными группами, у каждой свои флаги):
+    текст проходится один раз, для каждого срабатывания известно правило и смещение.
+    Если совпадения разных правил перекрываются, они сливаются в одну замену.
+    Правила с hints, чьих подстрок нет в тексте, в проход не включаются
+    (regex под каждый набор активных правил компилируется один раз).
+    Правила можно добавлять на лету (add_rule): общий regex пересобирается.
+    """
+
+    def __init__(self, rules: List[Rule]):
+        self._lock = threading.Lock()
+        self._counts: Counter = Counter()
+        for rule in rules:
+            self._check(rule)
+        self._build(list(rules))
+
+    @staticmethod
+    def _check(rule: Rule):
+        if not _RULE_NAME.match(rule.name):
+            raise ValueError(f"Имя правила должно быть идентификатором: {rule.name!r}")
+        compiled = re.compile(rule.pattern, re.IGNORECASE if rule.ignore_case else 0)
+        if compiled.groupindex:
+            raise ValueError("Именованные группы в правиле не поддерживаются")
+        if compiled.match(""):
+            raise ValueError("Правило совпадает с пустой строкой")
+
+    def _build(self, rules: List[Rule]):
+        compiled = {
+            r.name: re.compile(r.pattern, re.IGNORECASE if r.ignore_case else 0) for r in rules
+        }
+        # одна атомарная замена: параллельные scan() видят либо старый, либо новый набор
+        self._state = (tuple(rules), {r.name: r for r in rules}, compiled, self._combine(rules))
+        self._subsets: Dict[tuple, "re.Pattern"] = {}
+
+    @staticmethod
+    def _combine(rules) -> "re.Pattern":
+        return re.compile("|".join(
+            f"(?P<{r.name}>{'(?i:' + r.pattern + ')' if r.ignore_case else r.pattern})"
+            for r in rules
+        ))
+
+    def _active_regex(self, text: str, rules) -> Optional["re.Pattern"]:
+        """Общий regex только из правил, которые могут сработать на этом тексте"""
+        folded = None
+        active = []
+        for r in rules:
+            if r.hints:
+                if r.ignore_case:
+                    # casefold, а не lower: под IGNORECASE «ſ» совпадает с «s», «K» (кельвин) — с «k»
+                    folded = text.casefold() if folded is None else folded
+                    haystack = folded
+                else:
+                    haystack = text
+                if not any(h in haystack for h in r.hints):
+                    continue
+            active.append(r)
+        if not active:
+            return None
+        if len(active) == len(rules):
+            return self._state[3]
+        key = tuple(r.name for r in active)
+        subsets = self._subsets
+        regex = subsets.get(key)
+        if regex is None:
+            regex = subsets[key] = self._combine(active)
+        return regex
+
+    @property
+    def rules(self) -> List[Rule]:
+        return list(self._state[0])
+
+    @property
+    def regex(self) -> "re.Pattern":
+        return self._state[3]
+
+    @property
+    def patterns(self) -> List["re.Pattern"]:
+        """Regex каждого правила по отдельности (в общем regex перекрывающиеся совпадения не видны)"""
+        return list(self._state[2].values())
+
+    def add_rule(self, rule: Rule):
+        """Добавить (или заменить одноимённое) пользовательское правило"""
+        self._check(rule)
+        with self._lock:
+            self._build([r for r in self._state[0] if r.name != rule.name] + [rule])
+
+    @staticmethod
+    def _overlapping(text: str, start: int, end: int, fired: str, compiled) -> List[tuple]:
+        """
+        Совпадения остальных правил, начинающиеся внутри [start, end): общий regex
+        в каждой позиции берёт только первую альтернативу, а перекрывающиеся
+        совпадения других правил тоже должны попасть в hits/flags и в замену.
+        """
+        found = []
+        for name, rx in compiled.items():
+            if name == fired:
+                continue
+            pos = start
+            while pos < end:
+                m = rx.match(text, pos)
+                if m is None:
+                    pos += 1
+                    continue
+                found.append((name, m.start(), m.end()))
+                pos = max(m.end(), pos + 1)
+        return found
+
+    def _pass(self, text: str, redact: bool):
+        """Один проход общего regex: (текст после замен, hits, flags видимых совпадений)"""
+        rules, by_name, compiled, _ = self._state
+        hits, out = [], []
+        flags = {r.flag: False for r in rules if r.flag}
+        regex = self._active_regex(text, rules)
+        last = pos = 0
+        while regex is not None:
+            m = regex.search(text, pos)
+            if m is None:
+                break
+            start, end = m.span()
+            group = [(m.lastgroup, start, end)]
+            checked = start
+            while checked < end:
+                more = self._overlapping(text, checked, end, m.lastgroup, compiled)
+                checked = end
+                group += more
+                end = max([end] + [e for _, _, e in more])
+            replace = False
+            for name, s, e in group:
+                rule = by_name[name]
+                hits.append({"rule": name, "start": s, "end": e})
+                if redact and rule.redact:
+                    replace = True
+                elif rule.flag:
+                    flags[rule.flag] = True
+            if replace:
+                out.append(text[last:start])
+                out.append(REDACTED)
+                last = end
+            pos = end if end > start else end + 1
+        if out:
+            out.append(text[last:])
+            text = "".join(out)
+        return text, hits, flags
+
+    def scan(self, text: str, redact: bool = True) -> ScanResult:
+        """
+        Замены, срабатывания правил и флаги за один проход.
+        Замена меняет границы слов вокруг себя (например, «1.2.3.4http://…» ->
+        «1.2.3.4[REDACTED]» — теперь это IP), поэтому после замен проход
+        повторяется по результату, пока он меняется. Тогда ни одно редактирующее
+        правило на возвращённом тексте больше не срабатывает — кроме случая, когда
+        текст не устоялся за _MAX_PASSES проходов (правило срабатывает на собственной
+        замене). flags собираются по всем проходам. hits повторных проходов —
+        только новые замены (правила без замены уже учтены первым проходом),
+        помечены "pass" и считаются по тексту предыдущего прохода.
+        """
+        result, hits, flags = self._pass(text, redact)
+        passes = 1
+        while redact and result != text and passes < _MAX_PASSES:
+            text = result
+            passes += 1
+            result, more, more_flags = self._pass(text, redact)
+            by_name = self._state[1]
+            hits += [{**h, "pass": passes} for h in more if h["rule"] in by_name and by_name[h["rule"]].redact]
+            flags = {name: seen or flags.get(name, False) for name, seen in more_flags.items()}
+        if hits:
+            with self._lock:
+                self._counts.update(h["rule"] for h in hits)
+        return ScanResult(result, hits, flags)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """Правила и число их срабатываний с запуска"""
+        with self._lock:
+            return [{**r._asdict(), "hits": self._counts[r.name]} for r in self._state[0]]
+
+
+def _subpatterns(value):
+    """Вложенные SubPattern в аргументах узла разобранного regex"""
+    if isinstance(value, sre_parse.SubPattern):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            yield from _subpatterns(v)
+
+
+def _nested_repeat(parsed, outer: int = 1) -> bool:
+    """
+    Есть ли повтор внутри повтора, где хотя бы один из них неограничен (*, +, {n,}) —
+    источник катастрофического бэктрекинга ((a+)+, (x*y?)*). Вложенные
+    ограниченные повторы ((?: [0-9]{4}){3}) допустимы. outer — max внешнего повтора.
+    """
+    for op, av in parsed:
+        if op in _REPEATS:
+            inner = av[1]
+            if outer > 1 and inner > 1 and sre_parse.MAXREPEAT in (outer, inner):
+                return True
+            if _nested_repeat(av[2], max(outer, inner)):
+                return True
+        else:
+            for sub in _subpatterns(av):
+                if _nested_repeat(sub, outer):
+                    return True
+    return False
+
+
+def check_untrusted(rule: Rule, reserved: List[str]):
+    """
+    Проверка правила из непроверенного источника (POST /sanitize/rules) до add_rule:
+    не заменяет встроенное правило, без вложенных повторов, не длиннее
+    UNTRUSTED_MAX_PATTERN и не закрывает собой обычный текст. ValueError — отказ.
+    """
+    if rule.name in reserved:
+        raise ValueError(f"Встроенное правило {rule.name!r} нельзя заменить")
+    if len(rule.pattern) > UNTRUSTED_MAX_PATTERN:
+        raise ValueError(f"Шаблон длиннее {UNTRUSTED_MAX_PATTERN} символов")
+    if _nested_repeat(sre_parse.parse(rule.pattern)):
+        raise ValueError("Вложенные квантификаторы (например, (a+)+) не допускаются")
+    compiled = re.compile(rule.pattern, re.IGNORECASE if rule.ignore_case else 0)
+    covered = sum(m.end() - m.start() for m in compiled.finditer(_PROBE_TEXT))
+    if covered > UNTRUSTED_MAX_COVERAGE * len(_PROBE_TEXT):
+        raise ValueError("Правило совпадает с обычным текстом почти целиком")
+
+
+def load_rules(path: str) -> List[Rule]:
+    """Пользовательские правила из JSON: [{"name", "pattern", "ignore_case", "flag", "redact"}, ...]"""
+    with open(path, encoding="utf-8") as f:
+        return [Rule(**{**item, "hints": tuple(item.get("hints", ()))}) for item in json.load(f)]
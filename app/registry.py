@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+
+def _rss_bytes() -> int:
+    """Текущий RSS процесса в байтах (0, если платформа не поддерживается)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # на Linux ru_maxrss в КБ, на macOS — в байтах; это пик, а не текущее значение
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if os.uname().sysname == "Darwin" else rss * 1024
+    except (ImportError, AttributeError):
+        return 0
+
+
+class ModelRegistry:
+    """
+    Реестр тяжёлых ресурсов (LLM, эмбеддер, spaCy), живущих весь процесс.
+    Каждый ресурс строится один раз — лениво при первом get()
+    или заранее через warmup() в фоне — и дальше разделяется между запросами.
+    """
+
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._instances: Dict[str, Any] = {}
+        self._stats: Dict[str, Dict[str, Any]] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._guard = threading.Lock()
+
+    def register(self, name: str, factory: Callable[[], Any]):
+        """Зарегистрировать фабрику ресурса (сам ресурс не создаётся)"""
+        with self._guard:
+            self._factories[name] = factory
+            self._locks.setdefault(name, threading.Lock())
+            self._stats.setdefault(name, {"loaded": False})
+
+    def get(self, name: str) -> Any:
+        """Вернуть ресурс, при необходимости построив его (ровно один раз)"""
+        inst = self._instances.get(name)
+        if inst is not None:
+            return inst
+        if name not in self._factories:
+            raise KeyError(f"Модель '{name}' не зарегистрирована")
+        with self._locks[name]:
+            inst = self._instances.get(name)
+            if inst is None:
+                inst = self._load(name)
+        return inst
+
+    def _load(self, name: str) -> Any:
+        rss_before = _rss_bytes()
+        start = time.perf_counter()
+        try:
+            inst = self._factories[name]()
+        except Exception as e:
+            self._stats[name] = {"loaded": False, "error": repr(e)}
+            raise
+        # при параллельной загрузке нескольких моделей прирост RSS — приблизительный
+        self._stats[name] = {
+            "loaded": True,
+            "load_seconds": round(time.perf_counter() - start, 3),
+            "rss_delta_mb": round(max(_rss_bytes() - rss_before, 0) / 2**20, 1),
+            "loaded_at": time.time(),
+        }
+        self._instances[name] = inst
+        return inst
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._instances
+
+    def warmup(self, names: Optional[Iterable[str]] = None, background: bool = True) -> Optional[threading.Thread]:
+        """Заранее загрузить ресурсы (по умолчанию все) — в фоновом потоке или синхронно"""
+        names = list(names) if names is not None else list(self._factories)
+
+        def _run():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception:
+                    # ошибка сохранена в stats; get() при запросе повторит попытку
+                    pass
+
+        if not background:
+            _run()
+            return None
+        thread = threading.Thread(target=_run, name="model-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Время загрузки и прирост памяти по каждому ресурсу"""
+        models = {name: dict(st) for name, st in self._stats.items()}
+        return {"models": models, "rss_mb": round(_rss_bytes() / 2**20, 1)}
+
+
+# Единый реестр процесса
+registry = ModelRegistry()
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from app.pipeline import load_prompt
+from app.security import ATTACK_CATEGORIES, filter_prompt
+
+CATALOG_CHECK_SECONDS = float(os.getenv("CATALOG_CHECK_SECONDS", "1"))   # как часто сверять mtime файлов
+
+_CATEGORY_OF = {p: cat for cat, pats in ATTACK_CATEGORIES.items() for p in pats}
+
+
+def _matches(text: str) -> Dict[str, Dict[str, List[str]]]:
+    """Паттерны атак, найденные в тексте, по категориям ATTACK_CATEGORIES"""
+    _, exact, fuzzy = filter_prompt(text)
+    out: Dict[str, Dict[str, List[str]]] = {}
+    for kind, found in (("exact", exact), ("fuzzy", fuzzy)):
+        for pattern in found:
+            out.setdefault(_CATEGORY_OF.get(pattern, "other"), {"exact": [], "fuzzy": []})[kind].append(pattern)
+    return out
+
+
+class ScenarioCatalog:
+    """
+    Каталог сценариев атак в памяти: для каждого файла из attack_files —
+    описание из attack_scenarios.json, разобранный текст, размер и найденные
+    паттерны атак по категориям. Перестраивается, только когда меняются mtime
+    файлов или JSON (сверка не чаще раза в CATALOG_CHECK_SECONDS), причём
+    заново разбираются лишь изменившиеся файлы. listing() и etag отдаются
+    из памяти — для дешёвого опроса UI с If-None-Match.
+    """
+
+    def __init__(self, attack_dir: str, scenarios_file: str):
+        self.attack_dir = attack_dir
+        self.scenarios_file = scenarios_file
+        self._entries: Dict[str, Dict[str, Any]] = {}        # файл -> запись каталога
+        self._stamps: Dict[str, Tuple[float, int]] = {}      # файл -> (mtime, размер)
+        self._scenarios: Dict[str, Any] = {}
+        self._signature = None
+        self._checked = 0.0
+        self._listing: List[Dict[str, Any]] = []
+        self.etag = ""
+        self._lock = threading.Lock()
+
+    def _stat(self) -> Dict[str, Tuple[float, int]]:
+        stamps = {}
+        if os.path.isdir(self.attack_dir):
+            for entry in os.scandir(self.attack_dir):
+                if entry.is_file():
+                    st = entry.stat()
+                    stamps[entry.name] = (st.st_mtime, st.st_size)
+        return stamps
+
+    def _load_scenarios(self) -> Tuple[Optional[float], Dict[str, Any]]:
+        if not os.path.exists(self.scenarios_file):
+            return None, {}
+        mtime = os.path.getmtime(self.scenarios_file)
+        if self._signature is not None and mtime == self._signature[0]:
+            return mtime, self._scenarios
+        with open(self.scenarios_file, encoding="utf-8") as f:
+            return mtime, json.load(f)
+
+    def _entry(self, name: str, size: int) -> Dict[str, Any]:
+        try:
+            text = load_prompt({"attack_file": name}, self.attack_dir)
+            error = None
+        except HTTPException as e:
+            text, error = None, str(e.detail)
+        return {
+            "file": name,
+            "size": size,
+            "chars": len(text) if text is not None else 0,
+            "text": text,
+            "matches": _matches(text) if text else {},
+            "error": error,
+        }
+
+    def refresh(self, force: bool = False) -> bool:
+        """Сверить mtime и при изменениях перестроить каталог; True — каталог изменился"""
+        now = time.monotonic()
+        if not force and now - self._checked < CATALOG_CHECK_SECONDS:
+            return False
+        with self._lock:
+            self._checked = now
+            stamps = self._stat()
+            json_mtime, scenarios = self._load_scenarios()
+            signature = (json_mtime, tuple(sorted(stamps.items())))
+            if signature == self._signature:
+                return False
+            entries = {}
+            for name, stamp in sorted(stamps.items()):
+                same = self._stamps.get(name) == stamp and name in self._entries
+                entries[name] = self._entries[name] if same else self._entry(name, stamp[1])
+            self._entries, self._stamps, self._scenarios = entries, stamps, scenarios
+            self._signature = signature
+            self._listing = [
+                {
+                    "file": name,
+                    "name": scenarios.get(name, {}).get("name", name),
+                    "scenario": scenarios.get(name, {}).get("scenario", ""),
+                    "size": entry["size"],
+                    "matches": entry["matches"],
+                }
+                for name, entry in entries.items()
+            ]
+            self.etag = '"%s"' % hashlib.sha256(repr(signature).encode()).hexdigest()[:32]
+            return True
+
+    def listing(self) -> List[Dict[str, Any]]:
+        """Файлы атак с описанием сценария, размером и найденными паттернами"""
+        self.refresh()
+        return self._listing
+
+    def text(self, name: str) -> Optional[str]:
+        """Разобранный текст файла атаки (None — файла нет или формат не поддерживается)"""
+        self.refresh()
+        entry = self._entries.get(name)
+        return entry["text"] if entry else None
+
+    def default_files(self) -> List[str]:
+        """Файлы атак из attack_scenarios.json, которые есть на диске"""
+        self.refresh()
+        return [name for name in self._scenarios if name in self._entries]
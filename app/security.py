@@ -1,8 +1,10 @@
-import re
+import os
 import unicodedata
-from rapidfuzz import fuzz
 from typing import Tuple, List, Dict
 
+from app.matcher import PatternMatcher
+from app.redaction import RedactionEngine, Rule, ScanResult, load_rules
+
 # =================== КАТЕГОРИИ И ПАТТЕРНЫ АТАК =====================
 ATTACK_CATEGORIES = {
     "jailbreak": [
@@ -65,6 +67,8 @@ ATTACK_CATEGORIES = {
 # Собираем все паттерны
 _BASE_PATTERNS = sum(ATTACK_CATEGORIES.values(), [])
 _PATTERNS_NORM = [unicodedata.normalize("NFKC", p).lower() for p in _BASE_PATTERNS]
+# Предкомпилированный движок поиска (Aho–Corasick + отсечение fuzzy-кандидатов)
+_MATCHER = PatternMatcher(_BASE_PATTERNS)
 
 def _normalize(text: str) -> str:
     return unicodedata.normalize("NFKC", text).lower()
@@ -73,33 +77,34 @@ def filter_prompt(text: str, fuzzy_threshold: int = 75) -> Tuple[str, List[str],
     """
     Фильтрация текста: возвращает (отфильтрованный текст, точные совпадения, нечёткие совпадения)
     """
-    norm_txt = _normalize(text)
-    exact, fuzzy = [], []
-    for pat, norm_pat in zip(_BASE_PATTERNS, _PATTERNS_NORM):
-        if norm_pat in norm_txt:
-            exact.append(pat)
-        elif fuzz.partial_ratio(norm_pat, norm_txt) >= fuzzy_threshold:
-            fuzzy.append(pat)
     # Редактируем только точные совпадения для безопасности (можно расширить под fuzzy)
-    pattern = re.compile("|".join(map(re.escape, _BASE_PATTERNS)), flags=re.IGNORECASE)
-    redacted = pattern.sub("[REDACTED]", text)
-    return redacted, exact, fuzzy
+    return _MATCHER.scan(text, fuzzy_threshold)
+
+# Правила санитизации: собираются в один regex, при совпадении в одной позиции
+# побеждает правило, стоящее раньше
+_SANITIZE_RULES = [
+    Rule("secret", r"\b(?:password|admin_password|superuser_password|secret_key):?\s*\S+\b",
+         ignore_case=True, hints=("password", "secret_key")),
+    Rule("email", r"\b[\w\.-]+@[\w\.-]+\.\w+\b", flag="contains_email", hints=("@",)),
+    Rule("url", r"https?://\S+", flag="contains_url", hints=("://",)),
+    Rule("ip", r"\b\d{1,3}(?:\.\d{1,3}){3}\b", flag="contains_ip"),
+    Rule("sk_live", r"sk_live_[0-9A-Za-z]+", hints=("sk_live_",)),
+]
+# Дополнительные правила пользователя (JSON-файл), добавляются после встроенных
+if os.getenv("SANITIZE_RULES_FILE"):
+    _SANITIZE_RULES += load_rules(os.environ["SANITIZE_RULES_FILE"])
+SANITIZER = RedactionEngine(_SANITIZE_RULES)
+
+def sanitize_scan(text: str, redact: bool = True) -> ScanResult:
+    """Один проход: (отредактированный текст, срабатывания правил со смещениями, flags)"""
+    return SANITIZER.scan(text, redact)
 
 def sanitize_answer(text: str) -> str:
     # Скрыть e-mail, URL, IP, токены
-    text = re.sub(r"\b(?:password|admin_password|superuser_password|secret_key):?\s*\S+\b", "[REDACTED]", text, flags=re.IGNORECASE)
-    text = re.sub(r"\b[\w\.-]+@[\w\.-]+\.\w+\b", "[REDACTED]", text)
-    text = re.sub(r"https?://\S+", "[REDACTED]", text)
-    text = re.sub(r"\b\d{1,3}(?:\.\d{1,3}){3}\b", "[REDACTED]", text)
-    text = re.sub(r"sk_live_[0-9A-Za-z]+", "[REDACTED]", text)
-    return text
+    return SANITIZER.scan(text).text
 
 def sanity_check(text: str) -> Dict[str, bool]:
-    return {
-        "contains_email": bool(re.search(r"\b[\w\.-]+@[\w\.-]+\.\w+\b", text)),
-        "contains_url": bool(re.search(r"https?://\S+", text)),
-        "contains_ip": bool(re.search(r"\b\d{1,3}(?:\.\d{1,3}){3}\b", text)),
-    }
+    return SANITIZER.scan(text, redact=False).flags
 
 def isolate_context(raw: str) -> str:
     sensitive_patterns = ["password", "admin_password", "superuser_password", "secret_key"]
@@ -109,6 +114,78 @@ def isolate_context(raw: str) -> str:
             lines.append(line)
     return "\n".join(lines).strip()
 
+def _run_start(text: str, end: int) -> int:
+    """Начало непробельного участка, который заканчивается в позиции end"""
+    while end > 0 and not text[end - 1].isspace():
+        end -= 1
+    return end
+
+# Самый длинный участок без пробелов, который StreamSanitizer придерживает целиком
+STREAM_MAX_RUN = int(os.getenv("STREAM_MAX_RUN", "4096"))
+
+class StreamSanitizer:
+    """
+    Инкрементальные защиты для потока токенов: редактирование точных паттернов
+    (filter) и sanitize_answer. Последние lookback символов придерживаются,
+    пока не станет ясно, что совпадение через границу не пройдёт; если
+    найденное совпадение пересекает точку выдачи, выдача откатывается к его началу.
+    Выдача режется только по пробельным символам: непробельный участок
+    придерживается целиком (замены санитайзера внутри него цепляются друг
+    за друга), поэтому результат совпадает с обработкой всего текста сразу.
+    Исключение — участки длиннее max_run (STREAM_MAX_RUN): такой участок
+    режется, и на его границе редактирование может отличаться от целого текста.
+    """
+
+    def __init__(self, defenses: List[str], lookback: int = 64, max_run: int = STREAM_MAX_RUN):
+        self.use_filter = "filter" in defenses
+        self.use_sanitize = "sanitize" in defenses
+        self.lookback = max(lookback, _MATCHER.max_pattern_len)
+        self.max_run = max(max_run, self.lookback)
+        self._rules = ([_MATCHER.regex] if self.use_filter else []) + (SANITIZER.patterns if self.use_sanitize else [])
+        self._pending = ""
+
+    def _apply(self, text: str) -> str:
+        if self.use_filter:
+            text = _MATCHER.redact(text)
+        if self.use_sanitize:
+            text = sanitize_answer(text)
+        return text
+
+    def feed(self, token: str) -> str:
+        """Добавить токен; вернуть текст, который уже безопасно отдать клиенту"""
+        if not self._rules:
+            return token
+        self._pending += token
+        cut = len(self._pending) - self.lookback
+        moved = True
+        while moved and cut > 0:
+            moved = False
+            # не резать посреди слова: граница куска сама создала бы \b для правил
+            # (участок без пробелов длиннее max_run всё же режется)
+            run = _run_start(self._pending, cut)
+            if run < cut and cut - run <= self.max_run:
+                cut, moved = run, True
+            for rule in self._rules:
+                for m in rule.finditer(self._pending):
+                    if m.start() < cut < m.end():
+                        cut, moved = m.start(), True
+                    elif m.start() >= cut:
+                        # замена меняет границы слов слева от себя (повторный проход
+                        # санитайзера, напр. «1.2.3.4sk_live_…»): держим и примыкающий текст
+                        run = _run_start(self._pending, m.start())
+                        if run < cut:
+                            cut, moved = run, True
+                        break
+        if cut <= 0:
+            return ""
+        ready, self._pending = self._pending[:cut], self._pending[cut:]
+        return self._apply(ready)
+
+    def flush(self) -> str:
+        """Конец потока: отдать остаток"""
+        ready, self._pending = self._pending, ""
+        return self._apply(ready) if ready else ""
+
 def all_attack_patterns() -> List[str]:
     """Получить все паттерны атак — для тестов или анализа"""
     return list(_BASE_PATTERNS)
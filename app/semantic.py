@@ -0,0 +1,70 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+SEMANTIC_THRESHOLD = float(os.getenv("SEMANTIC_THRESHOLD", "0.65"))   # косинус, с которого чанк — атака
+SEMANTIC_CACHE_SIZE = 4096                                              # оценок текстов в LRU
+
+
+def _normalized(vectors) -> np.ndarray:
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class SemanticDetector:
+    """
+    Классификатор инъекций по эмбеддингам: все фразы ATTACK_CATEGORIES один раз
+    превращаются в нормированную матрицу паттернов (n × d). Пачка текстов
+    оценивается одним batch-эмбеддингом и одним умножением матриц: для каждого
+    текста — ближайшая фраза, её категория и косинусная близость.
+    В отличие от partial_ratio, ловит перефразировки, а цена на текст почти не
+    зависит от числа паттернов.
+    """
+
+    def __init__(self, embedder: Embeddings, categories: Dict[str, List[str]],
+                 threshold: float = SEMANTIC_THRESHOLD):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.patterns = [p for pats in categories.values() for p in pats]
+        self.labels = [cat for cat, pats in categories.items() for _ in pats]
+        self._matrix = _normalized(embedder.embed_documents(self.patterns)).T   # d × n
+        self._cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _result(self, scores: np.ndarray) -> Dict[str, Any]:
+        best = int(scores.argmax())
+        score = float(scores[best])
+        return {
+            "category": self.labels[best],
+            "pattern": self.patterns[best],
+            "score": round(score, 4),
+            "flagged": score >= self.threshold,
+        }
+
+    def score(self, texts: List[str]) -> List[Dict[str, Any]]:
+        """Для каждого текста: {category, pattern, score, flagged}"""
+        with self._lock:
+            known = {t: self._cache[t] for t in texts if t in self._cache}
+            for t in known:
+                self._cache.move_to_end(t)
+        missing = list(dict.fromkeys(t for t in texts if t not in known))
+        if missing:
+            scores = _normalized(self.embedder.embed_documents(missing)) @ self._matrix
+            fresh = {t: self._result(row) for t, row in zip(missing, scores)}
+            known.update(fresh)
+            with self._lock:
+                self._cache.update(fresh)
+                while len(self._cache) > SEMANTIC_CACHE_SIZE:
+                    self._cache.popitem(last=False)
+        return [dict(known[t]) for t in texts]
+
+    def score_query(self, text: str) -> Dict[str, Any]:
+        """Оценка prompt: эмбеддинг запроса уже посчитан retrieval и берётся из кэша сервиса"""
+        scores = _normalized([self.embedder.embed_query(text)])[0] @ self._matrix
+        return self._result(scores)
@@ -0,0 +1,115 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class DocumentStore:
+    """
+    Постоянный реестр документов в SQLite: doc_id, имя файла, размер текста,
+    метаданные и время загрузки (порядок загрузки сохраняется).
+    Сам текст хранится чанками вместе с эмбеддингами в Chroma (persist_directory),
+    частоты термов чанков для BM25 — здесь же (таблица terms),
+    поэтому при рестарте ничего не пересчитывается.
+    path=None — база в памяти (как раньше: всё теряется при перезапуске).
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path or ":memory:"
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            if path:
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " doc_id TEXT UNIQUE NOT NULL,"
+                " filename TEXT NOT NULL DEFAULT '',"
+                " size INTEGER NOT NULL DEFAULT 0,"
+                " meta TEXT NOT NULL DEFAULT '{}',"
+                " uploaded_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS terms ("
+                " chunk_id TEXT PRIMARY KEY,"
+                " doc_id TEXT NOT NULL,"
+                " tf TEXT NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS terms_doc_id ON terms (doc_id)")
+
+    def add(self, doc_id: str, filename: str, size: int, meta: Optional[Dict[str, Any]] = None,
+            uploaded_at: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Записать документ; возвращает запись в формате DOCS.
+        uploaded_at — время загрузки, уже записанное в метаданные чанков
+        (по нему фильтрует retrieval); без него — текущее.
+        """
+        if uploaded_at is None:
+            uploaded_at = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO documents (doc_id, filename, size, meta, uploaded_at) VALUES (?, ?, ?, ?, ?)",
+                (doc_id, filename or "", size, json.dumps(meta or {}, ensure_ascii=False), uploaded_at),
+            )
+        return {"size": size, "meta": meta or {}, "filename": filename, "uploaded_at": uploaded_at}
+
+    def remove(self, doc_id: str) -> bool:
+        with self._lock, self._conn:
+            return self._conn.execute("DELETE FROM documents WHERE doc_id = ?", (doc_id,)).rowcount > 0
+
+    def all(self) -> List[Tuple[str, Dict[str, Any]]]:
+        """Все документы в порядке загрузки: [(doc_id, запись DOCS), ...]"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT doc_id, filename, size, meta, uploaded_at FROM documents ORDER BY seq"
+            ).fetchall()
+        return [
+            (doc_id, {"size": size, "meta": json.loads(meta), "filename": filename, "uploaded_at": uploaded_at})
+            for doc_id, filename, size, meta, uploaded_at in rows
+        ]
+
+    def save_terms(self, rows: List[Tuple[str, str, Dict[str, int]]]):
+        """Частоты термов чанков BM25: [(id чанка, doc_id, {терм: tf}), ...]"""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO terms (chunk_id, doc_id, tf) VALUES (?, ?, ?)",
+                [(chunk_id, doc_id or "", json.dumps(tf, ensure_ascii=False)) for chunk_id, doc_id, tf in rows],
+            )
+
+    def load_terms(self) -> Dict[str, Counter]:
+        """Все сохранённые частоты термов: id чанка -> Counter"""
+        with self._lock:
+            rows = self._conn.execute("SELECT chunk_id, tf FROM terms").fetchall()
+        return {chunk_id: Counter(json.loads(tf)) for chunk_id, tf in rows}
+
+    def remove_terms(self, doc_ids: Optional[List[str]] = None, chunk_ids: Optional[List[str]] = None):
+        """Удалить частоты термов документов или чанков; без аргументов — все"""
+        with self._lock, self._conn:
+            if doc_ids is None and chunk_ids is None:
+                self._conn.execute("DELETE FROM terms")
+            if doc_ids:
+                self._conn.executemany("DELETE FROM terms WHERE doc_id = ?", [(d,) for d in doc_ids])
+            if chunk_ids:
+                self._conn.executemany("DELETE FROM terms WHERE chunk_id = ?", [(c,) for c in chunk_ids])
+
+    def get_setting(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_setting(self, key: str, value: str):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
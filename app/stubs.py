@@ -0,0 +1,95 @@
+"""
+Локальные заменители тяжёлых моделей — для бенчмарков и разработки без
+mistral-7b.gguf и sentence-transformers:
+    LLM_BACKEND=stub      — StubLLM вместо LlamaCpp
+    EMBED_BACKEND=hashing — HashingEmbeddings вместо HuggingFaceEmbeddings
+Оба детерминированы: одинаковый вход даёт одинаковый выход.
+"""
+import hashlib
+import math
+import os
+import re
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+STUB_LLM_LATENCY_MS = float(os.getenv("STUB_LLM_LATENCY_MS", "50"))        # до первого токена
+STUB_LLM_TOKENS_PER_SEC = float(os.getenv("STUB_LLM_TOKENS_PER_SEC", "0"))  # 0 — без задержки на токены
+STUB_LLM_MAX_TOKENS = int(os.getenv("STUB_LLM_MAX_TOKENS", "64"))
+_WORD = re.compile(r"\S+")
+
+
+class StubLLM(LLM):
+    """
+    Детерминированная «модель»: ответ — слова из prompt (в т.ч. из контекста,
+    так что защиты ответа работают на реалистичном тексте), выбранные по хэшу
+    prompt. latency_ms — задержка до первого токена, tokens_per_second —
+    скорость выдачи (0 — мгновенно). Токен = слово с пробелом.
+    """
+
+    latency_ms: float = STUB_LLM_LATENCY_MS
+    tokens_per_second: float = STUB_LLM_TOKENS_PER_SEC
+    max_tokens: int = STUB_LLM_MAX_TOKENS
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"latency_ms": self.latency_ms, "tokens_per_second": self.tokens_per_second,
+                "max_tokens": self.max_tokens}
+
+    def _tokens(self, prompt: str, max_tokens: Optional[int] = None) -> List[str]:
+        words = _WORD.findall(prompt) or ["Нет", "информации"]
+        seed = int.from_bytes(hashlib.blake2b(prompt.encode("utf-8", "surrogatepass"), digest_size=8).digest(), "big")
+        start = seed % len(words)
+        limit = min(max_tokens or self.max_tokens, self.max_tokens)
+        return [words[(start + i) % len(words)] + " " for i in range(min(limit, len(words)))]
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[GenerationChunk]:
+        if self.latency_ms > 0:
+            time.sleep(self.latency_ms / 1000)
+        delay = 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+        # max_tokens из профиля генерации (app.generation) — не больше своего лимита
+        for token in self._tokens(prompt, kwargs.get("max_tokens")):
+            if delay:
+                time.sleep(delay)
+            chunk = GenerationChunk(text=token)
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        return "".join(chunk.text for chunk in self._stream(prompt, stop, run_manager, **kwargs))
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Эмбеддинги хэшированием слов (feature hashing) в вектор размерности size,
+    нормированный по L2: без модели, микросекунды на текст, и тексты с общими
+    словами близки по косинусу — retrieval ведёт себя осмысленно.
+    """
+
+    def __init__(self, size: int = 384):
+        self.size = size
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.size
+        for word in _WORD.findall(text.lower()):
+            h = int.from_bytes(hashlib.blake2b(word.encode("utf-8", "surrogatepass"), digest_size=8).digest(), "big")
+            vector[h % self.size] += 1.0 if (h >> 32) & 1 else -1.0
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
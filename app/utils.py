@@ -1,3 +1,5 @@
+import re
+from functools import lru_cache
 from typing import Any, List
 
 def to_text(resp: Any) -> str:
@@ -35,6 +37,16 @@ CYRILLIC_LATIN_PAIRS = {
     'н': 'h', 'Н': 'H'
 }
 
+# Прочие «двойники» латиницы (греческие, расширенная кириллица, полноширинные буквы):
+# в словах вместе с латиницей считаются подменой так же, как кириллица
+CONFUSABLES = frozenset(
+    'ΑΒΕΖΗΙΚΜΝΟΡΤΥΧαικνορτυχ'      # греческий
+    'ЅЈԀԚԜӀҮҺѕјԁԛԝӏүһ'             # кириллица за пределами а-я
+    'օոսցհ'                         # армянский
+    + ''.join(chr(c) for c in range(0xFF21, 0xFF3B))   # Ａ-Ｚ
+    + ''.join(chr(c) for c in range(0xFF41, 0xFF5B))   # ａ-ｚ
+)
+
 def is_obfuscated(text: str, min_length: int = 6) -> bool:
     """
     True, если в тексте найдены слова с смешанными кириллицей и латиницей,
@@ -43,21 +55,58 @@ def is_obfuscated(text: str, min_length: int = 6) -> bool:
     obf = find_obfuscated_fragments(text, min_length)
     return bool(obf)
 
+# Классы символов для find_obfuscated_fragments: биты «кириллица», «латиница», «буква-замена»
+_CYR, _LAT, _PAIR = 1, 2, 4
+_PAIR_VALUES = frozenset(CYRILLIC_LATIN_PAIRS.values())
+
+
+def _class_code(bits: int) -> str:
+    return chr(ord("A") + bits)
+
+
+def _code_class(flag: int) -> str:
+    return "[" + "".join(_class_code(b) for b in range(8) if b & flag) + "]"
+
+
+class _ScriptTable(dict):
+    """
+    Таблица для str.translate: символ -> код класса (набор битов _CYR/_LAT/_PAIR).
+    Коды считаются лениво при первой встрече символа и запоминаются.
+    """
+
+    def __missing__(self, code: int) -> str:
+        ch = chr(code)
+        bits = 0
+        if 'а' <= ch.lower() <= 'я' or ch in CYRILLIC_LATIN_PAIRS or ch in CONFUSABLES:
+            bits |= _CYR
+        if 'a' <= ch.lower() <= 'z' or ch in _PAIR_VALUES:
+            bits |= _LAT
+        if ch in CYRILLIC_LATIN_PAIRS or ch in _PAIR_VALUES:
+            bits |= _PAIR
+        value = self[code] = _class_code(bits)
+        return value
+
+
+_SCRIPT_TABLE = _ScriptTable()
+
+# По строке кодов слова: есть и кириллица, и латиница — или 2+ буквы-замены
+_SUSPICIOUS = re.compile(
+    "{c}.*{l}|{l}.*{c}|{p}.*{p}".format(c=_code_class(_CYR), l=_code_class(_LAT), p=_code_class(_PAIR))
+)
+
+
+@lru_cache(maxsize=8)
+def _words_re(min_length: int):
+    return re.compile(r'\w{' + str(min_length) + ',}')
+
+
 def find_obfuscated_fragments(text: str, min_length: int = 6) -> List[str]:
     """
-    Находит все слова в тексте, которые выглядят как смесь латиницы и кириллицы,
-    либо содержат похожие буквы-замены из карты CYRILLIC_LATIN_PAIRS.
-    """
-    import re
-    results = []
-    words = re.findall(r'\w{' + str(min_length) + ',}', text)
-    for w in words:
-        cyr = sum('а' <= ch.lower() <= 'я' or ch in CYRILLIC_LATIN_PAIRS for ch in w)
-        lat = sum('a' <= ch.lower() <= 'z' or ch in CYRILLIC_LATIN_PAIRS.values() for ch in w)
-        if cyr > 0 and lat > 0:
-            results.append(w)
-        # эвристика: буквы-замены встречаются 2+ раза
-        pair_count = sum(1 for ch in w if ch in CYRILLIC_LATIN_PAIRS or ch in CYRILLIC_LATIN_PAIRS.values())
-        if pair_count >= 2:
-            results.append(w)
-    return list(set(results))
+    Находит все слова в тексте, которые выглядят как смесь латиницы и кириллицы
+    (или других двойников латиницы из CONFUSABLES),
+    либо содержат 2+ похожие буквы-замены из карты CYRILLIC_LATIN_PAIRS.
+    Каждое уникальное слово проверяется один раз: str.translate в коды классов
+    и одно регулярное выражение, без посимвольных циклов в Python.
+    """
+    words = set(_words_re(min_length).findall(text))
+    return [w for w in words if _SUSPICIOUS.search(w.translate(_SCRIPT_TABLE))]
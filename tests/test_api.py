@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.requests import ClientDisconnect
+
+from app import generation, main, rag
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # заглушки вместо LLM и эмбеддера (app.stubs), данные — во временном каталоге
+    monkeypatch.setattr(rag, "LLM_BACKEND", "stub")
+    monkeypatch.setattr(rag, "EMBED_BACKEND", "hashing")
+    monkeypatch.setattr(rag, "EMBED_ID", "hashing")
+    monkeypatch.setattr(main, "RAG_DATA_DIR", str(tmp_path))
+    with TestClient(main.app) as c:
+        yield c
+
+
+def test_uploaded_after_listed_time_includes_the_doc(client):
+    text = "квартальный отчёт zebra quartz marker"
+    doc_id = client.post("/upload", files={"file": ("report.txt", text.encode())}).json()["doc_id"]
+    listed = next(d for d in client.get("/docs").json() if d["doc_id"] == doc_id)
+
+    out = client.post("/query", json={"prompt": "zebra quartz marker",
+                                      "filters": {"uploaded_after": listed["uploaded_at"]}}).json()
+    assert "zebra quartz marker" in out["raw_context"]
+
+    out = client.post("/query", json={"prompt": "zebra quartz marker",
+                                      "filters": {"uploaded_before": listed["uploaded_at"]}}).json()
+    assert "zebra quartz marker" in out["raw_context"]
+
+
+@pytest.mark.parametrize("path", ["/attack_files", "/docs"])
+def test_listing_answers_conditional_get_with_304(client, path):
+    first = client.get(path)
+    assert first.status_code == 200
+    assert first.headers["content-type"].startswith("application/json")
+    etag = first.headers["ETag"]
+
+    again = client.get(path, headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.headers["ETag"] == etag
+    assert client.get(path, headers={"If-None-Match": '"stale"'}).status_code == 200
+
+
+def test_docs_etag_changes_after_upload(client):
+    etag = client.get("/docs").headers["ETag"]
+    client.post("/upload", files={"file": ("note.txt", b"plain note")})
+    assert client.get("/docs", headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_stream_is_released_when_client_leaves_before_first_event():
+    released, started = [], []
+
+    async def events():
+        started.append(True)
+        yield "event: token\n\n"
+
+    async def send(message):
+        raise OSError("client gone")
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    response = main._ReleasingStream(events(), lambda: released.append(True))
+    with pytest.raises(ClientDisconnect):
+        asyncio.run(response({"type": "http", "asgi": {"spec_version": "2.4"}}, receive, send))
+    assert not started and released == [True]
+
+
+def test_query_stream_sends_tokens_and_done(client):
+    body = client.post("/query/stream", json={"prompt": "hello"}).text
+    assert "event: token" in body and "event: done" in body
+
+
+def test_bulk_upload_over_total_limit_is_rejected_while_reading(client, monkeypatch):
+    # лимит проверяется при чтении файлов, а не только по Content-Length в middleware
+    monkeypatch.setattr(main, "MAX_BULK_UPLOAD_BYTES", 100)
+    files = [("files", (f"{i}.txt", b"a" * 60)) for i in range(2)]
+    response = client.post("/upload/bulk", files=files)
+    assert response.status_code == 413
+    assert all(d["filename"] not in ("0.txt", "1.txt") for d in client.get("/docs").json())
+
+
+def test_response_cache_is_not_shared_between_request_classes(client, monkeypatch):
+    profiles = {**generation.PROFILES,
+                "stream": {**generation.PROFILES["query"], "max_tokens": 16, "temperature": 0.0}}
+    monkeypatch.setattr(generation, "PROFILES", profiles)
+    prompt = {"prompt": "profile bound cache probe"}
+    assert client.post("/query", json=prompt).json()["cached"] is False
+    assert client.post("/query", json=prompt).json()["cached"] is True
+
+    # у stream другой профиль выборки — ответ query ему не подходит
+    assert '"cached": false' in client.post("/query/stream", json=prompt).text
+    assert '"cached": true' in client.post("/query/stream", json=prompt).text
@@ -0,0 +1,37 @@
+import random
+
+from app.chunking import CHUNK_SIZE, STREAM_WINDOW, split_stream, split_text
+
+_WORDS = "alpha beta gamma delta epsilon длинноеслово x".split()
+
+
+def _segments(seed: int, count: int):
+    rng = random.Random(seed)
+    return [
+        " ".join(rng.choice(_WORDS) for _ in range(rng.randint(20, 200))) + rng.choice(["\n\n", "\n", ". ", " ", ""])
+        for _ in range(count)
+    ]
+
+
+def test_short_text_matches_split_text():
+    segments = _segments(0, 10)
+    text = "".join(segments)
+    assert len(text) < STREAM_WINDOW
+    assert list(split_stream(segments)) == split_text(text)
+
+
+def test_multi_window_chunks_cover_text_with_true_offsets():
+    for seed in range(20):
+        segments = _segments(seed, 300)
+        text = "".join(segments)
+        assert len(text) > 2 * STREAM_WINDOW
+        chunks = list(split_stream(segments))
+        covered = 0
+        for offset, chunk in chunks:
+            assert text[offset:offset + len(chunk)] == chunk
+            assert len(chunk) <= CHUNK_SIZE
+            # между чанками нет пропущенного текста (кроме пробельных разделителей)
+            assert not text[covered:offset].strip()
+            covered = max(covered, offset + len(chunk))
+        assert not text[covered:].strip()
+        assert [o for o, _ in chunks] == sorted(o for o, _ in chunks)
@@ -0,0 +1,51 @@
+import asyncio
+import threading
+
+import pytest
+
+from app.inference import InferenceExecutor, QueueFullError
+
+
+def test_cancelled_queued_jobs_release_queue_slots():
+    executor = InferenceExecutor(max_workers=1, max_queue=2)
+    release = threading.Event()
+
+    async def scenario():
+        busy = executor.submit(release.wait)
+        queued = [asyncio.ensure_future(executor.run(lambda: None)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        with pytest.raises(QueueFullError):
+            executor.submit(lambda: None)
+        for task in queued:
+            task.cancel()
+        await asyncio.gather(*queued, return_exceptions=True)
+        release.set()
+        await busy
+
+    asyncio.run(scenario())
+    stats = executor.stats()
+    assert stats["queue_depth"] == 0
+    assert stats["running"] == 0
+    assert stats["cancelled"] == 2
+    assert stats["completed"] == 1
+
+
+def test_batch_work_does_not_fill_interactive_queue():
+    executor = InferenceExecutor(max_workers=1, max_queue=1, max_batch=1)
+    release = threading.Event()
+    sweep = [threading.Thread(target=executor.execute, args=(release.wait,)) for _ in range(4)]
+    for t in sweep:
+        t.start()
+
+    async def scenario():
+        await asyncio.sleep(0.05)
+        assert executor.stats()["batch"] == 1
+        # интерактивный запрос принимается, хотя прогон ждёт своей очереди
+        queued = executor.submit(lambda: "ok")
+        release.set()
+        return await queued
+
+    assert asyncio.run(scenario()) == "ok"
+    for t in sweep:
+        t.join()
+    assert executor.stats()["queue_depth"] == 0
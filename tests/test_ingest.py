@@ -0,0 +1,22 @@
+import os
+
+from app import ingest
+
+
+def _crashing_job(ext, content):
+    if content.startswith(b"crash"):
+        os._exit(1)
+    return {"text": content.decode(), "meta": "", "obfuscated": [], "meta_obfuscated": []}, None
+
+
+def test_crashed_parse_worker_fails_only_its_file(monkeypatch):
+    monkeypatch.setattr(ingest, "_parse_job", _crashing_job)
+    items = [(f"doc{i}.txt", f"text {i}".encode()) for i in range(4)] + [("bad.txt", b"crash")]
+
+    first = ingest.parse_many(items, workers=2)
+    assert [item["error"] for item in first] == [None] * 4 + [ingest.CRASHED_ERROR]
+    assert [item["parsed"]["text"] for item in first[:4]] == [f"text {i}" for i in range(4)]
+
+    # сломанный пул не остаётся в кэше: следующая пачка разбирается
+    second = ingest.parse_many([(f"new{i}.txt", f"more {i}".encode()) for i in range(3)], workers=2)
+    assert [item["error"] for item in second] == [None] * 3
@@ -0,0 +1,78 @@
+from app.index import DocumentIndex
+from app.lexical import BM25Index, Lemmatizer
+from app.store import DocumentStore
+from app.stubs import HashingEmbeddings
+
+
+class CountingLemmatizer(Lemmatizer):
+    def __init__(self):
+        super().__init__({})
+        self.calls = 0
+
+    def terms(self, text):
+        self.calls += 1
+        return super().terms(text)
+
+
+def _open(path):
+    store = DocumentStore(str(path / "documents.sqlite3"))
+    lexical = BM25Index(CountingLemmatizer(), store=store)
+    index = DocumentIndex(HashingEmbeddings(), persist_directory=str(path / "chroma"), lexical=lexical)
+    return index, lexical
+
+
+def test_reopened_index_restores_bm25_without_lemmatizing(tmp_path):
+    index, lexical = _open(tmp_path)
+    index.add("doc", "quarterly invoice for the backup server\n\n" + "secret_key rotation policy " * 40,
+              {"filename": "a.txt"})
+    index.add("gone", "temporary document", {"filename": "b.txt"})
+    index.remove("gone")
+    chunks = len(lexical)
+
+    index, lexical = _open(tmp_path)
+    assert not lexical.ready.is_set()
+    assert index.rebuild_lexical() == chunks
+    assert lexical.lemmatizer.calls == 0
+    assert lexical.ready.is_set()
+    found = lexical.search("invoice", k=1)
+    assert found and found[0][0].metadata["doc_id"] == "doc"
+    assert not lexical.search("temporary", k=1)
+
+
+def test_chunks_are_lemmatized_outside_the_index_lock(tmp_path):
+    index, lexical = _open(tmp_path)
+    held = []
+    terms = lexical.lemmatizer.terms
+    lexical.lemmatizer.terms = lambda text: held.append(index._lock.locked()) or terms(text)
+
+    index.add("doc", "quarterly invoice for the backup server", {"filename": "a.txt"})
+    index.add_many([("bulk", "monthly report on the mail server", {"filename": "b.txt"})])
+    assert held and not any(held)
+    assert lexical.search("invoice", k=1) and lexical.search("monthly", k=1)
+
+
+def test_rebuild_does_not_hold_the_index_lock(tmp_path):
+    index, lexical = _open(tmp_path)
+    index.add("doc", "quarterly invoice for the backup server", {"filename": "a.txt"})
+    index.add("gone", "temporary document", {"filename": "b.txt"})
+
+    index, lexical = _open(tmp_path)
+    lexical.store.remove_terms()   # при сборке лемматизировать придётся всё
+    held, changed = [], []
+    terms = lexical.lemmatizer.terms
+
+    def _terms(text):
+        held.append(index._lock.locked())
+        if not changed:
+            # запись посреди сборки: она не ждёт конца сборки, а сборка её не затирает
+            changed.append(True)
+            index.remove("gone")
+            index.add("new", "fresh memo about the parking lot", {"filename": "c.txt"})
+        return terms(text)
+
+    lexical.lemmatizer.terms = _terms
+    assert index.rebuild_lexical() == 2
+    assert held and not any(held)
+    assert lexical.ready.is_set()
+    assert lexical.search("invoice", k=1) and lexical.search("parking", k=1)
+    assert not lexical.search("temporary", k=1)
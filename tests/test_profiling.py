@@ -0,0 +1,52 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app.profiling import RequestProfiler
+
+
+def _busy(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        sum(range(1000))
+
+
+def test_idle_thread_pool_workers_are_not_hotspots():
+    profiler = RequestProfiler(interval_ms=2)
+    pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="idle")
+    try:
+        list(pool.map(lambda _: None, range(8)))   # потоки пула запущены и ждут задач
+        session = profiler.start("req", "POST", "/query", requested=True)
+        _busy(0.2)
+        record = profiler.finish(session, 200)
+    finally:
+        pool.shutdown()
+
+    assert record["samples"] > 0
+    functions = [row["function"] for row in record["hotspots"]["self"]]
+    assert not any(f.startswith("_worker ") for f in functions)
+    assert any(f.startswith("_busy ") for f in functions)
+    assert not any(line.startswith("idle;") for line in profiler.folded("req").splitlines())
+
+
+def _profile(profiler, request_id):
+    return profiler.finish(profiler.start(request_id, "POST", "/query", requested=True), 200)
+
+
+def test_reused_request_id_does_not_overwrite_saved_profile(tmp_path):
+    profiler = RequestProfiler(str(tmp_path), interval_ms=2)
+    _profile(profiler, "same")
+    _profile(profiler, "same")
+    assert len(os.listdir(tmp_path)) == 2
+    assert RequestProfiler(str(tmp_path)).folded("same") is not None
+
+
+def test_profile_directory_keeps_newest_files_across_restarts(tmp_path):
+    (tmp_path / "old.folded").write_text("main;old 1\n")
+    os.utime(tmp_path / "old.folded", (0, 0))
+    profiler = RequestProfiler(str(tmp_path), interval_ms=2, keep=3)
+    for i in range(5):
+        _profile(profiler, f"req{i}")
+    assert len(os.listdir(tmp_path)) == 3
+    assert RequestProfiler(str(tmp_path), keep=2).folded("req0") is None
+    assert len(os.listdir(tmp_path)) == 2
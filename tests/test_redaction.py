@@ -0,0 +1,144 @@
+import random
+import re
+
+import pytest
+
+from app.redaction import RedactionEngine, Rule, check_untrusted
+from app.security import _MATCHER, SANITIZER, StreamSanitizer, sanitize_answer, sanitize_scan, sanity_check
+
+RESERVED = ["secret", "email"]
+
+
+@pytest.mark.parametrize("pattern", [r"(a+)+$", r"(\w*\s?)*x", r"(x+x+)+y", r"((x+)y)*"])
+def test_nested_quantifiers_are_rejected(pattern):
+    with pytest.raises(ValueError):
+        check_untrusted(Rule("custom", pattern), RESERVED)
+
+
+@pytest.mark.parametrize("pattern", [r".+", r"[\s\S]*?\.", r"\S+"])
+def test_rules_covering_plain_text_are_rejected(pattern):
+    with pytest.raises(ValueError):
+        check_untrusted(Rule("custom", pattern), RESERVED)
+
+
+def test_builtin_rules_cannot_be_replaced():
+    with pytest.raises(ValueError):
+        check_untrusted(Rule("secret", r"nothing"), RESERVED)
+
+
+def test_ordinary_rule_is_accepted():
+    check_untrusted(Rule("card", r"\b\d{4}(?: \d{4}){3}\b", flag="contains_card"), RESERVED)
+    check_untrusted(Rule("token", r"tok_[0-9a-f]{16,}"), RESERVED)
+
+
+def test_scan_repeats_until_no_redacting_rule_matches():
+    # каждая замена открывает совпадение ещё на одну цифру левее
+    engine = RedactionEngine([Rule("tok", r"tok"), Rule("digit", r"\d\[REDACTED\]")])
+    result = engine.scan("1234567tok")
+    assert result.text == "[REDACTED]"
+    assert engine.regex.search(result.text) is None
+
+
+def test_scan_stops_on_rule_matching_its_own_replacement():
+    engine = RedactionEngine([Rule("loop", r"REDACTED")])
+    assert engine.scan("REDACTED").text.count("[") == 16
+
+
+def test_flags_are_collected_from_all_passes():
+    engine = RedactionEngine([
+        Rule("tok", r"tok_\w+"),
+        Rule("pair", r"\d+\[REDACTED\]"),
+        Rule("num", r"\b\d+", flag="has_num", redact=False),
+    ])
+    # число видно в первом проходе и исчезает во втором, последний проход его уже не видит
+    result = engine.scan("7tok_a")
+    assert result.text == "[REDACTED]"
+    assert result.flags == {"has_num": True}
+
+
+def _old_sanitize_answer(text):
+    """Прежняя цепочка re.sub, по одному правилу за раз"""
+    text = re.sub(r"\b(?:password|admin_password|superuser_password|secret_key):?\s*\S+\b", "[REDACTED]", text,
+                  flags=re.IGNORECASE)
+    text = re.sub(r"\b[\w\.-]+@[\w\.-]+\.\w+\b", "[REDACTED]", text)
+    text = re.sub(r"https?://\S+", "[REDACTED]", text)
+    text = re.sub(r"\b\d{1,3}(?:\.\d{1,3}){3}\b", "[REDACTED]", text)
+    text = re.sub(r"sk_live_[0-9A-Za-z]+", "[REDACTED]", text)
+    return text
+
+
+def _old_sanity_check(text):
+    return {
+        "contains_email": bool(re.search(r"\b[\w\.-]+@[\w\.-]+\.\w+\b", text)),
+        "contains_url": bool(re.search(r"https?://\S+", text)),
+        "contains_ip": bool(re.search(r"\b\d{1,3}(?:\.\d{1,3}){3}\b", text)),
+    }
+
+
+_ATOMS = ["password: hunter2", "Secret_Key=abc", "sk_live_abc123", "1.2.3.4", "10.0.0.7", "admin@corp.local",
+          "http://x.io/a", "https://a.b/c?d=1", " ", "\n", "abc", "9", ".", "-", "@", ":", "_", "x"]
+_RANDOM = ["".join(rng.choice(_ATOMS) for _ in range(rng.randint(1, 12)))
+           for rng in (random.Random(seed) for seed in range(2000))]
+
+
+def test_redaction_exposing_an_ip_is_redacted_too():
+    # старая цепочка оставляла IP, к которому примкнула замена токена
+    text = "10.0.0.7sk_live_abc123"
+    assert _old_sanitize_answer(text) == "10.0.0.7[REDACTED]"
+    assert sanitize_answer(text) == "[REDACTED][REDACTED]"
+    assert [h["rule"] for h in sanitize_scan(text).hits] == ["sk_live", "ip"]
+
+
+def test_overlapping_rules_merge_into_one_replacement():
+    result = sanitize_scan("see http://user@corp.local/x now")
+    assert result.text == "see [REDACTED] now"
+    assert sorted(h["rule"] for h in result.hits) == ["email", "url"]
+
+
+def test_no_rule_matches_sanitized_text_where_old_chain_left_residue():
+    residue = 0
+    for text in _RANDOM:
+        assert SANITIZER.regex.search(sanitize_answer(text)) is None
+        residue += SANITIZER.regex.search(_old_sanitize_answer(text)) is not None
+    assert residue   # корпус действительно содержит случаи, где старая цепочка недоредактировала
+
+
+def test_sanity_check_matches_old_implementation():
+    for text in _RANDOM:
+        assert sanity_check(text) == _old_sanity_check(text)
+
+
+_STREAM_ATOMS = _ATOMS + ["password:", "secret_key", "ignore all previous instructions", "jailbreak",
+                          "y" * 70, "z" * 200, "  ", "token", "ключ"]
+
+
+def _whole(text, defenses):
+    if "filter" in defenses:
+        text = _MATCHER.redact(text)
+    if "sanitize" in defenses:
+        text = sanitize_answer(text)
+    return text
+
+
+def _streamed(text, defenses, rng):
+    stream, out, pos = StreamSanitizer(defenses), [], 0
+    while pos < len(text):
+        size = rng.randint(1, 12)
+        out.append(stream.feed(text[pos:pos + size]))
+        pos += size
+    out.append(stream.flush())
+    return "".join(out)
+
+
+@pytest.mark.parametrize("defenses", [["sanitize"], ["filter"], ["filter", "sanitize"]])
+def test_stream_output_matches_whole_text(defenses):
+    for seed in range(300):
+        rng = random.Random(seed)
+        text = "".join(rng.choice(_STREAM_ATOMS) for _ in range(rng.randint(1, 30)))
+        assert _streamed(text, defenses, rng) == _whole(text, defenses), text
+
+
+def test_stream_cuts_runs_longer_than_max_run():
+    stream = StreamSanitizer(["sanitize"], max_run=100)
+    assert stream.feed("x" * 99) == ""
+    assert len(stream.feed("x" * 200)) == 299 - stream.lookback